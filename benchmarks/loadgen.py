@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Simulated camera load generator for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import httplib
+import optparse
+import os
+import re
+import resource
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import common
+
+CONTROL_PATH = '/upnp/control/ContentDirectory1'
+DESC_PATH = '/DMS/SamsungDmsDesc.xml'
+HTTP_PORT = 52235
+SSDP_PORT = 1900
+
+# Every camera connects from its own loopback address, the server tells
+# cameras apart by their address.
+CAMERA_ADDRESS = '127.0.1.%d'
+CAMERA_USER_AGENT = 'SEC_HHP_[Camera]LOADGEN%02d/1.0'
+
+IMPORT_URI = re.compile(r'importUri=&quot;http://[^/]+(?P<path>/[^&]+)&quot;')
+SEND_BUFFER_SIZE = 256 * 1024
+
+MSEARCH = ('M-SEARCH * HTTP/1.1\r\n'
+           'HOST: 239.255.255.250:1900\r\n'
+           'MAN: "ssdp:discover"\r\n'
+           'MX: %d\r\n'
+           'ST: urn:schemas-upnp-org:device:MediaServer:1\r\n\r\n')
+
+SOAP_REQUEST = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+  <s:Body>
+    <u:%(action)s xmlns:u="urn:schemas-upnp-org:service:ContentDirectory:1">%(args)s</u:%(action)s>
+  </s:Body>
+</s:Envelope>'''
+SOAP_ACTION = '"urn:schemas-upnp-org:service:ContentDirectory:1#%s"'
+
+CREATE_OBJ_ARGS = '''
+      <ContainerID>DLNA.ORG_AnyContainer</ContainerID>
+      <Elements>%s</Elements>
+    '''
+DIDL = '''<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" xmlns:dlna = "urn:schemas-dlna-org:metadata-1-0/">
+  <item id="" restricted="0" parentID="DLNA.ORG_AnyContainer" >
+    <dc:title>%(name)s</dc:title>
+    <dc:date>%(date)s</dc:date>
+    <upnp:class>%(class)s</upnp:class>
+    <res protocolInfo="*:*:%(type)s:%(subtype)s;DLNA.ORG_CI=0" size="%(size)d" ></res>
+  </item>
+</DIDL-Lite>'''
+
+# The start of each kind of object, followed by a tag making every object's
+# content unique, so deduplication doesn't discard them.
+OBJECT_KINDS = {
+    'jpeg': {'class': 'object.item.imageItem',
+             'ext': 'JPG',
+             'header': '\xff\xd8\xff\xe1\x00\x10Exif\x00\x00',
+             'subtype': 'DLNA.ORG_PN=JPEG_LRG',
+             'type': 'image/jpeg'},
+    'mp4': {'class': 'object.item.videoItem',
+            'ext': 'MP4',
+            'header': '\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom',
+            'subtype': 'DLNA.ORG_PN=AVC_MP4_HP_HD_AAC',
+            'type': 'video/mp4'},
+}
+TAG = struct.Struct('>HI')
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+class SimulatedCamera(object):
+  """Backs up a set of synthetic objects the way a Samsung camera does.
+
+  The camera finds the server with an M-SEARCH, fetches the DMS description
+  and then sends each object with CreateObject and an upload to the
+  importUri it was given, between X_BACKUP_START and X_BACKUP_DONE.
+  """
+
+  def __init__(self, number, host, objects, mx=1):
+    self.address = CAMERA_ADDRESS % (number + 1)
+    self.host = host
+    self.mx = mx
+    self.number = number
+    self.objects = objects
+
+    self.bytes_sent = 0
+    self.discovery_latency = None
+    self.error = None
+    self.object_latencies = []
+
+  def _Connect(self):
+    return httplib.HTTPConnection(self.host, HTTP_PORT,
+                                  source_address=(self.address, 0))
+
+  def _Request(self, method, path, body='', headers={}):
+    conn = self._Connect()
+    try:
+      conn.request(method, path, body, headers)
+      response = conn.getresponse()
+      data = response.read()
+    finally:
+      conn.close()
+    if response.status != 200:
+      raise IOError('%s %s returned %d' % (method, path, response.status))
+    return data
+
+  def _SOAP(self, action, args=''):
+    return self._Request('POST', CONTROL_PATH,
+                         SOAP_REQUEST % {'action': action, 'args': args},
+                         {'Content-Type': 'text/xml; charset="utf-8"',
+                          'SOAPACTION': SOAP_ACTION % action})
+
+  def _Upload(self, path, obj, padding):
+    (kind, index, size) = obj
+    head = OBJECT_KINDS[kind]['header'] + TAG.pack(self.number, index)
+    conn = self._Connect()
+    try:
+      conn.putrequest('POST', path)
+      conn.putheader('Content-Type', OBJECT_KINDS[kind]['type'])
+      conn.putheader('Content-Length', str(size))
+      conn.endheaders()
+      conn.send(head)
+      view = memoryview(padding)
+      sent = len(head)
+      while sent < size:
+        chunk = min(SEND_BUFFER_SIZE, size - sent)
+        conn.send(view[:chunk])
+        sent += chunk
+      response = conn.getresponse()
+      response.read()
+    finally:
+      conn.close()
+    if response.status != 200:
+      raise IOError('Upload to %s returned %d' % (path, response.status))
+    self.bytes_sent += size
+
+  def Discover(self, timeout=10):
+    """Find the server with an M-SEARCH.
+
+    Args:
+      timeout: An int containing the seconds to wait for a response
+
+    Returns:
+      A float containing the seconds until the response arrived
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      s.bind((self.address, 0))
+      s.settimeout(timeout)
+      started = time.time()
+      s.sendto(MSEARCH % self.mx, (self.host, SSDP_PORT))
+      s.recvfrom(4096)
+      return time.time() - started
+    finally:
+      s.close()
+
+  def Run(self, padding, date):
+    """Back up every object.
+
+    Args:
+      padding: A string containing enough data to fill the largest object
+      date: A string containing the date the objects were taken on
+    """
+    try:
+      self.discovery_latency = self.Discover()
+      self._Request('GET', DESC_PATH, headers={
+          'User-Agent': CAMERA_USER_AGENT % self.number})
+      self._SOAP('X_BACKUP_START')
+      for obj in self.objects:
+        (kind, index, size) = obj
+        started = time.time()
+        didl = DIDL % {'class': OBJECT_KINDS[kind]['class'],
+                       'date': date,
+                       'name': 'SAM_%04d.%s' % (index,
+                                                OBJECT_KINDS[kind]['ext']),
+                       'size': size,
+                       'subtype': OBJECT_KINDS[kind]['subtype'],
+                       'type': OBJECT_KINDS[kind]['type']}
+        response = self._SOAP('CreateObject',
+                              CREATE_OBJ_ARGS % common.EscapeHTML(didl))
+        m = IMPORT_URI.search(response)
+        if not m:
+          raise IOError('No importUri in CreateObject response')
+        self._Upload(m.group('path'), obj, padding)
+        self.object_latencies.append(time.time() - started)
+      self._SOAP('X_BACKUP_DONE')
+    except (IOError, socket.error, httplib.HTTPException) as e:
+      self.error = '%s: %s' % (self.address, e)
+
+
+def GetPeakRSS(pid):
+  """Get the peak resident set size of a process.
+
+  Args:
+    pid: An int containing the process id
+
+  Returns:
+    An int containing the peak RSS in bytes, or None if it can't be read
+  """
+  try:
+    with open('/proc/%d/status' % pid) as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except IOError:
+    pass
+  return None
+
+
+def Percentile(values, percent):
+  """Get a percentile of a list of values.
+
+  Args:
+    values: A sorted list of numbers
+    percent: A number between 0 and 100
+
+  Returns:
+    The value below which percent of values fall
+  """
+  if not values:
+    return 0
+  return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def ParseSize(size):
+  """Parse an object size given on the command line.
+
+  Args:
+    size: A string containing a number of bytes, optionally followed by K,
+      M or G
+
+  Returns:
+    An int containing the number of bytes
+  """
+  size = size.strip().upper()
+  unit = size[-1:] if size[-1:] in SIZE_UNITS else ''
+  return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def StartServer(work_dir, cameras):
+  """Start a PC Autobackup server writing to a scratch directory.
+
+  Args:
+    work_dir: A string containing the scratch directory
+    cameras: An int containing the number of cameras which will back up
+
+  Returns:
+    A subprocess.Popen
+  """
+  config_file = os.path.join(work_dir, 'pc_autobackup.cfg')
+  config = common.LoadOrCreateConfig(config_file)
+  config.set('AUTOBACKUP', 'backup_dir', os.path.join(work_dir, 'backup'))
+  config.set('AUTOBACKUP', 'max_sessions', str(max(cameras, 1)))
+  config.set('AUTOBACKUP', 'state_dir', os.path.join(work_dir, 'state'))
+  config.Save()
+
+  server = subprocess.Popen(
+      [sys.executable, os.path.join(common.BASEDIR, 'pc_autobackup.py'),
+       '--config_file', config_file, '--log_file',
+       os.path.join(work_dir, 'autobackup.log'), '-q'])
+  # Wait for the server to accept connections.
+  for _ in xrange(50):
+    try:
+      socket.create_connection(('127.0.0.1', HTTP_PORT), 0.1).close()
+      return server
+    except socket.error:
+      time.sleep(0.1)
+  server.terminate()
+  sys.exit('PC Autobackup did not start, see %s' %
+           os.path.join(work_dir, 'autobackup.log'))
+
+
+def main():
+  parser = optparse.OptionParser(
+      usage='%prog [options]\n\nBack up synthetic objects from simulated '
+      'cameras over loopback.')
+  parser.add_option('-c', '--cameras', dest='cameras', type='int', default=4,
+                    help='number of cameras backing up at once',
+                    metavar='COUNT')
+  parser.add_option('--host', dest='host', default='127.0.0.1',
+                    help='address of a server which is already running',
+                    metavar='IP')
+  parser.add_option('--jpeg_size', dest='jpeg_size', default='4M',
+                    help='size of each photo (default: 4M)', metavar='SIZE')
+  parser.add_option('--mp4_size', dest='mp4_size', default='20M',
+                    help='size of each video (default: 20M)', metavar='SIZE')
+  parser.add_option('--mx', dest='mx', type='int', default=1,
+                    help='MX of the M-SEARCH (default: 1)', metavar='SECONDS')
+  parser.add_option('--photos', dest='photos', type='int', default=20,
+                    help='photos per camera (default: 20)', metavar='COUNT')
+  parser.add_option('--start_server', dest='start_server',
+                    action='store_true', default=False,
+                    help='start a server writing to a scratch directory')
+  parser.add_option('--videos', dest='videos', type='int', default=2,
+                    help='videos per camera (default: 2)', metavar='COUNT')
+  (options, args) = parser.parse_args()
+
+  sizes = {'jpeg': ParseSize(options.jpeg_size),
+           'mp4': ParseSize(options.mp4_size)}
+  for kind, size in sizes.items():
+    if size < len(OBJECT_KINDS[kind]['header']) + TAG.size:
+      parser.error('%s objects must be at least %d bytes' % (
+          kind, len(OBJECT_KINDS[kind]['header']) + TAG.size))
+  padding = '\0' * max(sizes.values())
+
+  work_dir = None
+  server = None
+  if options.start_server:
+    work_dir = tempfile.mkdtemp(prefix='pc_autobackup_loadgen.')
+    server = StartServer(work_dir, options.cameras)
+
+  cameras = []
+  for number in xrange(options.cameras):
+    objects = []
+    for index in xrange(options.photos + options.videos):
+      kind = 'jpeg' if index < options.photos else 'mp4'
+      objects.append((kind, index + 1, sizes[kind]))
+    cameras.append(SimulatedCamera(number, options.host, objects,
+                                   mx=options.mx))
+
+  try:
+    started = time.time()
+    threads = [threading.Thread(target=camera.Run,
+                                args=(padding, '2012-01-%02d' % (n % 28 + 1)))
+               for n, camera in enumerate(cameras)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    duration = max(time.time() - started, 0.001)
+
+    server_rss = server and GetPeakRSS(server.pid)
+  finally:
+    if server:
+      server.terminate()
+      server.wait()
+    if work_dir:
+      shutil.rmtree(work_dir)
+
+  errors = [camera.error for camera in cameras if camera.error]
+  discovery = sorted(camera.discovery_latency for camera in cameras
+                     if camera.discovery_latency is not None)
+  latencies = sorted(sum((camera.object_latencies for camera in cameras), []))
+  total_bytes = sum(camera.bytes_sent for camera in cameras)
+
+  print '%d cameras, %d objects, %.1f MB in %.2fs' % (
+      len(cameras), len(latencies), total_bytes / 1048576.0, duration)
+  print 'discovery latency  p50 %7.1f ms  max %7.1f ms' % (
+      Percentile(discovery, 50) * 1000, (discovery or [0])[-1] * 1000)
+  print 'object latency     p50 %7.1f ms  p90 %7.1f ms  p99 %7.1f ms  ' \
+        'max %7.1f ms' % (Percentile(latencies, 50) * 1000,
+                          Percentile(latencies, 90) * 1000,
+                          Percentile(latencies, 99) * 1000,
+                          (latencies or [0])[-1] * 1000)
+  print 'throughput         %.1f MB/s' % (total_bytes / 1048576.0 / duration)
+  if server_rss:
+    print 'server peak RSS    %.1f MB' % (server_rss / 1048576.0)
+  print 'loadgen peak RSS   %.1f MB' % (
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+  for error in errors:
+    print 'error: %s' % error
+  if errors:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
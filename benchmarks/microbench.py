@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Microbenchmarks for PC Autobackup hot paths
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import HTMLParser
+import json
+import optparse
+import os
+import platform
+import re
+import sys
+import timeit
+import xml.dom.minidom
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import common
+import mediaserver
+import ssdp
+
+# Results of a run on the reference machine, which later runs are compared
+# with. A benchmark with a reference is checked by how many times faster
+# than its reference it is. Both are timed in the same run, so the check
+# holds on any machine and under load. Times per call are only checked with
+# --absolute, on the machine the baseline was saved on. Regenerate it after
+# an intended change in performance with
+#   benchmarks/microbench.py --baseline= --save benchmarks/baseline.json
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baseline.json')
+# Without --number, each benchmark is called often enough for a run to last
+# at least this many seconds, so the fastest calls aren't lost in the noise.
+MIN_RUN_TIME = 0.05
+CREATE_OBJ_DIDL = re.compile(r'<Elements>(?P<didl>.*)</Elements>')
+CREATE_OBJ_REQUEST = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+  <s:Body>
+    <u:CreateObject xmlns:u="urn:schemas-upnp-org:service:ContentDirectory:1">
+      <ContainerID>DLNA.ORG_AnyContainer</ContainerID>
+      <Elements>%s</Elements>
+    </u:CreateObject>
+  </s:Body>
+</s:Envelope>'''
+DIDL = ('<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" '
+        'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+        'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" '
+        'xmlns:dlna = "urn:schemas-dlna-org:metadata-1-0/">'
+        '<item id="" restricted="0" parentID="DLNA.ORG_AnyContainer" >'
+        '<dc:title>SAM_0001.JPG</dc:title>'
+        '<dc:date>2012-01-01</dc:date>'
+        '<upnp:class>object.item.imageItem</upnp:class>'
+        '<res protocolInfo="*:*:image/jpeg:DLNA.ORG_PN=JPEG_LRG;DLNA.ORG_CI=0" '
+        'size="4429673" ></res>'
+        '</item></DIDL-Lite>')
+MSEARCH = ('M-SEARCH * HTTP/1.1\r\n'
+           'HOST: 239.255.255.250:1900\r\n'
+           'MAN: "ssdp:discover"\r\n'
+           'MX: 3\r\n'
+           'ST: urn:schemas-upnp-org:device:MediaServer:1\r\n'
+           'USER-AGENT: SEC_HHP_[Camera]WB150F/1.0\r\n\r\n')
+SOAP_XML = CREATE_OBJ_REQUEST % common.EscapeHTML(DIDL)
+UUID = '4a682b0b-0361-dbae-6155-d8c5b1cb1f41'
+RESPONSE_DICT = {'interface': '192.168.1.10',
+                 'obj_class': u'object.item.imageItem',
+                 'obj_id': '123456',
+                 'obj_size': u'4429673',
+                 'obj_subtype': u'DLNA.ORG_PN=JPEG_LRG',
+                 'obj_type': u'image/jpeg',
+                 'parent_id': 'DLNA.ORG_AnyContainer',
+                 'resume_upload': 0,
+                 'uploaded_size': 0}
+
+
+def CreateObjectResponseFormat(response_dict):
+  """Build a CreateObject response the way GetContentDirectoryResponse used to.
+
+  Args:
+    response_dict: A dict containing the values of the response
+
+  Returns:
+    A string containing the response
+  """
+  response_dict = dict(response_dict)
+  didl = mediaserver.CREATE_OBJ_RESPONSE_DIDL % response_dict
+  response_dict['didl'] = EscapeHTMLReplace(didl)
+  return mediaserver.CREATE_OBJ_RESPONSE % response_dict
+
+
+def CreateObjectResponseTemplate(response_dict):
+  """Build a CreateObject response from the pre-escaped template.
+
+  Args:
+    response_dict: A dict containing the values of the response
+
+  Returns:
+    A string containing the response
+  """
+  response_dict = dict(response_dict)
+  for k in ('obj_class', 'obj_size', 'obj_subtype', 'obj_type'):
+    response_dict[k] = common.EscapeHTML('%s' % response_dict[k])
+  return mediaserver.CREATE_OBJ_RESPONSE_TEMPLATE % response_dict
+
+
+def EscapeHTMLReplace(html):
+  """Escape HTML the way common.EscapeHTML used to.
+
+  Args:
+    html: A string containing HTML to be escaped
+
+  Returns:
+    A string containing escaped HTML
+  """
+  for old, new in common.HTML_CODES:
+    html = html.replace(old, new)
+  return html
+
+
+def ParseDIDLMinidom(soap_xml):
+  """Parse a CreateObject request the way ParseDIDL used to.
+
+  Args:
+    soap_xml: A string containing the CreateObject request
+
+  Returns:
+    A dict containing the item's elements
+  """
+  didl = CREATE_OBJ_DIDL.search(soap_xml).group('didl')
+  didl = HTMLParser.HTMLParser().unescape(didl)
+
+  didl_elements = {}
+  dom = xml.dom.minidom.parseString(didl)
+
+  def getText(node):
+    rc = []
+    for child in node.childNodes:
+      if child.nodeType == child.TEXT_NODE:
+        rc.append(child.data)
+    return ''.join(rc)
+
+  for tag, key in [('dc:title', 'name'), ('dc:date', 'date'),
+                   ('upnp:class', 'class')]:
+    nodes = dom.getElementsByTagName(tag)
+    if nodes:
+      didl_elements[key] = getText(nodes[0])
+
+  res = dom.getElementsByTagName('res')
+  if res:
+    for k, v in res[0].attributes.items():
+      didl_elements[k] = v
+
+  return didl_elements
+
+
+def ParseDIDLExpat(soap_xml):
+  """Parse a CreateObject request with mediaserver.DIDLParser.
+
+  Args:
+    soap_xml: A string containing the CreateObject request
+
+  Returns:
+    A dict containing the item's elements
+  """
+  return mediaserver.DIDLParser().Parse(soap_xml)
+
+
+class Backup(mediaserver.Backup):
+  """A Backup which doesn't load the configuration or open any state."""
+
+  def __init__(self):
+    pass
+
+
+class SSDPServer(ssdp.SSDPServer):
+  """An SSDPServer with a configuration which is never read from disk."""
+
+  def __init__(self):
+    self.config = common.Config(os.path.join(os.path.dirname(BASELINE_FILE),
+                                             'microbench.cfg'))
+    self.config.add_section('AUTOBACKUP')
+    self.config.set('AUTOBACKUP', 'uuid', UUID)
+    self._responses = {}
+    self._responses_mtime = None
+    self._responses_uuid = None
+
+
+BACKUP = Backup()
+SSDP_SERVER = SSDPServer()
+
+
+# Benchmarks in the order they are run. A benchmark with a reference is
+# timed against it, which is how it is checked against the baseline.
+BENCHMARKS = [
+    ('parse_didl_minidom', lambda: ParseDIDLMinidom(SOAP_XML), None),
+    ('parse_didl', lambda: ParseDIDLExpat(SOAP_XML), 'parse_didl_minidom'),
+    ('escape_value_replace', lambda: EscapeHTMLReplace(u'image/jpeg'), None),
+    ('escape_value', lambda: common.EscapeHTML(u'image/jpeg'),
+     'escape_value_replace'),
+    ('create_object_response_format',
+     lambda: CreateObjectResponseFormat(RESPONSE_DICT), None),
+    ('create_object_response',
+     lambda: CreateObjectResponseTemplate(RESPONSE_DICT),
+     'create_object_response_format'),
+    ('generate_object_id', lambda: BACKUP._GenerateObjectID('2012-01-01'),
+     None),
+    ('parse_ssdp_discovery', lambda: SSDP_SERVER.ParseSSDPDiscovery(MSEARCH),
+     None),
+    ('generate_ssdp_response',
+     lambda: SSDP_SERVER.GenerateSSDPResponse('m-search', '192.168.1.10',
+                                              UUID), None),
+    ('get_ssdp_response',
+     lambda: SSDP_SERVER.GetSSDPResponse('m-search', '192.168.1.10'),
+     'generate_ssdp_response'),
+]
+
+
+def CompareResults(results, baseline, tolerance, absolute=None):
+  """Compare benchmark results with a baseline.
+
+  Args:
+    results: A dict containing the time per call of each benchmark
+    baseline: A dict containing the baseline time per call of each benchmark
+    tolerance: A float containing how much less faster than its reference a
+      benchmark may be than in the baseline, e.g. 0.1 for 10%
+    absolute: A float containing how much slower than the baseline the time
+      per call of a benchmark may be, or None to not check it
+
+  Returns:
+    A list of strings containing the names of benchmarks which regressed
+  """
+  regressions = []
+  for name, func, reference in BENCHMARKS:
+    if name not in results or name not in baseline:
+      continue
+
+    change = results[name] / baseline[name] - 1
+    line = '%-30s %10.2f -> %10.2f us/call  %+6.1f%%' % (
+        name, baseline[name], results[name], change * 100)
+    regressed = absolute is not None and change > absolute
+
+    if reference in results and reference in baseline:
+      speedup = baseline[reference] / baseline[name]
+      new_speedup = results[reference] / results[name]
+      line += '  %5.1fx -> %5.1fx' % (speedup, new_speedup)
+      regressed = regressed or speedup / new_speedup - 1 > tolerance
+
+    if regressed:
+      line += '  REGRESSION'
+      regressions.append(name)
+    print line
+  return regressions
+
+
+def LoadResults(results_file):
+  """Load benchmark results saved with --save.
+
+  Args:
+    results_file: A string containing the path to the results
+
+  Returns:
+    A dict containing the time per call of each benchmark
+  """
+  with open(results_file) as f:
+    return json.load(f)['results']
+
+
+def SaveResults(results_file, results, number, repeat):
+  """Save benchmark results as JSON.
+
+  Args:
+    results_file: A string containing the path to save the results at
+    results: A dict containing the time per call of each benchmark
+    number: An int containing the number of calls per run, or None if each
+      benchmark was called often enough for a run to last MIN_RUN_TIME
+    repeat: An int containing the number of runs
+  """
+  with open(results_file, 'w') as f:
+    json.dump({'number': number,
+               'platform': platform.platform(),
+               'python': platform.python_version(),
+               'repeat': repeat,
+               'results': results}, f, indent=2, sort_keys=True)
+    f.write('\n')
+
+
+def GetNumber(timer):
+  """Get how many calls of a benchmark make a run of at least MIN_RUN_TIME.
+
+  Args:
+    timer: A timeit.Timer for the benchmark
+
+  Returns:
+    An int containing the number of calls per run
+  """
+  number = 1
+  while timer.timeit(number=number) < MIN_RUN_TIME:
+    number *= 2
+  return number
+
+
+def RunBenchmarks(funcs, number, repeat):
+  """Time benchmarks, taking turns so they all run under the same load.
+
+  Args:
+    funcs: A list of functions taking no arguments
+    number: An int containing the number of calls per run, or None to make
+      each run last at least MIN_RUN_TIME
+    repeat: An int containing the number of runs
+
+  Returns:
+    A list of floats containing the fastest time per call of each function
+    in microseconds
+  """
+  timers = [timeit.Timer(func) for func in funcs]
+  numbers = [number or GetNumber(timer) for timer in timers]
+  times = [[] for _ in timers]
+  for _ in range(repeat):
+    for timer, timer_number, timer_times in zip(timers, numbers, times):
+      timer_times.append(timer.timeit(number=timer_number) / timer_number)
+  return [min(timer_times) * 1e6 for timer_times in times]
+
+
+def main():
+  parser = optparse.OptionParser(
+      usage='%prog [options] [BENCHMARK...]\n\nTime the per-request hot '
+      'paths and compare them with a baseline.\nRegenerate the committed '
+      'baseline with\n--save benchmarks/baseline.json.')
+  parser.add_option('-a', '--absolute', dest='absolute', type='float',
+                    help='also fail when a time per call is more than '
+                    'PERCENT slower than the baseline', metavar='PERCENT')
+  parser.add_option('-b', '--baseline', dest='baseline', default=BASELINE_FILE,
+                    help='compare with results saved with --save, empty to '
+                    'skip the comparison (default: %default)', metavar='FILE')
+  parser.add_option('-n', '--number', dest='number', type='int',
+                    help='calls per run (default: enough for a run to last '
+                    '%gs)' % MIN_RUN_TIME, metavar='NUMBER')
+  parser.add_option('-r', '--repeat', dest='repeat', type='int', default=10,
+                    help='runs per benchmark, the fastest is reported',
+                    metavar='REPEAT')
+  parser.add_option('-s', '--save', dest='save',
+                    help='save the results as JSON', metavar='FILE')
+  parser.add_option('-t', '--tolerance', dest='tolerance', type='float',
+                    default=25, help='percent less faster than its reference '
+                    'than in the baseline which is a regression (default: '
+                    '%default)', metavar='PERCENT')
+  (options, args) = parser.parse_args()
+
+  saved_results = None
+  if options.baseline:
+    try:
+      saved_results = LoadResults(options.baseline)
+    except (IOError, KeyError, ValueError) as e:
+      parser.error('Unable to load %s: %s' % (options.baseline, e))
+
+  if ParseDIDLExpat(SOAP_XML) != ParseDIDLMinidom(SOAP_XML):
+    sys.exit('DIDLParser and minidom results differ')
+  if (CreateObjectResponseTemplate(RESPONSE_DICT) !=
+      CreateObjectResponseFormat(RESPONSE_DICT)):
+    sys.exit('CreateObject responses differ')
+
+  benchmarks = [b for b in BENCHMARKS if not args or b[0] in args]
+  results = dict(zip(
+      [name for name, _, _ in benchmarks],
+      RunBenchmarks([func for _, func, _ in benchmarks], options.number,
+                    options.repeat)))
+  for name, func, reference in benchmarks:
+    line = '%-30s %10.2f us/call' % (name, results[name])
+    if reference in results:
+      line += '  %.1fx faster than %s' % (results[reference] / results[name],
+                                         reference)
+    print line
+
+  if options.save:
+    SaveResults(options.save, results, options.number, options.repeat)
+
+  if saved_results is not None:
+    print
+    absolute = None
+    if options.absolute is not None:
+      absolute = options.absolute / 100.0
+    regressions = CompareResults(results, saved_results,
+                                 options.tolerance / 100.0, absolute)
+    if regressions:
+      sys.exit('%d benchmarks regressed: %s' % (len(regressions),
+                                              ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Catalog of backed up objects for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import collections
+import logging
+import optparse
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import common
+
+COLUMNS = ('obj_id', 'name', 'date', 'size', 'class', 'mime_type', 'hash',
+           'path', 'camera', 'client_ip', 'session', 'stored', 'duplicate')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+  id INTEGER PRIMARY KEY,
+  obj_id TEXT NOT NULL,
+  name TEXT NOT NULL,
+  date TEXT,
+  size INTEGER,
+  class TEXT,
+  mime_type TEXT,
+  hash TEXT,
+  path TEXT NOT NULL,
+  camera TEXT,
+  client_ip TEXT,
+  session TEXT,
+  stored REAL NOT NULL,
+  duplicate INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS objects_camera_stored ON objects (camera, stored);
+CREATE INDEX IF NOT EXISTS objects_date ON objects (date);
+CREATE INDEX IF NOT EXISTS objects_hash ON objects (hash);
+CREATE INDEX IF NOT EXISTS objects_name ON objects (name);
+CREATE INDEX IF NOT EXISTS objects_session ON objects (session);
+CREATE INDEX IF NOT EXISTS objects_stored ON objects (stored);
+'''
+
+# Browsing walks the objects one date at a time. The number of objects of
+# each date is kept up to date in the dates table, so a page of any size
+# never has to count or skip more than the objects of a single date.
+# Duplicates point at a file which is already listed and are left out. Every
+# index on objects ends in the id, so a page of the objects of a date or
+# class is read from the index in the order they were backed up.
+BROWSE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dates (
+  date TEXT PRIMARY KEY,
+  objects INTEGER NOT NULL
+);
+DROP INDEX IF EXISTS objects_browse;
+CREATE INDEX IF NOT EXISTS objects_browse_date ON objects (IFNULL(date, ''))
+  WHERE NOT duplicate;
+CREATE INDEX IF NOT EXISTS objects_browse_class ON objects (class)
+  WHERE NOT duplicate;
+CREATE TRIGGER IF NOT EXISTS objects_dates AFTER INSERT ON objects
+  WHEN NOT NEW.duplicate
+BEGIN
+  INSERT OR IGNORE INTO dates (date, objects)
+    VALUES (IFNULL(NEW.date, ''), 0);
+  UPDATE dates SET objects = objects + 1 WHERE date = IFNULL(NEW.date, '');
+END;
+'''
+
+# The most pages whose position is remembered. Clients page through the
+# objects of a date or a search in order, so the next page is read after the
+# id of the last object they were sent instead of skipping the objects
+# before it.
+MAX_CURSORS = 100
+
+# How each Search operator is turned into SQL, given the column and value.
+SEARCH_OPERATORS = {
+    '=': lambda column, value: ('%s = ?' % column, [value]),
+    '!=': lambda column, value: ('%s != ?' % column, [value]),
+    'contains': lambda column, value: (
+        "%s LIKE ? ESCAPE '\\'" % column, ['%%%s%%' % EscapeLike(value)]),
+    'derivedfrom': lambda column, value: (
+        "(%s = ? OR %s LIKE ? ESCAPE '\\')" % (column, column),
+        [value, '%s.%%' % EscapeLike(value)]),
+}
+
+
+class Catalog(object):
+  """An SQLite catalog of every object which has been backed up.
+
+  Saved objects are queued per client and written to the catalog in one
+  transaction when the client's backup session ends, which is also when the
+  camera and session they came from are filled in.
+
+  The connection may be used from any thread, one at a time.
+  """
+
+  def __init__(self, db_file):
+    self.logger = logging.getLogger('pc_autobackup.catalog')
+    self.db_file = db_file
+
+    self._counts = {}
+    self._cursors = {}
+    self._lock = threading.Lock()
+    self._pending = collections.defaultdict(list)
+
+    db_dir = os.path.dirname(db_file)
+    if db_dir and not os.path.isdir(db_dir):
+      os.makedirs(db_dir)
+
+    self._db = sqlite3.connect(db_file, check_same_thread=False)
+    self._db.row_factory = sqlite3.Row
+    with self._lock:
+      # Readers, like the query command, don't have to wait for the server.
+      self._db.execute('PRAGMA journal_mode=WAL')
+      self._db.execute('PRAGMA synchronous=NORMAL')
+      self._db.executescript(SCHEMA)
+      self._Upgrade()
+
+  def _Upgrade(self):
+    columns = [row['name'] for row in
+               self._db.execute('PRAGMA table_info(objects)')]
+    if 'duplicate' not in columns:
+      self._db.execute('ALTER TABLE objects ADD COLUMN duplicate INTEGER NOT '
+                       'NULL DEFAULT 0')
+
+    new_dates = not self._db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+        "name = 'dates'").fetchone()
+    self._db.executescript(BROWSE_SCHEMA)
+    if new_dates:
+      with self._db:
+        self._db.execute(
+            "INSERT INTO dates (date, objects) SELECT IFNULL(date, ''), "
+            "COUNT(*) FROM objects WHERE NOT duplicate "
+            "GROUP BY IFNULL(date, '')")
+
+  def _Count(self, where, args):
+    key = (where, tuple(args))
+    if key not in self._counts:
+      self._counts[key] = self._db.execute(
+          'SELECT COUNT(*) FROM objects WHERE %s' % where, args).fetchone()[0]
+    return self._counts[key]
+
+  def _Page(self, where, args, offset, limit):
+    key = (where, tuple(args))
+    after = self._cursors.get(key + (offset,))
+    if after is None:
+      rows = self._db.execute(
+          'SELECT * FROM objects WHERE %s ORDER BY id LIMIT ? OFFSET ?' % where,
+          args + [-1 if limit is None else limit, offset]).fetchall()
+    else:
+      rows = self._db.execute(
+          'SELECT * FROM objects WHERE %s AND id > ? ORDER BY id LIMIT ?' %
+          where, args + [after, -1 if limit is None else limit]).fetchall()
+
+    if rows:
+      if len(self._cursors) >= MAX_CURSORS:
+        self._cursors.clear()
+      self._cursors[key + (offset + len(rows),)] = rows[-1]['id']
+    return rows
+
+  def __len__(self):
+    with self._lock:
+      return self._db.execute('SELECT COUNT(*) FROM objects').fetchone()[0]
+
+  def Add(self, entries):
+    """Write objects to the catalog in one transaction.
+
+    Args:
+      entries: A list of dicts with a value for each of COLUMNS
+    """
+    sql = 'INSERT INTO objects (%s) VALUES (%s)' % (
+        ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+    with self._lock:
+      with self._db:
+        self._db.executemany(
+            sql, [[entry.get(k) for k in COLUMNS] for entry in entries])
+      self._counts.clear()
+      self._cursors.clear()
+    self.logger.debug('Added %d objects to the catalog', len(entries))
+
+  def Close(self):
+    """Close the catalog."""
+    with self._lock:
+      self._db.close()
+
+  def Find(self, camera=None, since=None, until=None, date=None, name=None,
+           session=None, limit=None):
+    """Find backed up objects.
+
+    Args:
+      camera: A string containing the model of the camera the objects came
+        from
+      since: A float containing the earliest time the objects were stored
+      until: A float containing the latest time the objects were stored
+      date: A string containing the date of the objects
+      name: A string containing the name of the objects
+      session: A string containing the backup session of the objects
+      limit: An int containing the maximum number of objects to return
+
+    Returns:
+      A list of sqlite3.Row objects, oldest first
+    """
+    where = []
+    args = []
+    for column, op, value in (('camera', '=', camera),
+                              ('stored', '>=', since),
+                              ('stored', '<', until),
+                              ('date', '=', date),
+                              ('name', '=', name),
+                              ('session', '=', session)):
+      if value is not None:
+        where.append('%s %s ?' % (column, op))
+        args.append(value)
+
+    sql = 'SELECT * FROM objects'
+    if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY stored'
+    if limit:
+      sql += ' LIMIT ?'
+      args.append(limit)
+
+    with self._lock:
+      return self._db.execute(sql, args).fetchall()
+
+  def Flush(self, client_ip, camera=None, session=None):
+    """Take the objects queued for a client.
+
+    Args:
+      client_ip: A string containing the client's IP address
+      camera: A string containing the model of the client's camera
+      session: A string containing the id of the client's backup session
+
+    Returns:
+      A list of dicts ready to be passed to Add
+    """
+    entries = self._pending.pop(client_ip, [])
+    for entry in entries:
+      entry['camera'] = camera
+      entry['session'] = session
+    return entries
+
+  def GetCameras(self):
+    """Get the cameras which have backed up objects.
+
+    Returns:
+      A list of sqlite3.Row objects with camera, objects and last_stored
+    """
+    with self._lock:
+      return self._db.execute(
+          'SELECT camera, COUNT(*) AS objects, MAX(stored) AS last_stored '
+          'FROM objects GROUP BY camera ORDER BY camera').fetchall()
+
+  def GetDate(self, date):
+    """Get a date which has backed up objects.
+
+    Args:
+      date: A string containing the date, or '' for objects without one
+
+    Returns:
+      A sqlite3.Row object with date and objects, or None if there are no
+      objects of the date
+    """
+    with self._lock:
+      return self._db.execute('SELECT date, objects FROM dates WHERE date = ?',
+                              (date,)).fetchone()
+
+  def GetDates(self, offset=0, limit=None):
+    """Get the dates which have backed up objects, newest first.
+
+    Args:
+      offset: An int containing the number of dates to skip
+      limit: An int containing the maximum number of dates to return
+
+    Returns:
+      A tuple of a list of sqlite3.Row objects with date and objects, and
+      an int containing the number of dates
+    """
+    with self._lock:
+      total = self._db.execute('SELECT COUNT(*) FROM dates').fetchone()[0]
+      rows = self._db.execute(
+          'SELECT date, objects FROM dates ORDER BY date DESC LIMIT ? '
+          'OFFSET ?', (-1 if limit is None else limit, offset)).fetchall()
+    return (rows, total)
+
+  def GetObject(self, row_id):
+    """Get a backed up object.
+
+    Args:
+      row_id: An int containing the object's id in the catalog
+
+    Returns:
+      A sqlite3.Row object, or None if there is no such object
+    """
+    with self._lock:
+      return self._db.execute('SELECT * FROM objects WHERE id = ?',
+                              (row_id,)).fetchone()
+
+  def GetObjectsOfDate(self, date, offset=0, limit=None):
+    """Get the objects of a date, in the order they were backed up.
+
+    Duplicates are left out.
+
+    Args:
+      date: A string containing the date, or '' for objects without one
+      offset: An int containing the number of objects to skip
+      limit: An int containing the maximum number of objects to return
+
+    Returns:
+      A list of sqlite3.Row objects
+    """
+    with self._lock:
+      return self._Page("IFNULL(date, '') = ? AND NOT duplicate", [date],
+                        offset, limit)
+
+  def GetPendingClients(self):
+    """Get the clients which have objects queued.
+
+    Returns:
+      A list of strings containing IP addresses
+    """
+    return self._pending.keys()
+
+  def GetUpdateID(self):
+    """Get a number which changes whenever objects are added.
+
+    Returns:
+      An int containing the id of the newest object
+    """
+    with self._lock:
+      return self._db.execute('SELECT MAX(id) FROM objects').fetchone()[0] or 0
+
+  def Queue(self, client_ip, entry):
+    """Queue a saved object until the client's backup session ends.
+
+    Args:
+      client_ip: A string containing the client's IP address
+      entry: A dict with a value for each of COLUMNS, apart from camera and
+        session
+    """
+    entry['client_ip'] = client_ip
+    self._pending[client_ip].append(entry)
+
+  def Search(self, criteria, date=None, offset=0, limit=None):
+    """Find backed up objects matching all of a list of criteria.
+
+    Duplicates are left out.
+
+    Args:
+      criteria: A list of tuples of a column, one of SEARCH_OPERATORS and a
+        value
+      date: A string containing the date to search in, '' for objects
+        without one, or None to search every date
+      offset: An int containing the number of objects to skip
+      limit: An int containing the maximum number of objects to return
+
+    Returns:
+      A tuple of a list of sqlite3.Row objects, in the order they were backed
+      up, and an int containing the number of matching objects
+
+    Raises:
+      ValueError: A criterion has an unknown column or operator
+    """
+    where = ['NOT duplicate']
+    args = []
+    if date is not None:
+      criteria = list(criteria) + [('date', '=', date)]
+    for column, op, value in criteria:
+      if column not in COLUMNS or op not in SEARCH_OPERATORS:
+        raise ValueError('Unsupported criterion: %s %s' % (column, op))
+      if column == 'date' and op == '=':
+        # Objects without a date are kept under '', as in the dates table.
+        column = "IFNULL(date, '')"
+      (sql, values) = SEARCH_OPERATORS[op](column, value)
+      where.append(sql)
+      args.extend(values)
+    where = ' AND '.join(where)
+
+    with self._lock:
+      return (self._Page(where, args, offset, limit),
+              self._Count(where, args))
+
+
+def EscapeLike(value):
+  """Escape a value for use in a LIKE pattern.
+
+  Args:
+    value: A string to be matched literally
+
+  Returns:
+    A string with the LIKE wildcards escaped with a backslash
+  """
+  return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def ParseDate(date):
+  """Parse a date given on the command line.
+
+  Args:
+    date: A string containing a date as YYYY-MM-DD
+
+  Returns:
+    A float containing the start of the date in seconds since the epoch
+  """
+  return time.mktime(time.strptime(date, '%Y-%m-%d'))
+
+
+def main():
+  parser = optparse.OptionParser(
+      usage='%prog [options]\n\nList objects in the backup catalog.')
+  parser.add_option('--camera', dest='camera',
+                    help='only objects from this camera model, as listed by '
+                    '--cameras', metavar='MODEL')
+  parser.add_option('--cameras', dest='cameras', action='store_true',
+                    default=False, help='list the cameras in the catalog')
+  parser.add_option('--config_file', dest='config_file',
+                    help='change config file location', metavar='FILE')
+  parser.add_option('--date', dest='date',
+                    help='only objects taken on this date', metavar='DATE')
+  parser.add_option('--days', dest='days', type='int',
+                    help='only objects stored in the last DAYS days',
+                    metavar='DAYS')
+  parser.add_option('--limit', dest='limit', type='int',
+                    help='list at most this many objects', metavar='COUNT')
+  parser.add_option('--name', dest='name',
+                    help='only objects with this name', metavar='NAME')
+  parser.add_option('--session', dest='session',
+                    help='only objects from this backup session',
+                    metavar='SESSION')
+  parser.add_option('--since', dest='since',
+                    help='only objects stored on or after this date',
+                    metavar='YYYY-MM-DD')
+  parser.add_option('--until', dest='until',
+                    help='only objects stored before this date',
+                    metavar='YYYY-MM-DD')
+  (options, args) = parser.parse_args()
+
+  config = common.LoadOrCreateConfig(options.config_file or
+                                     common.CONFIG_FILE)
+  db_file = os.path.join(common.GetStateDir(config), 'catalog.sqlite')
+  if not os.path.isfile(db_file):
+    sys.exit('Catalog %s does not exist' % db_file)
+  catalog = Catalog(db_file)
+
+  if options.cameras:
+    for row in catalog.GetCameras():
+      print '%s\t%d\t%s' % (row['camera'], row['objects'],
+                            time.strftime('%Y-%m-%d %H:%M:%S',
+                                          time.localtime(row['last_stored'])))
+    return
+
+  since = None
+  until = None
+  try:
+    if options.since:
+      since = ParseDate(options.since)
+    if options.until:
+      until = ParseDate(options.until)
+  except ValueError as e:
+    parser.error(str(e))
+  if options.days:
+    since = max(since or 0, time.time() - options.days * 86400)
+
+  for row in catalog.Find(camera=options.camera, since=since, until=until,
+                          date=options.date, name=options.name,
+                          session=options.session, limit=options.limit):
+    print '\t'.join([
+        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['stored'])),
+        row['camera'] or '-', row['date'] or '-', str(row['size']),
+        row['path']]).encode('utf-8')
+
+
+if __name__ == '__main__':
+  main()
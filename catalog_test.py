@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the catalog of backed up objects
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import catalog
+
+
+def MakeEntry(name, date='2012-01-01', **values):
+  """Make a catalog entry for an object.
+
+  Args:
+    name: A string containing the object's name
+    date: A string containing the object's date
+    **values: Values for other COLUMNS
+
+  Returns:
+    A dict with a value for each of COLUMNS, apart from camera and session
+  """
+  entry = {'obj_id': 'UP_%s' % name, 'name': name, 'date': date,
+           'size': 1000, 'class': 'object.item.imageItem',
+           'mime_type': 'image/jpeg', 'hash': None,
+           'path': '/backup/%s' % name, 'client_ip': None, 'stored': 1.0,
+           'duplicate': 0}
+  entry.update(values)
+  return entry
+
+
+class CatalogTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.db_file = os.path.join(self.tmp_dir, 'state', 'catalog.sqlite')
+    self.catalog = catalog.Catalog(self.db_file)
+
+  def tearDown(self):
+    self.catalog.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def testQueueAndFlush(self):
+    self.catalog.Queue('192.168.1.10', MakeEntry('SAM_0001.JPG'))
+    self.catalog.Queue('192.168.1.11', MakeEntry('SAM_0002.JPG'))
+    self.assertEqual(['192.168.1.10', '192.168.1.11'],
+                     sorted(self.catalog.GetPendingClients()))
+
+    entries = self.catalog.Flush('192.168.1.10', camera='WB150F',
+                                 session='s1')
+    self.assertEqual(1, len(entries))
+    self.assertEqual('192.168.1.10', entries[0]['client_ip'])
+    self.assertEqual('WB150F', entries[0]['camera'])
+    self.assertEqual('s1', entries[0]['session'])
+    self.assertEqual(['192.168.1.11'], self.catalog.GetPendingClients())
+    self.assertEqual([], self.catalog.Flush('192.168.1.10'))
+    self.assertEqual(0, len(self.catalog))
+
+  def testFind(self):
+    self.catalog.Add([
+        MakeEntry('SAM_0001.JPG', camera='WB150F', stored=10.0),
+        MakeEntry('SAM_0002.JPG', camera='WB150F', stored=20.0,
+                  date='2012-01-02'),
+        MakeEntry('SAM_0003.JPG', camera='ST200F', stored=30.0)])
+    self.assertEqual(3, len(self.catalog))
+
+    self.assertEqual(
+        ['SAM_0001.JPG', 'SAM_0002.JPG'],
+        [row['name'] for row in self.catalog.Find(camera='WB150F')])
+    self.assertEqual(
+        ['SAM_0002.JPG', 'SAM_0003.JPG'],
+        [row['name'] for row in self.catalog.Find(since=20.0)])
+    self.assertEqual(
+        ['SAM_0002.JPG'],
+        [row['name'] for row in self.catalog.Find(since=20.0, until=30.0)])
+    self.assertEqual(
+        ['SAM_0002.JPG'],
+        [row['name'] for row in self.catalog.Find(date='2012-01-02')])
+    self.assertEqual(
+        ['SAM_0001.JPG'],
+        [row['name'] for row in self.catalog.Find(limit=1)])
+
+  def testGetCameras(self):
+    self.catalog.Add([
+        MakeEntry('SAM_0001.JPG', camera='WB150F', stored=10.0),
+        MakeEntry('SAM_0002.JPG', camera='WB150F', stored=20.0),
+        MakeEntry('SAM_0003.JPG', camera='ST200F', stored=30.0)])
+    self.assertEqual(
+        [('ST200F', 1, 30.0), ('WB150F', 2, 20.0)],
+        [tuple(row) for row in self.catalog.GetCameras()])
+
+  def testCatalogIsKept(self):
+    self.catalog.Add([MakeEntry('SAM_0001.JPG', camera='WB150F')])
+    self.catalog.Close()
+
+    self.catalog = catalog.Catalog(self.db_file)
+    self.assertEqual(['WB150F'],
+                     [row['camera'] for row in self.catalog.Find()])
+
+  def testGetDates(self):
+    self.catalog.Add([
+        MakeEntry('SAM_0001.JPG', date='2012-01-01'),
+        MakeEntry('SAM_0002.JPG', date='2012-01-02'),
+        MakeEntry('SAM_0003.JPG', date='2012-01-02'),
+        MakeEntry('SAM_0004.JPG', date='2012-01-02', duplicate=1),
+        MakeEntry('SAM_0005.JPG', date=None)])
+    (rows, total) = self.catalog.GetDates(limit=2)
+    self.assertEqual(3, total)
+    self.assertEqual([('2012-01-02', 2), ('2012-01-01', 1)],
+                     [tuple(row) for row in rows])
+    self.assertEqual(1, self.catalog.GetDate('')['objects'])
+    self.assertIsNone(self.catalog.GetDate('2012-01-03'))
+
+  def testGetObject(self):
+    self.catalog.Add([MakeEntry('SAM_0001.JPG')])
+    row_id = self.catalog.GetUpdateID()
+    self.assertEqual('SAM_0001.JPG', self.catalog.GetObject(row_id)['name'])
+    self.assertIsNone(self.catalog.GetObject(row_id + 1))
+
+  def testGetObjectsOfDate(self):
+    self.catalog.Add([
+        MakeEntry('SAM_0001.JPG', date='2012-01-01'),
+        MakeEntry('SAM_0002.JPG', date=None),
+        MakeEntry('SAM_0003.JPG', date=''),
+        MakeEntry('SAM_0004.JPG', date=None, duplicate=1)])
+    self.assertEqual(
+        ['SAM_0002.JPG', 'SAM_0003.JPG'],
+        [row['name'] for row in self.catalog.GetObjectsOfDate('')])
+    self.assertEqual(self.catalog.GetDate('')['objects'],
+                     len(self.catalog.GetObjectsOfDate('')))
+    self.assertEqual(
+        ['SAM_0001.JPG'],
+        [row['name'] for row in self.catalog.GetObjectsOfDate('2012-01-01')])
+
+  def testPaging(self):
+    self.catalog.Add([MakeEntry('SAM_%04d.JPG' % i) for i in range(5)])
+    names = [row['name'] for row in self.catalog.GetObjectsOfDate(
+        '2012-01-01')]
+
+    for page in (self.catalog.GetObjectsOfDate,
+                 lambda date, offset, limit: self.catalog.Search(
+                     [], date=date, offset=offset, limit=limit)[0]):
+      # In order, out of order and again, which is read after the cursors.
+      for offsets in ((0, 2, 4), (4, 0, 2), (0, 2, 4)):
+        rows = {}
+        for offset in offsets:
+          rows[offset] = page('2012-01-01', offset=offset, limit=2)
+        self.assertEqual(
+            names, [row['name'] for offset in sorted(rows)
+                    for row in rows[offset]])
+
+    self.catalog.Add([MakeEntry('SAM_0000.JPG', date='2012-01-01',
+                                duplicate=1),
+                      MakeEntry('SAM_0005.JPG', date='2012-01-01')])
+    self.assertEqual(
+        ['SAM_0004.JPG', 'SAM_0005.JPG'],
+        [row['name'] for row in self.catalog.GetObjectsOfDate(
+            '2012-01-01', offset=4, limit=2)])
+
+  def testSearch(self):
+    self.catalog.Add([
+        MakeEntry('SAM_0001.JPG'),
+        MakeEntry('SAM_0002.MP4', date=None,
+                  **{'class': 'object.item.videoItem'}),
+        MakeEntry('SAM_0003.JPG', date='2012-01-02'),
+        MakeEntry('SAM_0004.JPG', duplicate=1),
+        MakeEntry('SAM_5%.JPG')])
+
+    (rows, total) = self.catalog.Search(
+        [('class', 'derivedfrom', 'object.item.imageItem')], offset=1,
+        limit=1)
+    self.assertEqual(3, total)
+    self.assertEqual(['SAM_0003.JPG'], [row['name'] for row in rows])
+
+    (rows, total) = self.catalog.Search([('name', 'contains', '5%')])
+    self.assertEqual(['SAM_5%.JPG'], [row['name'] for row in rows])
+
+    (rows, total) = self.catalog.Search([], date='')
+    self.assertEqual(['SAM_0002.MP4'], [row['name'] for row in rows])
+
+    (rows, total) = self.catalog.Search([('date', '=', '')])
+    self.assertEqual(['SAM_0002.MP4'], [row['name'] for row in rows])
+
+    (rows, total) = self.catalog.Search([('name', '!=', 'SAM_0001.JPG')],
+                                        date='2012-01-01')
+    self.assertEqual(1, total)
+    self.assertEqual(['SAM_5%.JPG'], [row['name'] for row in rows])
+
+    self.assertRaises(ValueError, self.catalog.Search,
+                      [('path', '>', '/')])
+
+  def testSearchCountIsUpdated(self):
+    self.catalog.Add([MakeEntry('SAM_0001.JPG')])
+    self.assertEqual(1, self.catalog.Search([])[1])
+    self.catalog.Add([MakeEntry('SAM_0002.JPG')])
+    self.assertEqual(2, self.catalog.Search([])[1])
+
+  def testUpgrade(self):
+    self.catalog.Close()
+    os.remove(self.db_file)
+    db = sqlite3.connect(self.db_file)
+    db.executescript(catalog.SCHEMA.replace(
+        ',\n  duplicate INTEGER NOT NULL DEFAULT 0', ''))
+    db.execute("INSERT INTO objects (obj_id, name, date, path, stored) "
+               "VALUES ('UP_1', 'SAM_0001.JPG', '2012-01-01', '/backup', 1)")
+    db.execute("INSERT INTO objects (obj_id, name, path, stored) "
+               "VALUES ('UP_2', 'SAM_0002.JPG', '/backup', 1)")
+    db.commit()
+    db.close()
+
+    self.catalog = catalog.Catalog(self.db_file)
+    self.assertEqual(0, self.catalog.Find()[0]['duplicate'])
+    self.assertEqual(1, self.catalog.GetDate('2012-01-01')['objects'])
+    self.assertEqual(['SAM_0002.JPG'],
+                     [row['name'] for row in self.catalog.GetObjectsOfDate('')])
+
+
+if __name__ == '__main__':
+  unittest.main()
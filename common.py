@@ -3,13 +3,26 @@
 
 __author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
 
+import array
 import ConfigParser
+import ctypes
+import ctypes.util
+import errno
 import logging
 import os
 import re
 import socket
+import struct
+import sys
+import threading
+import time
 import uuid
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
 CAMERA_CONFIG = {
   'default': {'desc_file': os.path.join('dlna_web_root',
                                         'samsungautobackupdesc.ini')},
@@ -44,8 +57,27 @@ WOLSupport=1\r
 ServerFlag=1\r
 '''
 
+_configs = {}
+_copy_file_range = None
+_fallocate = None
+_libc = None
+_sendfile = None
+
+FALLOC_FL_KEEP_SIZE = 1
+SIOCGIFCONF = 0x8912
+
+HTML_CODES = (('&', '&amp;'),
+              ('<', '&lt;'),
+              ('>', '&gt;'),
+              ('"', '&quot;'),
+              ("'", '&apos;'))
+HTML_SPECIAL_CHARS = re.compile(r'[&<>"\']')
+
+# Request and response bodies are cut off after this many bytes in the log.
+LOG_BODY_LIMIT = 2048
 LOG_DATE_FMT = '[%m/%d/%Y %I:%M %p]'
 LOG_FMT = '%(asctime)s %(message)s'
+
 LOG_DEFAULTS = {'level': logging.INFO,
                 'format': LOG_FMT,
                 'datefmt': LOG_DATE_FMT}
@@ -60,16 +92,28 @@ def EscapeHTML(html):
   Returns:
     A string containing escaped HTML
   """
-  html_codes = (('&', '&amp;'),
-                ('<', '&lt;'),
-                ('>', '&gt;'),
-                ('"', '&quot;'),
-                ("'", '&apos;'))
-  for old, new in html_codes:
+  # Most strings have nothing to escape, a single scan finds that out.
+  if not HTML_SPECIAL_CHARS.search(html):
+    return html
+
+  for old, new in HTML_CODES:
     html = html.replace(old, new)
-  
   return html
 
+def TruncateForLog(data, limit=LOG_BODY_LIMIT):
+  """Shorten a request or response body for logging.
+
+  Args:
+    data: A string containing the body
+    limit: An int containing the number of bytes to keep
+
+  Returns:
+    A string containing at most limit bytes of the body
+  """
+  if len(data) <= limit:
+    return data
+  return '%s... (truncated)' % data[:limit]
+
 def GenerateUUID():
   """Generate a UUID.
 
@@ -81,35 +125,396 @@ def GenerateUUID():
   return '-'.join([uuid_prefix, uuid_suffix])
 
 
-def LoadOrCreateConfig(config_file=None):
-  """Load an existing configuration or create one.
+def Preallocate(f, offset, length):
+  """Reserve disk space for part of a file without changing its size.
+
+  Uses fallocate(2) with FALLOC_FL_KEEP_SIZE, so the file's size still only
+  counts the bytes actually written to it. Where fallocate is not available
+  this does nothing.
+
+  Args:
+    f: A file object opened for writing
+    offset: An int containing the offset of the space to reserve
+    length: An int containing the number of bytes to reserve
 
   Returns:
-    ConfigParser.RawConfigParser
+    True if the space was reserved
+
+  Raises:
+    IOError: There is not enough space on the disk
   """
-  if not config_file:
-    config_file = CONFIG_FILE
+  global _fallocate
+
+  if _fallocate is None:
+    _fallocate = False
+    libc = _GetLibc()
+    if libc and hasattr(libc, 'fallocate'):
+      _fallocate = libc.fallocate
+      _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                             ctypes.c_int64]
+
+  if not _fallocate or length <= 0:
+    return False
+
+  if _fallocate(f.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+    err = ctypes.get_errno()
+    if err in (errno.ENOSPC, errno.EFBIG, errno.EDQUOT):
+      raise IOError(err, os.strerror(err), f.name)
+    # Anything else means the filesystem can't preallocate, which is fine.
+    return False
+  return True
+
+
+def _GetLibc():
+  global _libc
 
-  logger = logging.getLogger('pc_autobackup.common')
+  if _libc is None:
+    _libc = False
+    libc = ctypes.util.find_library('c')
+    if libc:
+      _libc = ctypes.CDLL(libc, use_errno=True)
+  return _libc
 
-  config = ConfigParser.RawConfigParser()
-  config.read(config_file)
 
-  if not config.has_section('AUTOBACKUP'):
-    logger.info('Creating configuration file %s', config_file)
-    config.add_section('AUTOBACKUP')
-  if not config.has_option('AUTOBACKUP', 'backup_dir'):
-    config.set('AUTOBACKUP', 'backup_dir',
+def CopyFileData(src_fd, dst_fd, length, buffer_size=1024 * 1024):
+  """Copy data from one file to another without it passing through Python.
+
+  Uses copy_file_range(2), falling back to sendfile(2) where it is missing or
+  can't copy between the two filesystems, and to plain reads and writes
+  where neither is available. Data is copied from the current position of
+  src_fd to the current position of dst_fd.
+
+  Args:
+    src_fd: An int containing the file descriptor to copy from
+    dst_fd: An int containing the file descriptor to copy to
+    length: An int containing the number of bytes to copy
+    buffer_size: An int containing the size of each read when copying with
+      reads and writes
+
+  Returns:
+    An int containing the number of bytes copied, less than length if the
+    end of src_fd was reached
+
+  Raises:
+    OSError: The data could not be read or written
+  """
+  global _copy_file_range, _sendfile
+
+  if _copy_file_range is None:
+    _copy_file_range = _sendfile = False
+    libc = _GetLibc()
+    if libc and hasattr(libc, 'copy_file_range'):
+      _copy_file_range = libc.copy_file_range
+      _copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                   ctypes.c_void_p, ctypes.c_size_t,
+                                   ctypes.c_uint]
+      _copy_file_range.restype = ctypes.c_ssize_t
+    if libc and hasattr(libc, 'sendfile'):
+      _sendfile = libc.sendfile
+      _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                            ctypes.c_size_t]
+      _sendfile.restype = ctypes.c_ssize_t
+
+  copied = 0
+  for func in (_copy_file_range, _sendfile):
+    if not func:
+      continue
+    while copied < length:
+      if func is _copy_file_range:
+        n = func(src_fd, None, dst_fd, None, length - copied, 0)
+      else:
+        n = func(dst_fd, src_fd, None, length - copied)
+      if n < 0:
+        err = ctypes.get_errno()
+        if err == errno.EINTR:
+          continue
+        if copied == 0 and err in (errno.EINVAL, errno.ENOSYS, errno.EXDEV,
+                                   errno.EOPNOTSUPP):
+          break
+        raise OSError(err, os.strerror(err))
+      if n == 0:
+        return copied
+      copied += n
+    if copied:
+      return copied
+
+  while copied < length:
+    data = os.read(src_fd, min(buffer_size, length - copied))
+    if not data:
+      break
+    os.write(dst_fd, data)
+    copied += len(data)
+  return copied
+
+
+def GetLocalAddresses():
+  """Get the IPv4 addresses of the local network interfaces.
+
+  On Linux the interfaces are asked for directly, elsewhere this falls back
+  to the addresses the host name resolves to.
+
+  Returns:
+    A frozenset of strings containing IP addresses
+  """
+  addresses = set()
+
+  if fcntl and sys.platform.startswith('linux'):
+    ifreq_size = 40 if struct.calcsize('P') == 8 else 32
+    buf = array.array('B', '\0' * ifreq_size * 128)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      ifconf = fcntl.ioctl(s.fileno(), SIOCGIFCONF,
+                           struct.pack('iL', len(buf), buf.buffer_info()[0]))
+      length = struct.unpack('iL', ifconf)[0]
+      data = buf.tostring()
+      for i in xrange(0, length, ifreq_size):
+        addresses.add(socket.inet_ntoa(data[i + 20:i + 24]))
+    except IOError:
+      pass
+    finally:
+      s.close()
+
+  if not addresses:
+    try:
+      addresses.update(socket.gethostbyname_ex(socket.gethostname())[2])
+    except socket.error:
+      pass
+
+  return frozenset(addresses)
+
+
+def GetStateDir(config):
+  """Get the directory PC Autobackup keeps its own state in.
+
+  Args:
+    config: A Config
+
+  Returns:
+    A string containing the state directory
+  """
+  state_dir = config.get('AUTOBACKUP', 'state_dir')
+  if not os.path.isdir(state_dir):
+    os.makedirs(state_dir)
+  return state_dir
+
+
+class Config(ConfigParser.RawConfigParser):
+  """A RawConfigParser which is only written when one of its values changes.
+
+  The configuration file is checked for changes at most once every
+  reload_interval seconds when an option is read, and loaded again if its
+  mtime has changed.
+  """
+
+  reload_interval = 1
+
+  def __init__(self, config_file):
+    ConfigParser.RawConfigParser.__init__(self)
+    self.logger = logging.getLogger('pc_autobackup.common')
+    self.changed = False
+    self.config_file = config_file
+    self.mtime = None
+
+    self._last_check = 0
+
+  def _GetMtime(self):
+    try:
+      return os.stat(self.config_file).st_mtime
+    except OSError:
+      return None
+
+  def add_section(self, section):
+    ConfigParser.RawConfigParser.add_section(self, section)
+    self.changed = True
+
+  def get(self, section, option):
+    self.ReloadIfChanged()
+    return ConfigParser.RawConfigParser.get(self, section, option)
+
+  def set(self, section, option, value=None):
+    if (self.has_option(section, option) and
+        ConfigParser.RawConfigParser.get(self, section, option) == value):
+      return
+    ConfigParser.RawConfigParser.set(self, section, option, value)
+    self.changed = True
+
+  def Load(self):
+    """Load the configuration file, filling in any missing defaults."""
+    for section in self.sections():
+      self.remove_section(section)
+    self.mtime = self._GetMtime()
+    self.read(self.config_file)
+    self.changed = False
+
+    if not self.has_section('AUTOBACKUP'):
+      self.logger.info('Creating configuration file %s', self.config_file)
+      self.add_section('AUTOBACKUP')
+    if not self.has_option('AUTOBACKUP', 'backup_dir'):
+      self.set('AUTOBACKUP', 'backup_dir',
                os.path.expanduser('~/PCAutoBackup'))
-  if not config.has_option('AUTOBACKUP', 'create_date_subdir'):
-    config.set('AUTOBACKUP', 'create_date_subdir', '1')
-  if not config.has_option('AUTOBACKUP', 'server_name'):
-    config.set('AUTOBACKUP', 'server_name', '[PC]AutoBackup')
-  if not config.has_option('AUTOBACKUP', 'uuid'):
-    config.set('AUTOBACKUP', 'uuid', GenerateUUID())
+    if not self.has_option('AUTOBACKUP', 'catalog'):
+      self.set('AUTOBACKUP', 'catalog', '1')
+    if not self.has_option('AUTOBACKUP', 'create_date_subdir'):
+      self.set('AUTOBACKUP', 'create_date_subdir', '1')
+    if not self.has_option('AUTOBACKUP', 'dedup'):
+      self.set('AUTOBACKUP', 'dedup', '1')
+    if not self.has_option('AUTOBACKUP', 'max_pending_objects'):
+      self.set('AUTOBACKUP', 'max_pending_objects', '10000')
+    if not self.has_option('AUTOBACKUP', 'max_sessions'):
+      self.set('AUTOBACKUP', 'max_sessions', '5')
+    if not self.has_option('AUTOBACKUP', 'min_free_space'):
+      self.set('AUTOBACKUP', 'min_free_space', '100')
+    if not self.has_option('AUTOBACKUP', 'object_journal'):
+      self.set('AUTOBACKUP', 'object_journal', '1')
+    if not self.has_option('AUTOBACKUP', 'path_template'):
+      self.set('AUTOBACKUP', 'path_template', '')
+    if not self.has_option('AUTOBACKUP', 'pending_object_ttl'):
+      self.set('AUTOBACKUP', 'pending_object_ttl', '86400')
+    if not self.has_option('AUTOBACKUP', 'postprocess'):
+      self.set('AUTOBACKUP', 'postprocess', '')
+    if not self.has_option('AUTOBACKUP', 'postprocess_processes'):
+      self.set('AUTOBACKUP', 'postprocess_processes', '2')
+    if not self.has_option('AUTOBACKUP', 'server_name'):
+      self.set('AUTOBACKUP', 'server_name', '[PC]AutoBackup')
+    if not self.has_option('AUTOBACKUP', 'session_idle_timeout'):
+      self.set('AUTOBACKUP', 'session_idle_timeout', '600')
+    if not self.has_option('AUTOBACKUP', 'state_dir'):
+      self.set('AUTOBACKUP', 'state_dir',
+               os.path.expanduser('~/.pc_autobackup'))
+    if not self.has_option('AUTOBACKUP', 'thumbnail_dir'):
+      self.set('AUTOBACKUP', 'thumbnail_dir',
+               os.path.join(self.get('AUTOBACKUP', 'state_dir'), 'thumbnails'))
+    if not self.has_option('AUTOBACKUP', 'uuid'):
+      self.set('AUTOBACKUP', 'uuid', GenerateUUID())
+    if not self.has_option('AUTOBACKUP', 'write_queue_size'):
+      self.set('AUTOBACKUP', 'write_queue_size', '4')
+    if not self.has_option('AUTOBACKUP', 'write_threads'):
+      self.set('AUTOBACKUP', 'write_threads', '4')
+
+    self.Save()
+
+  def ReloadIfChanged(self):
+    """Load the configuration file again if it changed on disk.
+
+    Returns:
+      True if the configuration was reloaded
+    """
+    now = time.time()
+    if now - self._last_check < self.reload_interval:
+      return False
+    self._last_check = now
+
+    if self._GetMtime() == self.mtime:
+      return False
+
+    self.logger.info('Reloading configuration file %s', self.config_file)
+    self.Load()
+    return True
+
+  def Save(self):
+    """Write the configuration file if anything changed.
+
+    The file is written to a temporary file first and renamed into place, so
+    an interrupted write never leaves a truncated configuration behind.
+
+    Returns:
+      True if the configuration file was written
+    """
+    if not self.changed:
+      return False
+
+    tmp_file = '%s.tmp' % self.config_file
+    with open(tmp_file, 'wb') as f:
+      self.write(f)
+    os.rename(tmp_file, self.config_file)
+
+    self.changed = False
+    self.mtime = self._GetMtime()
+    return True
+
+
+class QueueHandler(logging.Handler):
+  """A handler which puts records on a queue for a QueueListener.
+
+  Backport of logging.handlers.QueueHandler from Python 3.2. Logging only
+  costs formatting the message, the other handlers run in the listener's
+  thread.
+  """
+
+  def __init__(self, queue):
+    logging.Handler.__init__(self)
+    self.queue = queue
+
+  def emit(self, record):
+    try:
+      # Format the message now, its arguments may change or not be
+      # picklable by the time the listener gets to it.
+      msg = self.format(record)
+      record.message = msg
+      record.msg = msg
+      record.args = None
+      record.exc_info = None
+      self.queue.put_nowait(record)
+    except (KeyboardInterrupt, SystemExit):
+      raise
+    except:
+      self.handleError(record)
+
+
+class QueueListener(object):
+  """A thread which passes records from a queue to handlers.
+
+  Backport of logging.handlers.QueueListener from Python 3.2.
+  """
+
+  _sentinel = None
+
+  def __init__(self, queue, *handlers, **kwargs):
+    self.handlers = handlers
+    self.queue = queue
+    self.respect_handler_level = kwargs.get('respect_handler_level', False)
+    self._thread = None
+
+  def _Monitor(self):
+    while True:
+      record = self.queue.get()
+      if record is self._sentinel:
+        break
+      for handler in self.handlers:
+        if not self.respect_handler_level or record.levelno >= handler.level:
+          handler.handle(record)
+
+  def start(self):
+    """Start the listener thread."""
+    self._thread = threading.Thread(target=self._Monitor,
+                                    name='pc_autobackup.log')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """Stop the listener thread once the queued records are handled."""
+    if self._thread:
+      self.queue.put_nowait(self._sentinel)
+      self._thread.join()
+      self._thread = None
+
+
+def LoadOrCreateConfig(config_file=None):
+  """Load an existing configuration or create one.
+
+  The configuration is only loaded once per file, every caller shares the
+  same Config object.
+
+  Returns:
+    Config
+  """
+  if not config_file:
+    config_file = CONFIG_FILE
 
-  with open(config_file, 'wb') as file:
-    config.write(file)
+  config = _configs.get(config_file)
+  if config is None:
+    config = Config(config_file)
+    config.Load()
+    _configs[config_file] = config
 
   return config
-  
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the PC Autobackup common functions
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import common
+
+
+class ConfigTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.config_file = os.path.join(self.tmp_dir, 'pc_autobackup.cfg')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def GetConfig(self):
+    config = common.Config(self.config_file)
+    config.Load()
+    return config
+
+  def WriteConfig(self, contents):
+    with open(self.config_file, 'w') as f:
+      f.write(contents)
+    # Make sure the mtime changes, however coarse the filesystem's is.
+    mtime = time.time() + 10
+    os.utime(self.config_file, (mtime, mtime))
+
+  def testLoadCreatesConfig(self):
+    config = self.GetConfig()
+    self.assertTrue(os.path.isfile(self.config_file))
+    self.assertFalse(config.changed)
+    self.assertEqual(os.stat(self.config_file).st_mtime, config.mtime)
+    self.assertEqual('4', config.get('AUTOBACKUP', 'write_threads'))
+
+  def testLoadKeepsValues(self):
+    self.WriteConfig('[AUTOBACKUP]\nwrite_threads = 8\n')
+    config = self.GetConfig()
+    self.assertEqual('8', config.get('AUTOBACKUP', 'write_threads'))
+    # The missing defaults were filled in and written.
+    with open(self.config_file) as f:
+      self.assertIn('write_queue_size', f.read())
+
+  def testSaveOnlyWhenChanged(self):
+    config = self.GetConfig()
+    self.assertFalse(config.Save())
+
+    config.set('AUTOBACKUP', 'write_threads', '4')
+    self.assertFalse(config.changed)
+    self.assertFalse(config.Save())
+
+    config.set('AUTOBACKUP', 'write_threads', '2')
+    self.assertTrue(config.Save())
+    self.assertFalse(config.changed)
+    self.assertFalse(os.path.exists('%s.tmp' % self.config_file))
+    self.assertEqual('2', self.GetConfig().get('AUTOBACKUP', 'write_threads'))
+
+  def testReloadIfChanged(self):
+    config = self.GetConfig()
+    config._last_check = time.time()
+    self.assertFalse(config.ReloadIfChanged())
+
+    # Changes are only looked for once every reload_interval.
+    self.WriteConfig('[AUTOBACKUP]\nwrite_threads = 8\n')
+    self.assertFalse(config.ReloadIfChanged())
+    self.assertEqual('4', config.get('AUTOBACKUP', 'write_threads'))
+
+    config._last_check = 0
+    self.assertEqual('8', config.get('AUTOBACKUP', 'write_threads'))
+    self.assertEqual(os.stat(self.config_file).st_mtime, config.mtime)
+    config._last_check = 0
+    self.assertFalse(config.ReloadIfChanged())
+
+  def testLoadOrCreateConfigIsShared(self):
+    config = common.LoadOrCreateConfig(self.config_file)
+    self.assertIs(config, common.LoadOrCreateConfig(self.config_file))
+
+
+if __name__ == '__main__':
+  unittest.main()
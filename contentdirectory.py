@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# ContentDirectory Browse and Search for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import logging
+import re
+import xml.etree.cElementTree as ElementTree
+
+import common
+
+ROOT_ID = '0'
+DATE_ID = 'D_%s'
+OBJECT_ID = 'I_%d'
+
+# The most objects returned by one Browse or Search, however many were asked
+# for. Clients page through the rest with StartingIndex.
+MAX_REQUESTED_COUNT = 500
+
+SEARCH_CAPABILITIES = 'dc:date,dc:title,upnp:class'
+SEARCH_PROPERTIES = {'dc:date': 'date',
+                     'dc:title': 'name',
+                     'upnp:class': 'class'}
+SEARCH_TOKEN = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+
+UPNP_ERROR_INVALID_ACTION = 401
+UPNP_ERROR_INVALID_ARGS = 402
+UPNP_ERROR_NO_SUCH_OBJECT = 701
+UPNP_ERROR_INVALID_SEARCH_CRITERIA = 708
+UPNP_ERROR_NO_SUCH_CONTAINER = 710
+
+DIDL_HEADER = ('<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" '
+               'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+               'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/">')
+DIDL_FOOTER = '</DIDL-Lite>'
+DIDL_CONTAINER = ('<container id="%(id)s" parentID="%(parent_id)s" '
+                  'restricted="1" childCount="%(child_count)d">'
+                  '<dc:title>%(title)s</dc:title>'
+                  '<upnp:class>object.container</upnp:class></container>')
+DIDL_ITEM = ('<item id="%(id)s" parentID="%(parent_id)s" restricted="1">'
+             '<dc:title>%(title)s</dc:title>%(date)s'
+             '<upnp:class>%(class)s</upnp:class>'
+             '<res protocolInfo="http-get:*:%(mime_type)s:*" size="%(size)d">'
+             '%(url)s</res></item>')
+
+RESPONSE = '''<?xml version="1.0"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+  <s:Body>
+    <u:%(action)sResponse xmlns:u="urn:schemas-upnp-org:service:ContentDirectory:1">
+%(args)s
+    </u:%(action)sResponse>
+  </s:Body>
+</s:Envelope>'''
+
+
+class UPnPError(Exception):
+  """An action failed and the client should get a SOAP fault."""
+
+  def __init__(self, error_code, error_description):
+    Exception.__init__(self, error_description)
+    self.error_code = error_code
+    self.error_description = error_description
+
+
+class ContentDirectory(object):
+  """Answers Browse and Search from the catalog of backed up objects.
+
+  The root container holds a container for each date objects were taken on,
+  newest first, and each of those holds the objects of that date in the
+  order they were backed up. Only the page of objects asked for is read from
+  the catalog and turned into DIDL, and the catalog keeps the number of
+  objects of each date, so a page costs the same however large the archive
+  is.
+
+  Methods query the catalog, so they should be called off the reactor.
+  """
+
+  def __init__(self, catalog):
+    self.logger = logging.getLogger('pc_autobackup.contentdirectory')
+    self.catalog = catalog
+
+    self.actions = {'Browse': self.Browse,
+                    'GetSearchCapabilities': self.GetSearchCapabilities,
+                    'GetSortCapabilities': self.GetSortCapabilities,
+                    'GetSystemUpdateID': self.GetSystemUpdateID,
+                    'Search': self.Search}
+
+  def _DateContainer(self, row):
+    return DIDL_CONTAINER % {'child_count': row['objects'],
+                             'id': common.EscapeHTML(DATE_ID % row['date']),
+                             'parent_id': ROOT_ID,
+                             'title': common.EscapeHTML(row['date'] or
+                                                        'Unknown date')}
+
+  def _Item(self, row, content_url):
+    date = ''
+    if row['date']:
+      date = '<dc:date>%s</dc:date>' % common.EscapeHTML(row['date'])
+    return DIDL_ITEM % {
+        'class': common.EscapeHTML(row['class'] or 'object.item'),
+        'date': date,
+        'id': OBJECT_ID % row['id'],
+        'mime_type': common.EscapeHTML(row['mime_type'] or '*'),
+        'parent_id': common.EscapeHTML(DATE_ID % (row['date'] or '')),
+        'size': row['size'] or 0,
+        'title': common.EscapeHTML(row['name']),
+        'url': common.EscapeHTML(content_url % row['id'])}
+
+  def _Result(self, didl, total):
+    return [('Result', common.EscapeHTML(
+                DIDL_HEADER + ''.join(didl) + DIDL_FOOTER)),
+            ('NumberReturned', len(didl)),
+            ('TotalMatches', total),
+            ('UpdateID', self.catalog.GetUpdateID())]
+
+  def _RootContainer(self):
+    (_, total) = self.catalog.GetDates(limit=0)
+    return DIDL_CONTAINER % {'child_count': total,
+                             'id': ROOT_ID,
+                             'parent_id': '-1',
+                             'title': 'PC Autobackup'}
+
+  def Browse(self, args, content_url):
+    """Browse a container or get the metadata of an object.
+
+    Args:
+      args: A dict containing the action's arguments
+      content_url: A string containing the URL objects are served at, with
+        %d in place of the object's id
+
+    Returns:
+      A list of tuples of the name and value of each output argument
+
+    Raises:
+      UPnPError: The object does not exist or the arguments are invalid
+    """
+    object_id = args.get('ObjectID', '')
+    browse_flag = args.get('BrowseFlag')
+    (offset, limit) = GetPage(args)
+
+    if browse_flag == 'BrowseMetadata':
+      if object_id == ROOT_ID:
+        return self._Result([self._RootContainer()], 1)
+
+      date = ParseDateID(object_id)
+      if date is not None:
+        row = self.catalog.GetDate(date)
+        if row:
+          return self._Result([self._DateContainer(row)], 1)
+
+      row_id = ParseObjectID(object_id)
+      if row_id is not None:
+        row = self.catalog.GetObject(row_id)
+        if row and not row['duplicate']:
+          return self._Result([self._Item(row, content_url)], 1)
+
+      raise UPnPError(UPNP_ERROR_NO_SUCH_OBJECT, 'No such object')
+
+    if browse_flag != 'BrowseDirectChildren':
+      raise UPnPError(UPNP_ERROR_INVALID_ARGS,
+                      'Invalid BrowseFlag: %s' % browse_flag)
+
+    if object_id == ROOT_ID:
+      (rows, total) = self.catalog.GetDates(offset=offset, limit=limit)
+      return self._Result([self._DateContainer(row) for row in rows], total)
+
+    date = ParseDateID(object_id)
+    container = date is not None and self.catalog.GetDate(date)
+    if not container:
+      raise UPnPError(UPNP_ERROR_NO_SUCH_CONTAINER, 'No such container')
+    rows = self.catalog.GetObjectsOfDate(date, offset=offset, limit=limit)
+    return self._Result([self._Item(row, content_url) for row in rows],
+                        container['objects'])
+
+  def Call(self, action, args, content_url):
+    """Run an action.
+
+    Args:
+      action: A string containing the name of the action
+      args: A dict containing the action's arguments
+      content_url: A string containing the URL objects are served at, with
+        %d in place of the object's id
+
+    Returns:
+      A string containing the response XML
+
+    Raises:
+      UPnPError: The action failed
+    """
+    if action not in self.actions:
+      raise UPnPError(UPNP_ERROR_INVALID_ACTION, 'Invalid action')
+    return GetResponse(action, self.actions[action](args, content_url))
+
+  def GetSearchCapabilities(self, args, content_url):
+    return [('SearchCaps', SEARCH_CAPABILITIES)]
+
+  def GetSortCapabilities(self, args, content_url):
+    return [('SortCaps', '')]
+
+  def GetSystemUpdateID(self, args, content_url):
+    return [('Id', self.catalog.GetUpdateID())]
+
+  def Search(self, args, content_url):
+    """Search for objects in a container.
+
+    Args:
+      args: A dict containing the action's arguments
+      content_url: A string containing the URL objects are served at, with
+        %d in place of the object's id
+
+    Returns:
+      A list of tuples of the name and value of each output argument
+
+    Raises:
+      UPnPError: The container does not exist or the arguments are invalid
+    """
+    container_id = args.get('ContainerID', '')
+    (offset, limit) = GetPage(args)
+
+    date = None
+    if container_id != ROOT_ID:
+      date = ParseDateID(container_id)
+      if date is None or not self.catalog.GetDate(date):
+        raise UPnPError(UPNP_ERROR_NO_SUCH_CONTAINER, 'No such container')
+
+    criteria = ParseSearchCriteria(args.get('SearchCriteria') or '*')
+    if criteria is None:
+      return self._Result([], 0)
+
+    try:
+      (rows, total) = self.catalog.Search(criteria, date=date, offset=offset,
+                                          limit=limit)
+    except ValueError as e:
+      raise UPnPError(UPNP_ERROR_INVALID_SEARCH_CRITERIA, str(e))
+    return self._Result([self._Item(row, content_url) for row in rows], total)
+
+
+def GetPage(args):
+  """Get the page of results asked for by Browse or Search.
+
+  Args:
+    args: A dict containing the action's arguments
+
+  Returns:
+    A tuple of an int containing the offset of the first result and an int
+    containing the maximum number of results
+
+  Raises:
+    UPnPError: StartingIndex or RequestedCount is not a positive number
+  """
+  try:
+    offset = int(args.get('StartingIndex') or 0)
+    limit = int(args.get('RequestedCount') or 0)
+  except ValueError:
+    raise UPnPError(UPNP_ERROR_INVALID_ARGS, 'Invalid StartingIndex or '
+                    'RequestedCount')
+  if offset < 0 or limit < 0:
+    raise UPnPError(UPNP_ERROR_INVALID_ARGS, 'Invalid StartingIndex or '
+                    'RequestedCount')
+
+  # A RequestedCount of 0 asks for everything.
+  if not limit or limit > MAX_REQUESTED_COUNT:
+    limit = MAX_REQUESTED_COUNT
+  return (offset, limit)
+
+
+def GetResponse(action, args):
+  """Generate the response XML of an action.
+
+  Args:
+    action: A string containing the name of the action
+    args: A list of tuples of the name and value of each output argument,
+      values must already be escaped
+
+  Returns:
+    A string containing the XML contents
+  """
+  return RESPONSE % {'action': action,
+                     'args': '\n'.join('      <%s>%s</%s>' % (k, v, k)
+                                       for k, v in args)}
+
+
+def ParseArguments(soap_xml):
+  """Parse the arguments of a SOAP action.
+
+  Args:
+    soap_xml: A string containing the SOAP request
+
+  Returns:
+    A dict containing the text of each argument
+
+  Raises:
+    UPnPError: The request can't be parsed
+  """
+  try:
+    envelope = ElementTree.fromstring(soap_xml)
+  except SyntaxError:
+    raise UPnPError(UPNP_ERROR_INVALID_ARGS, 'Invalid SOAP request')
+
+  body = envelope.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')
+  if body is None or not len(body):
+    raise UPnPError(UPNP_ERROR_INVALID_ARGS, 'Invalid SOAP request')
+  return dict((arg.tag.split('}')[-1], arg.text or '') for arg in body[0])
+
+
+def ParseDateID(object_id):
+  """Get the date of a date container.
+
+  Args:
+    object_id: A string containing an object id
+
+  Returns:
+    A string containing the date, or None if object_id is not a date
+    container
+  """
+  if object_id.startswith(DATE_ID % ''):
+    return object_id[len(DATE_ID % ''):]
+  return None
+
+
+def ParseObjectID(object_id):
+  """Get the catalog id of an object.
+
+  Args:
+    object_id: A string containing an object id
+
+  Returns:
+    An int containing the object's id in the catalog, or None if object_id
+    is not an object
+  """
+  if object_id.startswith(OBJECT_ID[:2]) and object_id[2:].isdigit():
+    return int(object_id[2:])
+  return None
+
+
+def ParseSearchCriteria(search_criteria):
+  """Parse the SearchCriteria of a Search.
+
+  Only * and comparisons of SEARCH_PROPERTIES joined by 'and' are supported,
+  which is what TVs and media players send, e.g.
+
+    upnp:class derivedfrom "object.item.imageItem" and @refID exists false
+
+  Args:
+    search_criteria: A string containing the SearchCriteria argument
+
+  Returns:
+    A list of tuples of a catalog column, operator and value, or None if
+    nothing can match
+
+  Raises:
+    UPnPError: The criteria are not supported
+  """
+  tokens = [t for t in SEARCH_TOKEN.findall(search_criteria)
+            if t not in ('(', ')')]
+  if tokens == ['*']:
+    return []
+
+  criteria = []
+  while tokens:
+    if len(tokens) < 3:
+      raise UPnPError(UPNP_ERROR_INVALID_SEARCH_CRITERIA,
+                      'Invalid SearchCriteria: %s' % search_criteria)
+    (prop, op, value) = tokens[:3]
+    tokens = tokens[3:]
+    if tokens:
+      if tokens[0].lower() != 'and':
+        raise UPnPError(UPNP_ERROR_INVALID_SEARCH_CRITERIA,
+                        'Unsupported SearchCriteria: %s' % search_criteria)
+      tokens = tokens[1:]
+
+    op = op.lower()
+    if op == 'exists':
+      # Every object has the searchable properties and none of the others.
+      if (prop in SEARCH_PROPERTIES) != (value.lower() == 'true'):
+        return None
+      continue
+
+    if prop not in SEARCH_PROPERTIES or not value.startswith('"'):
+      raise UPnPError(UPNP_ERROR_INVALID_SEARCH_CRITERIA,
+                      'Unsupported SearchCriteria: %s' % search_criteria)
+    value = re.sub(r'\\(.)', r'\1', value[1:-1])
+    criteria.append((SEARCH_PROPERTIES[prop], op, value))
+  return criteria
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the ContentDirectory Browse and Search
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import unittest
+
+import contentdirectory
+
+
+class ParseSearchCriteriaTest(unittest.TestCase):
+
+  def assertUnsupported(self, search_criteria):
+    try:
+      contentdirectory.ParseSearchCriteria(search_criteria)
+    except contentdirectory.UPnPError as e:
+      self.assertEqual(contentdirectory.UPNP_ERROR_INVALID_SEARCH_CRITERIA,
+                       e.error_code)
+    else:
+      self.fail('%s was parsed' % search_criteria)
+
+  def testAll(self):
+    self.assertEqual([], contentdirectory.ParseSearchCriteria('*'))
+    self.assertEqual([], contentdirectory.ParseSearchCriteria(' ( * ) '))
+
+  def testAnd(self):
+    self.assertEqual(
+        [('class', 'derivedfrom', 'object.item.imageItem'),
+         ('date', '>=', '2013-01-01')],
+        contentdirectory.ParseSearchCriteria(
+            '(upnp:class DerivedFrom "object.item.imageItem") AND '
+            '(dc:date >= "2013-01-01")'))
+
+  def testEscapedQuotes(self):
+    self.assertEqual(
+        [('name', 'contains', 'a "b" (c)')],
+        contentdirectory.ParseSearchCriteria(
+            r'dc:title contains "a \"b\" (c)"'))
+
+  def testExists(self):
+    self.assertEqual(
+        [('class', 'derivedfrom', 'object.item.imageItem')],
+        contentdirectory.ParseSearchCriteria(
+            'upnp:class derivedfrom "object.item.imageItem" and '
+            '@refID exists false and dc:date exists true'))
+
+  def testNothingMatches(self):
+    self.assertIsNone(
+        contentdirectory.ParseSearchCriteria('@refID exists true'))
+    self.assertIsNone(contentdirectory.ParseSearchCriteria(
+        'dc:title = "SAM_0001.JPG" and dc:title exists false'))
+
+  def testUnsupported(self):
+    self.assertUnsupported('dc:title = "a" or dc:title = "b"')
+    self.assertUnsupported('dc:creator = "Samsung"')
+    self.assertUnsupported('dc:title = SAM_0001.JPG')
+    self.assertUnsupported('dc:title =')
+
+
+if __name__ == '__main__':
+  unittest.main()
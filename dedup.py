@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Index of backed up objects for PC Autobackup deduplication
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import anydbm
+import hashlib
+import logging
+import threading
+
+HASH = hashlib.sha1
+
+
+class DedupIndex(object):
+  """An on-disk index of objects which have already been backed up.
+
+  Objects are indexed twice: by the name, date and size a camera announces
+  in CreateObject, and by a hash of their content. Both map to the path of
+  the file holding the object.
+
+  The index is safe to use from any thread. Once it is closed nothing is
+  found in it and nothing can be added.
+  """
+
+  def __init__(self, index_file):
+    self.logger = logging.getLogger('pc_autobackup.dedup')
+    self.index_file = index_file
+    self._db = anydbm.open(index_file, 'c')
+    self._lock = threading.Lock()
+
+  def _Encode(self, value):
+    if isinstance(value, unicode):
+      return value.encode('utf-8')
+    return str(value)
+
+  def _Get(self, key):
+    with self._lock:
+      if self._db is None:
+        return None
+      # Not every dbm implementation has get().
+      try:
+        return self._db[key]
+      except KeyError:
+        return None
+
+  def _Key(self, obj_name, obj_date, obj_size):
+    return '\0'.join(['k', self._Encode(obj_name), self._Encode(obj_date),
+                      self._Encode(obj_size)])
+
+  def Add(self, obj_name, obj_date, obj_size, obj_hash, obj_file):
+    """Record a backed up object.
+
+    Args:
+      obj_name: A string containing the object name
+      obj_date: A string containing the object date
+      obj_size: A string containing the object size
+      obj_hash: A string containing the hex digest of the object's content
+      obj_file: A string containing the path the object is saved at
+
+    Raises:
+      IOError: The index is closed
+    """
+    obj_file = self._Encode(obj_file)
+    with self._lock:
+      if self._db is None:
+        raise IOError('%s is closed' % self.index_file)
+      self._db[self._Key(obj_name, obj_date, obj_size)] = obj_file
+      self._db['h\0%s' % obj_hash] = obj_file
+
+  def Close(self):
+    """Close the index."""
+    with self._lock:
+      if self._db is not None:
+        self._db.close()
+        self._db = None
+
+  def Find(self, obj_name, obj_date, obj_size):
+    """Find a backed up object by the details a camera announces.
+
+    Args:
+      obj_name: A string containing the object name
+      obj_date: A string containing the object date
+      obj_size: A string containing the object size
+
+    Returns:
+      A string containing the path of the object or None
+    """
+    return self._Get(self._Key(obj_name, obj_date, obj_size))
+
+  def FindHash(self, obj_hash):
+    """Find a backed up object by its content.
+
+    Args:
+      obj_hash: A string containing the hex digest of the object's content
+
+    Returns:
+      A string containing the path of the object or None
+    """
+    return self._Get('h\0%s' % obj_hash)
+
+  def Sync(self):
+    """Write the changes made to the index to disk."""
+    with self._lock:
+      # Not every dbm implementation has sync() either.
+      if self._db is not None and hasattr(self._db, 'sync'):
+        self._db.sync()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the deduplication index
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dedup
+
+
+class DedupIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.index_file = os.path.join(self.tmp_dir, 'dedup')
+    self.index = dedup.DedupIndex(self.index_file)
+
+  def tearDown(self):
+    self.index.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def testFind(self):
+    self.index.Add(u'SAM_\xe9.JPG', '2012-01-01', '1000', 'abc',
+                   u'/backup/SAM_\xe9.JPG')
+    self.assertEqual('/backup/SAM_\xc3\xa9.JPG',
+                     self.index.Find(u'SAM_\xe9.JPG', '2012-01-01', '1000'))
+    self.assertEqual('/backup/SAM_\xc3\xa9.JPG', self.index.FindHash('abc'))
+    self.assertIsNone(self.index.Find(u'SAM_\xe9.JPG', '2012-01-01', '1001'))
+    self.assertIsNone(self.index.FindHash('abd'))
+
+  def testSizeIsAString(self):
+    self.index.Add('SAM_0001.JPG', '2012-01-01', 1000, 'abc',
+                   '/backup/SAM_0001.JPG')
+    self.assertEqual('/backup/SAM_0001.JPG',
+                     self.index.Find('SAM_0001.JPG', '2012-01-01', '1000'))
+
+  def testIndexIsKept(self):
+    self.index.Add('SAM_0001.JPG', '2012-01-01', '1000', 'abc',
+                   '/backup/SAM_0001.JPG')
+    self.index.Sync()
+    self.index.Close()
+
+    self.index = dedup.DedupIndex(self.index_file)
+    self.assertEqual('/backup/SAM_0001.JPG', self.index.FindHash('abc'))
+
+  def testClosed(self):
+    self.index.Add('SAM_0001.JPG', '2012-01-01', '1000', 'abc',
+                   '/backup/SAM_0001.JPG')
+    self.index.Close()
+    self.index.Close()
+    self.index.Sync()
+    self.assertIsNone(self.index.FindHash('abc'))
+    self.assertRaises(IOError, self.index.Add, 'SAM_0002.JPG', '2012-01-01',
+                      '1000', 'abd', '/backup/SAM_0002.JPG')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# EXIF capture date parsing for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import struct
+import time
+
+EXIF_HEADER = 'Exif\0\0'
+EXIF_DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+# EXIF has to be in the first segment after the start of image, and a
+# segment can be at most 64 KB.
+MAX_HEADER_BYTES = 64 * 1024 + 16
+READ_SIZE = 4096
+
+JPEG_SOI = '\xff\xd8'
+JPEG_APP1 = 0xe1
+JPEG_EOI = 0xd9
+JPEG_SOS = 0xda
+
+TAG_DATE_TIME = 0x0132
+TAG_DATE_TIME_DIGITIZED = 0x9004
+TAG_DATE_TIME_ORIGINAL = 0x9003
+TAG_EXIF_IFD = 0x8769
+TAG_MODEL = 0x0110
+TYPE_ASCII = 2
+
+
+class NeedMoreData(Exception):
+  """The data ends before the capture date could be found."""
+
+
+class ExifError(Exception):
+  """The EXIF data is corrupt."""
+
+
+class TIFFReader(object):
+  """Reads the TIFF structure inside an EXIF segment."""
+
+  def __init__(self, data, start, end):
+    self.data = data
+    self.end = end
+    self.start = start
+
+    order = self.Read(0, 2)
+    if order == 'II':
+      self.byte_order = '<'
+    elif order == 'MM':
+      self.byte_order = '>'
+    else:
+      raise ExifError('Unknown byte order %r' % order)
+    if self.Unpack(2, 'H') != 42:
+      raise ExifError('Not a TIFF header')
+
+  def GetTags(self, ifd_offset, tags):
+    """Get the values of tags in an IFD.
+
+    Args:
+      ifd_offset: An int containing the offset of the IFD
+      tags: A list of ints containing the tags to get
+
+    Returns:
+      A dict containing the raw value of each tag found, an int for offsets
+      and a string for ASCII values
+    """
+    values = {}
+    entries = self.Unpack(ifd_offset, 'H')
+    for i in xrange(entries):
+      entry = ifd_offset + 2 + i * 12
+      tag = self.Unpack(entry, 'H')
+      if tag not in tags:
+        continue
+      (value_type, count) = struct.unpack(self.byte_order + 'HI',
+                                          self.Read(entry + 2, 6))
+      if value_type == TYPE_ASCII:
+        if count > 4:
+          value = self.Read(self.Unpack(entry + 8, 'I'), count)
+        else:
+          value = self.Read(entry + 8, count)
+        values[tag] = value.rstrip('\0 ')
+      else:
+        values[tag] = self.Unpack(entry + 8, 'I')
+    return values
+
+  def Read(self, offset, length):
+    """Read bytes of the TIFF structure.
+
+    Args:
+      offset: An int containing the offset from the TIFF header
+      length: An int containing the number of bytes
+
+    Returns:
+      A string
+
+    Raises:
+      ExifError: The bytes are outside the EXIF segment
+      NeedMoreData: The bytes have not been read yet
+    """
+    start = self.start + offset
+    if offset < 0 or start + length > self.end:
+      raise ExifError('Offset %d is outside the EXIF segment' % offset)
+    if start + length > len(self.data):
+      raise NeedMoreData()
+    return self.data[start:start + length]
+
+  def Unpack(self, offset, fmt):
+    """Read a number from the TIFF structure.
+
+    Args:
+      offset: An int containing the offset from the TIFF header
+      fmt: A struct format character, H or I
+
+    Returns:
+      An int
+    """
+    fmt = self.byte_order + fmt
+    return struct.unpack(fmt, self.Read(offset, struct.calcsize(fmt)))[0]
+
+
+def ParseDateTimeOriginal(data):
+  """Find when a JPEG was taken.
+
+  The DateTimeOriginal tag is used, or DateTimeDigitized or DateTime if it
+  is missing or invalid.
+
+  Args:
+    data: A string containing the start of a JPEG file
+
+  Returns:
+    A time.struct_time, or None if the data is not a JPEG with a valid
+    capture date
+
+  Raises:
+    NeedMoreData: More of the file is needed to find the capture date
+  """
+  return ParseExif(data)[0]
+
+
+def ParseExif(data):
+  """Find when and with which camera a JPEG was taken.
+
+  The capture date is found as by ParseDateTimeOriginal, the camera from the
+  Model tag.
+
+  Args:
+    data: A string containing the start of a JPEG file
+
+  Returns:
+    A tuple of a time.struct_time and a string containing the camera model,
+    either of which is None if the data does not have it
+
+  Raises:
+    NeedMoreData: More of the file is needed to find the capture date
+  """
+  if len(data) < 2:
+    raise NeedMoreData()
+  if not data.startswith(JPEG_SOI):
+    return (None, None)
+
+  pos = len(JPEG_SOI)
+  while True:
+    if len(data) < pos + 4:
+      raise NeedMoreData()
+    if data[pos] != '\xff':
+      return (None, None)
+    marker = ord(data[pos + 1])
+    if marker == 0xff:
+      # Fill byte
+      pos += 1
+      continue
+    if marker in (JPEG_EOI, JPEG_SOS):
+      return (None, None)
+    length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    if marker == JPEG_APP1:
+      if len(data) < pos + 4 + len(EXIF_HEADER):
+        raise NeedMoreData()
+      if data[pos + 4:pos + 4 + len(EXIF_HEADER)] == EXIF_HEADER:
+        try:
+          return _ParseTIFF(data, pos + 4 + len(EXIF_HEADER), pos + 2 + length)
+        except ExifError:
+          return (None, None)
+    pos += 2 + length
+
+
+def _ParseTIFF(data, start, end):
+  tiff = TIFFReader(data, start, end)
+  ifd0 = tiff.GetTags(tiff.Unpack(4, 'I'),
+                      (TAG_DATE_TIME, TAG_EXIF_IFD, TAG_MODEL))
+  exif_ifd = {}
+  if TAG_EXIF_IFD in ifd0:
+    exif_ifd = tiff.GetTags(ifd0[TAG_EXIF_IFD],
+                            (TAG_DATE_TIME_ORIGINAL, TAG_DATE_TIME_DIGITIZED))
+
+  model = ifd0.get(TAG_MODEL)
+  if not isinstance(model, str) or not model:
+    model = None
+
+  for value in (exif_ifd.get(TAG_DATE_TIME_ORIGINAL),
+                exif_ifd.get(TAG_DATE_TIME_DIGITIZED),
+                ifd0.get(TAG_DATE_TIME)):
+    if not isinstance(value, str):
+      continue
+    try:
+      return (time.strptime(value[:19], EXIF_DATE_FORMAT), model)
+    except ValueError:
+      # Cameras without a clock write 0000:00:00 00:00:00
+      continue
+  return (None, model)
+
+
+def ReadDateTimeOriginal(path):
+  """Find when a JPEG file was taken.
+
+  Only as much of the file as is needed is read.
+
+  Args:
+    path: A string containing the path to the file
+
+  Returns:
+    A time.struct_time, or None if the file is not a JPEG with a valid
+    capture date
+  """
+  return ReadExif(path)[0]
+
+
+def ReadExif(path):
+  """Find when and with which camera a JPEG file was taken.
+
+  Only as much of the file as is needed is read.
+
+  Args:
+    path: A string containing the path to the file
+
+  Returns:
+    A tuple of a time.struct_time and a string containing the camera model,
+    either of which is None if the file does not have it
+  """
+  data = ''
+  with open(path, 'rb') as f:
+    while len(data) < MAX_HEADER_BYTES:
+      chunk = f.read(READ_SIZE)
+      if not chunk:
+        return (None, None)
+      data += chunk
+      try:
+        return ParseExif(data)
+      except NeedMoreData:
+        continue
+  return (None, None)
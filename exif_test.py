@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the EXIF capture date parsing
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+
+import exif
+
+DATE = '2013:01:02 03:04:05'
+TAKEN = time.strptime(DATE, exif.EXIF_DATE_FORMAT)
+TAG_ARTIST = 0x013b
+
+
+def MakeIFD(offset, tags, byte_order):
+  """Make a TIFF IFD followed by the values which do not fit in it.
+
+  Args:
+    offset: An int containing the offset the IFD will be at
+    tags: A dict of tag to an int, or a string for an ASCII value
+    byte_order: A struct byte order, < or >
+
+  Returns:
+    A string
+  """
+  data_offset = offset + 2 + 12 * len(tags) + 4
+  ifd = struct.pack(byte_order + 'H', len(tags))
+  data = ''
+  for tag, value in sorted(tags.iteritems()):
+    if isinstance(value, str):
+      value += '\0'
+      if len(value) > 4:
+        ifd += struct.pack(byte_order + 'HHII', tag, exif.TYPE_ASCII,
+                           len(value), data_offset + len(data))
+        data += value
+      else:
+        ifd += struct.pack(byte_order + 'HHI', tag, exif.TYPE_ASCII,
+                           len(value)) + value.ljust(4, '\0')
+    else:
+      ifd += struct.pack(byte_order + 'HHII', tag, 4, 1, value)
+  return ifd + struct.pack(byte_order + 'I', 0) + data
+
+
+def MakeJPEG(ifd0=None, exif_ifd=None, byte_order='<'):
+  """Make the start of a JPEG with an EXIF segment.
+
+  Args:
+    ifd0: A dict of tags for IFD0
+    exif_ifd: A dict of tags for the EXIF IFD, which is left out if None
+    byte_order: A struct byte order, < or >
+
+  Returns:
+    A string
+  """
+  ifd0 = dict(ifd0 or {})
+  if exif_ifd is not None:
+    ifd0[exif.TAG_EXIF_IFD] = 0
+    ifd0[exif.TAG_EXIF_IFD] = 8 + len(MakeIFD(8, ifd0, byte_order))
+  tiff = (('II' if byte_order == '<' else 'MM') +
+          struct.pack(byte_order + 'HI', 42, 8) +
+          MakeIFD(8, ifd0, byte_order))
+  if exif_ifd is not None:
+    tiff += MakeIFD(len(tiff), exif_ifd, byte_order)
+  segment = exif.EXIF_HEADER + tiff
+  return (exif.JPEG_SOI +
+          '\xff\xe1' + struct.pack('>H', len(segment) + 2) + segment +
+          '\xff\xda' + struct.pack('>H', 2) + '\0' * 100)
+
+
+class ParseDateTimeOriginalTest(unittest.TestCase):
+
+  def testDateTimeOriginal(self):
+    data = MakeJPEG({exif.TAG_DATE_TIME: '2013:12:31 00:00:00'},
+                    {exif.TAG_DATE_TIME_ORIGINAL: DATE,
+                     exif.TAG_DATE_TIME_DIGITIZED: '2013:12:31 00:00:00'})
+    self.assertEqual(TAKEN, exif.ParseDateTimeOriginal(data))
+
+  def testBigEndian(self):
+    data = MakeJPEG(exif_ifd={exif.TAG_DATE_TIME_ORIGINAL: DATE},
+                    byte_order='>')
+    self.assertEqual(TAKEN, exif.ParseDateTimeOriginal(data))
+
+  def testDateTimeDigitized(self):
+    data = MakeJPEG(exif_ifd={exif.TAG_DATE_TIME_ORIGINAL:
+                                  '0000:00:00 00:00:00',
+                              exif.TAG_DATE_TIME_DIGITIZED: DATE})
+    self.assertEqual(TAKEN, exif.ParseDateTimeOriginal(data))
+
+  def testDateTime(self):
+    data = MakeJPEG({exif.TAG_DATE_TIME: DATE})
+    self.assertEqual(TAKEN, exif.ParseDateTimeOriginal(data))
+
+  def testModel(self):
+    data = MakeJPEG({exif.TAG_MODEL: 'WB150F'},
+                    {exif.TAG_DATE_TIME_ORIGINAL: DATE})
+    self.assertEqual((TAKEN, 'WB150F'), exif.ParseExif(data))
+    self.assertEqual((None, 'WB150F'),
+                     exif.ParseExif(MakeJPEG({exif.TAG_MODEL: 'WB150F'})))
+    self.assertEqual((TAKEN, None),
+                     exif.ParseExif(MakeJPEG({exif.TAG_DATE_TIME: DATE})))
+
+  def testNoDate(self):
+    data = MakeJPEG({exif.TAG_DATE_TIME: '0000:00:00 00:00:00'}, {})
+    self.assertIsNone(exif.ParseDateTimeOriginal(data))
+
+  def testSegmentBeforeExif(self):
+    jfif = 'JFIF\0\1\1\0\0\1\0\1\0\0'
+    data = MakeJPEG({exif.TAG_DATE_TIME: DATE})
+    data = (exif.JPEG_SOI + '\xff\xe0' + struct.pack('>H', len(jfif) + 2) +
+            jfif + data[len(exif.JPEG_SOI):])
+    self.assertEqual(TAKEN, exif.ParseDateTimeOriginal(data))
+
+  def testNeedMoreData(self):
+    data = MakeJPEG(exif_ifd={exif.TAG_DATE_TIME_ORIGINAL: DATE})
+    for length in (1, 4, 12, 30, data.index(DATE) + 10):
+      self.assertRaises(exif.NeedMoreData, exif.ParseDateTimeOriginal,
+                        data[:length])
+
+  def testNotJPEG(self):
+    self.assertIsNone(exif.ParseDateTimeOriginal('\0\0\0\0ftypmp42'))
+
+  def testNoExif(self):
+    data = exif.JPEG_SOI + '\xff\xda' + struct.pack('>H', 2) + '\0' * 100
+    self.assertIsNone(exif.ParseDateTimeOriginal(data))
+
+  def testOffsetOutsideSegment(self):
+    data = MakeJPEG({exif.TAG_EXIF_IFD: 5000})
+    self.assertIsNone(exif.ParseDateTimeOriginal(data))
+
+
+class ReadDateTimeOriginalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp_dir, 'SAM_0001.JPG')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def WriteFile(self, data):
+    with open(self.path, 'wb') as f:
+      f.write(data)
+
+  def testReadDateTimeOriginal(self):
+    # The date is past the first read.
+    self.WriteFile(MakeJPEG({TAG_ARTIST: 'x' * exif.READ_SIZE},
+                            {exif.TAG_DATE_TIME_ORIGINAL: DATE}))
+    self.assertEqual(TAKEN, exif.ReadDateTimeOriginal(self.path))
+
+  def testTruncatedFile(self):
+    data = MakeJPEG(exif_ifd={exif.TAG_DATE_TIME_ORIGINAL: DATE})
+    self.WriteFile(data[:data.index(DATE)])
+    self.assertIsNone(exif.ReadDateTimeOriginal(self.path))
+
+
+if __name__ == '__main__':
+  unittest.main()
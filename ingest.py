@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Offline SD card ingest for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+import time
+
+import common
+import dedup
+import exif
+import mediaserver
+
+COPY_BUFFER_SIZE = 1024 * 1024
+DCIM_DIR = 'DCIM'
+PROGRESS_INTERVAL = 5
+
+
+class CardIngest(object):
+  """Copies the objects on a camera's SD card into the backup directory.
+
+  Objects are saved where a backup over the network would have put them, and
+  objects which have already been backed up are skipped. The others are
+  copied by a pool of write_threads threads.
+
+  The data is copied by the kernel with common.CopyFileData, so the card is
+  only read once. When deduplication is on the content of each object has to
+  be hashed; the copy is hashed afterwards, while it is still in the page
+  cache, so that costs no second read of the card.
+
+  Objects which turn out to be duplicates of one already backed up are not
+  kept, and are counted in objects_duplicate rather than objects_copied.
+
+  The camera for a path_template is the camera given, or else the model in
+  the EXIF data of the card's photos.
+  """
+
+  def __init__(self, mountpoint, config_file=None, camera=None):
+    self.logger = logging.getLogger('pc_autobackup.ingest')
+    self.camera = mediaserver.GetCameraName(camera)
+    self.config = common.LoadOrCreateConfig(config_file)
+    self.mountpoint = mountpoint
+
+    self.bytes_copied = 0
+    self.errors = 0
+    self.objects_copied = 0
+    self.objects_duplicate = 0
+    self.objects_skipped = 0
+
+    self.dedup_index = None
+    if self.config.getboolean('AUTOBACKUP', 'dedup'):
+      self.dedup_index = dedup.DedupIndex(
+          os.path.join(common.GetStateDir(self.config), 'dedup'))
+
+    # Guards the dedup index and picking unused filenames.
+    self._lock = threading.Lock()
+
+  def _Copy(self, src_file, partial_file, obj_size):
+    obj_hash = None
+    src_fd = os.open(src_file, os.O_RDONLY)
+    try:
+      with open(partial_file, 'w+b') as f:
+        common.Preallocate(f, 0, obj_size)
+        common.CopyFileData(src_fd, f.fileno(), obj_size,
+                            buffer_size=COPY_BUFFER_SIZE)
+        if self.dedup_index:
+          # The copy was just written, reading it back comes from memory.
+          obj_hash = dedup.HASH()
+          f.seek(0)
+          while True:
+            data = f.read(COPY_BUFFER_SIZE)
+            if not data:
+              break
+            obj_hash.update(data)
+          obj_hash = obj_hash.hexdigest()
+        os.fsync(f.fileno())
+    finally:
+      os.close(src_fd)
+    return obj_hash
+
+  def CopyObject(self, obj):
+    """Copy an object into the backup directory.
+
+    Called in a pool thread.
+
+    Args:
+      obj: A tuple of the source path, object name, date, size and the path
+        to save it at
+
+    Returns:
+      A tuple of the object, the path it was saved at and whether it was a
+      duplicate of that already backed up path, or None if it could not be
+      copied
+    """
+    (src_file, obj_name, obj_date, obj_size, obj_file) = obj
+    obj_dir = os.path.dirname(obj_file)
+    # Objects with the same name can be copied at the same time.
+    partial_name = '%s.%d' % (obj_name, threading.current_thread().ident)
+    partial_file = os.path.join(obj_dir,
+                                mediaserver.PARTIAL_FILE % partial_name)
+    try:
+      mediaserver.MakeDirs(obj_dir)
+
+      obj_hash = self._Copy(src_file, partial_file, obj_size)
+
+      duplicate = False
+      with self._lock:
+        duplicate_of = None
+        if obj_hash:
+          duplicate_of = self.dedup_index.FindHash(obj_hash)
+        if duplicate_of and os.path.isfile(duplicate_of):
+          self.logger.info('%s is a duplicate of %s, not keeping it', src_file,
+                           duplicate_of)
+          os.remove(partial_file)
+          obj_file = duplicate_of
+          duplicate = True
+        else:
+          obj_file = mediaserver.GetUnusedFilename(obj_file)
+          os.rename(partial_file, obj_file)
+        if obj_hash:
+          self.dedup_index.Add(obj_name, obj_date, str(obj_size), obj_hash,
+                               obj_file)
+    except (IOError, OSError) as e:
+      self.logger.error('Unable to copy %s: %s', src_file, e)
+      if os.path.isfile(partial_file):
+        os.remove(partial_file)
+      return None
+
+    self.logger.debug('Copied %s to %s', src_file, obj_file)
+    return (obj, obj_file, duplicate)
+
+  def FindObjects(self):
+    """Find the objects on the card which still have to be backed up.
+
+    The EXIF data of each photo is read from the start of the file for the
+    date it was taken and the camera model.
+
+    Returns:
+      A list of tuples of the source path, object name, date, size and the
+      path to save it at
+    """
+    found = []
+    for root, dirs, files in os.walk(os.path.join(self.mountpoint, DCIM_DIR)):
+      dirs.sort()
+      for obj_name in sorted(files):
+        if obj_name.startswith('.'):
+          continue
+        src_file = os.path.join(root, obj_name)
+        stat = os.stat(src_file)
+        taken = model = None
+        try:
+          (taken, model) = exif.ReadExif(src_file)
+        except IOError as e:
+          self.logger.warning('Unable to read %s: %s', src_file, e)
+        found.append((src_file, obj_name, stat, taken, model))
+
+    # A card is written by one camera, so its videos are from the camera
+    # its photos name.
+    card_camera = self.camera or next(
+        (mediaserver.GetCameraName(model) for (_, _, _, _, model) in found
+         if model), None)
+
+    objects = []
+    for (src_file, obj_name, stat, taken, model) in found:
+      # Cameras announce the day an object was taken. Without EXIF data the
+      # file's mtime is all there is, which a copy of the card can change.
+      if taken is not None:
+        obj_date = time.strftime('%Y-%m-%d', taken)
+      else:
+        obj_date = time.strftime('%Y-%m-%d', time.localtime(stat.st_mtime))
+      camera = self.camera or mediaserver.GetCameraName(model) or card_camera
+      obj_file = mediaserver.GetObjectPath(self.config, obj_name, obj_date,
+                                           taken=taken, camera=camera)
+      if self.IsBackedUp(obj_name, obj_date, stat.st_size, obj_file):
+        self.objects_skipped += 1
+        continue
+      objects.append((src_file, obj_name, obj_date, stat.st_size, obj_file))
+    return objects
+
+  def IsBackedUp(self, obj_name, obj_date, obj_size, obj_file):
+    """Check whether an object has already been backed up.
+
+    Args:
+      obj_name: A string containing the object name
+      obj_date: A string containing the object date
+      obj_size: An int containing the object size
+      obj_file: A string containing the path the object would be saved at
+
+    Returns:
+      True if the object is already in the backup directory
+    """
+    if self.dedup_index:
+      saved_file = self.dedup_index.Find(obj_name, obj_date, str(obj_size))
+      if saved_file and os.path.isfile(saved_file):
+        return True
+
+    return os.path.isfile(obj_file) and os.path.getsize(obj_file) == obj_size
+
+  def Run(self):
+    """Copy everything on the card which is not backed up yet.
+
+    Returns:
+      True if every object was backed up
+    """
+    dcim_dir = os.path.join(self.mountpoint, DCIM_DIR)
+    if not os.path.isdir(dcim_dir):
+      self.logger.error('%s does not exist!', dcim_dir)
+      return False
+
+    objects = self.FindObjects()
+    total_size = sum(obj[3] for obj in objects)
+    self.logger.info('Ingesting %d objects (%.1f MB) from %s, %d already '
+                     'backed up', len(objects), total_size / 1048576.0,
+                     self.mountpoint, self.objects_skipped)
+
+    started = time.time()
+    last_progress = started
+    pool = ThreadPool(self.config.getint('AUTOBACKUP', 'write_threads'))
+    try:
+      for result in pool.imap_unordered(self.CopyObject, objects):
+        if not result:
+          self.errors += 1
+        elif result[2]:
+          self.bytes_copied += result[0][3]
+          self.objects_duplicate += 1
+        else:
+          self.bytes_copied += result[0][3]
+          self.objects_copied += 1
+
+        now = time.time()
+        if now - last_progress >= PROGRESS_INTERVAL:
+          last_progress = now
+          self.logger.info('%d/%d objects, %.1f/%.1f MB, %.1f MB/s',
+                           self.objects_copied + self.objects_duplicate +
+                           self.errors, len(objects),
+                           self.bytes_copied / 1048576.0,
+                           total_size / 1048576.0,
+                           self.bytes_copied / 1048576.0 / (now - started))
+    finally:
+      pool.close()
+      pool.join()
+      if self.dedup_index:
+        self.dedup_index.Close()
+
+    duration = max(time.time() - started, 0.001)
+    self.logger.info('Ingested %d objects (%.1f MB) in %.1fs, %.1f MB/s, '
+                     '%d duplicates not kept, %d errors', self.objects_copied,
+                     self.bytes_copied / 1048576.0, duration,
+                     self.bytes_copied / 1048576.0 / duration,
+                     self.objects_duplicate, self.errors)
+    return not self.errors
+
+
+def IngestCard(mountpoint, config_file=None, camera=None):
+  """Back up a camera's SD card without going through the camera.
+
+  Args:
+    mountpoint: A string containing the path to the cameras SD card
+    config_file: A string containing the path to the configuration file
+    camera: A string containing the camera model, read from the photos if
+      not given
+
+  Returns:
+    True if every object was backed up
+  """
+  return CardIngest(mountpoint, config_file, camera=camera).Run()
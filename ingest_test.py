@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the offline SD card ingest
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import exif
+import exif_test
+import ingest
+
+
+class CardIngestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.backup_dir = os.path.join(self.tmp_dir, 'backup')
+    self.card_dir = os.path.join(self.tmp_dir, 'card', ingest.DCIM_DIR,
+                                 '100PHOTO')
+    os.makedirs(self.card_dir)
+    self.config_file = os.path.join(self.tmp_dir, 'pc_autobackup.cfg')
+    self.WriteConfig()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def WriteConfig(self, options=''):
+    with open(self.config_file, 'w') as f:
+      f.write('[AUTOBACKUP]\nbackup_dir = %s\ncreate_date_subdir = 0\n'
+              'state_dir = %s\n%s' % (self.backup_dir,
+                                      os.path.join(self.tmp_dir, 'state'),
+                                      options))
+
+  def WriteObject(self, obj_name, data, mtime=None):
+    obj_file = os.path.join(self.card_dir, obj_name)
+    with open(obj_file, 'wb') as f:
+      f.write(data)
+    if mtime is not None:
+      os.utime(obj_file, (mtime, mtime))
+
+  def testCameraAndDateFromExif(self):
+    self.WriteConfig('path_template = {camera}/{date}/{name}\n')
+    mtime = time.mktime((2013, 6, 1, 12, 0, 0, 0, 0, -1))
+    self.WriteObject('SAM_0001.JPG',
+                     exif_test.MakeJPEG({exif.TAG_MODEL: 'WB150F'},
+                                        {exif.TAG_DATE_TIME_ORIGINAL:
+                                             exif_test.DATE}),
+                     mtime=mtime)
+    self.WriteObject('SAM_0002.MP4', os.urandom(1000), mtime=mtime)
+
+    card_ingest = ingest.CardIngest(os.path.join(self.tmp_dir, 'card'),
+                                    self.config_file)
+    objects = card_ingest.FindObjects()
+    self.assertEqual(
+        [('SAM_0001.JPG', '2013-01-02',
+          os.path.join(self.backup_dir, 'WB150F', '2013-01-02',
+                       'SAM_0001.JPG')),
+         ('SAM_0002.MP4', '2013-06-01',
+          os.path.join(self.backup_dir, 'WB150F', '2013-06-01',
+                       'SAM_0002.MP4'))],
+        [(obj[1], obj[2], obj[4]) for obj in objects])
+
+    card_ingest = ingest.CardIngest(os.path.join(self.tmp_dir, 'card'),
+                                    self.config_file, camera='NX1000')
+    self.assertEqual(
+        [os.path.join(self.backup_dir, 'NX1000', '2013-01-02', 'SAM_0001.JPG'),
+         os.path.join(self.backup_dir, 'NX1000', '2013-06-01',
+                      'SAM_0002.MP4')],
+        [obj[4] for obj in card_ingest.FindObjects()])
+
+  def testDuplicatesAreCountedSeparately(self):
+    photo = os.urandom(3 * ingest.COPY_BUFFER_SIZE / 2)
+    self.WriteObject('SAM_0001.JPG', photo)
+    self.WriteObject('SAM_0002.JPG', os.urandom(1000))
+    self.WriteObject('SAM_0003.JPG', photo)
+
+    card_ingest = ingest.CardIngest(os.path.join(self.tmp_dir, 'card'),
+                                    self.config_file)
+    self.assertTrue(card_ingest.Run())
+    self.assertEqual(2, card_ingest.objects_copied)
+    self.assertEqual(1, card_ingest.objects_duplicate)
+    # Either copy of the photo can be the one which is kept.
+    saved = os.listdir(self.backup_dir)
+    self.assertEqual(2, len(saved))
+    saved.remove('SAM_0002.JPG')
+    with open(os.path.join(self.backup_dir, saved[0]), 'rb') as f:
+      self.assertEqual(photo, f.read())
+
+
+if __name__ == '__main__':
+  unittest.main()
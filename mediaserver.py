@@ -5,22 +5,45 @@
 
 __author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
 
-import HTMLParser
+import collections
+import errno
+import functools
+import hashlib
 import logging
+import math
 import os
 import random
 import re
 import string
-import xml.dom.minidom
+import time
+import urlparse
+import xml.parsers.expat
 
+from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.internet import task
+from twisted.web import http
 from twisted.web.resource import Resource
+from twisted.web.server import Request
+from twisted.web.server import NOT_DONE_YET
 from twisted.web.server import Site
+from twisted.web.static import File
 
+import catalog
 import common
-
+import contentdirectory
+import dedup
+import exif
+import metrics
+import postprocess
+import profiling
+import registry
+import session
+import writepool
+
+CAMERA_MODEL = re.compile(r'\[Camera\]([^/]+)')
+CONTENT_DIRECTORY = 'urn:schemas-upnp-org:service:ContentDirectory:1'
 CREATE_OBJ = '"urn:schemas-upnp-org:service:ContentDirectory:1#CreateObject"'
-CREATE_OBJ_DIDL = re.compile(r'<Elements>(?P<didl>.*)</Elements>')
 CREATE_OBJ_RESPONSE = '''<?xml version="1.0"?>
 <s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
   <s:Body>
@@ -34,14 +57,54 @@ CREATE_OBJ_RESPONSE = '''<?xml version="1.0"?>
 CREATE_OBJ_RESPONSE_DIDL = '''<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:upnp='urn:schemas-upnp-org:metadata-1-0/upnp/' xmlns:dlna="urn:schemas-dlna-org:metadata-1-0/" xmlns:sec="http://www.sec.co.kr/">
   <item id="%(obj_id)s" parentID="%(parent_id)s" restricted="0" dlna:dlnaManaged="00000004">
     <dc:title></dc:title>
-    <res protocolInfo="http-get:*:%(obj_type)s:%(obj_subtype)s;DLNA.ORG_CI=0;DLNA.ORG_FLAGS=00D00000000000000000000000000000" importUri="http://%(interface)s:52235/cd/content?didx=0_id=%(obj_id)s" dlna:resumeUpload="0" dlna:uploadedSize="0" size="%(obj_size)s"></res>
+    <res protocolInfo="http-get:*:%(obj_type)s:%(obj_subtype)s;DLNA.ORG_CI=0;DLNA.ORG_FLAGS=00D00000000000000000000000000000" importUri="http://%(interface)s:52235/cd/content?didx=0_id=%(obj_id)s" dlna:resumeUpload="%(resume_upload)s" dlna:uploadedSize="%(uploaded_size)s" size="%(obj_size)s"></res>
     <upnp:class>%(obj_class)s</upnp:class>
   </item>
 </DIDL-Lite>'''
 
+# The DIDL is escaped once here, only the values filled in have to be escaped
+# for each response.
+CREATE_OBJ_RESPONSE_TEMPLATE = CREATE_OBJ_RESPONSE.replace(
+    '%(didl)s', common.EscapeHTML(CREATE_OBJ_RESPONSE_DIDL))
+
+DMS_DESC = 'SamsungDmsDesc.xml'
+DMS_DOCUMENTS = ('ConnectionManager1.xml', 'ContentDirectory1.xml', DMS_DESC)
+
+SOAP_FAULT = '''<?xml version="1.0"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+  <s:Body>
+    <s:Fault>
+      <faultcode>s:Client</faultcode>
+      <faultstring>UPnPError</faultstring>
+      <detail>
+        <UPnPError xmlns="urn:schemas-upnp-org:control-1-0">
+          <errorCode>%(error_code)d</errorCode>
+          <errorDescription>%(error_description)s</errorDescription>
+        </UPnPError>
+      </detail>
+    </s:Fault>
+  </s:Body>
+</s:Envelope>'''
+
+UPNP_ERROR_CANNOT_PROCESS = 720
+
 X_BACKUP_DONE = '"urn:schemas-upnp-org:service:ContentDirectory:1#X_BACKUP_DONE"'
 X_BACKUP_START = '"urn:schemas-upnp-org:service:ContentDirectory:1#X_BACKUP_START"'
 
+CONTENT_PATH = '/content/'
+CONTENT_RANGE = re.compile(r'bytes[ =](?P<start>\d+)-')
+JOURNAL_FLUSH_INTERVAL = 1
+PARTIAL_FILE = '.%s.part'
+PATH_TEMPLATE_UNKNOWN = 'Unknown'
+SESSION_EXPIRE_INTERVAL = 60
+METRICS_PATH = '/metrics'
+UPLOAD_BUFFER_SIZE = 256 * 1024
+UPLOAD_PATH = '/cd/content'
+UNSAFE_PATH_CHARS = re.compile(r'[^A-Za-z0-9_.-]+')
+
+# Directories known to exist, so they aren't checked for every object.
+_known_dirs = set()
+
 X_BACKUP_RESPONSE = '''<?xml version="1.0"?>
 <s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
   <s:Body>
@@ -52,12 +115,102 @@ X_BACKUP_RESPONSE = '''<?xml version="1.0"?>
 
 class Backup(object):
 
-  backup_objects = {}
+  backup_objects = None
+  catalog = None
+  dedup_index = None
+  postprocess_stages = None
+  postprocessor = None
+  write_pool = None
+
+  # The mtime of the configuration postprocess_stages was read from.
+  _stages_mtime = None
 
   def __init__(self, config_file=None):
     self.logger = logging.getLogger('pc_autobackup.mediaserver.backup')
     self.config = common.LoadOrCreateConfig(config_file)
 
+    if Backup.write_pool is None:
+      Backup.write_pool = writepool.WritePool(
+          self.config.getint('AUTOBACKUP', 'write_threads'))
+      metrics.WRITE_POOL_QUEUED.SetFunction(lambda: Backup.write_pool.queued)
+
+    if Backup.backup_objects is None:
+      journal_file = None
+      if self.config.getboolean('AUTOBACKUP', 'object_journal'):
+        journal_file = os.path.join(common.GetStateDir(self.config),
+                                    'objects.journal')
+      Backup.backup_objects = registry.ObjectRegistry(
+          max_objects=self.config.getint('AUTOBACKUP', 'max_pending_objects'),
+          ttl=self.config.getint('AUTOBACKUP', 'pending_object_ttl'),
+          journal_file=journal_file,
+          evict_callback=self._RemovePartialFile)
+      metrics.PENDING_OBJECTS.SetFunction(lambda: len(Backup.backup_objects))
+      if journal_file:
+        # The journal is written in the write pool, never on the reactor.
+        task.LoopingCall(self._FlushJournal).start(JOURNAL_FLUSH_INTERVAL,
+                                                   now=False)
+        reactor.addSystemEventTrigger('after', 'shutdown',
+                                      Backup.backup_objects.Close)
+
+    if (Backup.dedup_index is None and
+        self.config.getboolean('AUTOBACKUP', 'dedup')):
+      Backup.dedup_index = dedup.DedupIndex(
+          os.path.join(common.GetStateDir(self.config), 'dedup'))
+      # The index is used in the write pool, it is closed there once the
+      # work queued before the shutdown is done.
+      reactor.addSystemEventTrigger(
+          'before', 'shutdown',
+          lambda: Backup.write_pool.Submit(Backup.dedup_index.Close))
+
+    if (Backup.catalog is None and
+        self.config.getboolean('AUTOBACKUP', 'catalog')):
+      Backup.catalog = catalog.Catalog(
+          os.path.join(common.GetStateDir(self.config), 'catalog.sqlite'))
+
+    # A Backup is created for every request, the stages are only parsed
+    # again when the configuration has been reloaded. The post-processor is
+    # started with the MediaServer.
+    if (Backup.postprocess_stages is None or
+        Backup._stages_mtime != self.config.mtime):
+      Backup._stages_mtime = self.config.mtime
+      stages = postprocess.GetStages(self.config)
+      if stages != Backup.postprocess_stages:
+        Backup.postprocess_stages = stages
+        self._SetPostProcessStages(stages)
+
+  def _AddObject(self, obj_class, obj_date, obj_name, obj_size, obj_subtype,
+                 obj_type, duplicate_of=None):
+    uploaded_size = 0
+    if duplicate_of:
+      self.logger.info('%s is already backed up as %s', obj_name,
+                       duplicate_of)
+      uploaded_size = int(obj_size)
+    elif not self.HasSpaceFor(obj_size):
+      return None
+
+    (parent_id, obj_id) = self._GenerateObjectID(obj_date)
+    self.logger.debug('Creating Backup Object for %s (type:%s size:%s)',
+                      obj_name, obj_type, obj_size)
+    self.backup_objects.Add(registry.BackupObject(
+        obj_id, parent_id, obj_class, obj_date, obj_name, obj_size,
+        obj_subtype, obj_type, uploaded_size=uploaded_size,
+        duplicate_of=duplicate_of))
+    return obj_id
+
+  def _FindBackedUp(self, obj_name, obj_date, obj_size):
+    duplicate_of = self.dedup_index.Find(obj_name, obj_date, obj_size)
+    if duplicate_of and os.path.isfile(duplicate_of):
+      return duplicate_of
+    return None
+
+  def _FlushJournal(self):
+    if not self.backup_objects.unflushed:
+      return
+    self.write_pool.Submit(self.backup_objects.Flush).addErrback(
+        lambda failure: self.logger.error('Unable to write the object '
+                                          'journal: %s',
+                                          failure.getErrorMessage()))
+
   def _GenerateObjectID(self, obj_date, length=10):
     """Generate an ObjectID for a new backup item.
 
@@ -74,10 +227,52 @@ class Backup(object):
     obj_id = '%s_%s' % (parent_id, rand_chars)
     return (parent_id, obj_id)
 
+  def _RemovePartialFile(self, obj_details):
+    partial_file = os.path.join(self.GetObjectDir(obj_details),
+                                PARTIAL_FILE % obj_details.obj_id)
+
+    def Remove():
+      if os.path.isfile(partial_file):
+        os.remove(partial_file)
+
+    self.write_pool.Submit(Remove).addErrback(
+        lambda failure: self.logger.error('Unable to remove %s: %s',
+                                          partial_file,
+                                          failure.getErrorMessage()))
+
+  def _SetPostProcessStages(self, stages):
+    if not Backup.postprocessor:
+      if stages:
+        self.logger.warning('Restart the server to turn post-processing on')
+      return
+    try:
+      Backup.postprocessor.SetStages(stages)
+    except ValueError as e:
+      self.logger.error('Unable to change the post-processing stages: %s', e)
+      return
+    self.logger.info('Post-processing stages: %s',
+                     ', '.join(Backup.postprocessor.stages) or 'none')
+
+  def CloseObject(self, obj_id):
+    """Record that an ObjectWriter for an object is done with it.
+
+    Args:
+      obj_id: A string containing the object id
+    """
+    self.backup_objects.RemoveWriter(obj_id)
+
   def CreateObject(self, obj_class, obj_date, obj_name, obj_size, obj_subtype,
                    obj_type):
     """Create a new object.
 
+    If an earlier upload of the same object was interrupted, that object is
+    returned again so the upload can be resumed. Its uploaded_size detail
+    holds the number of bytes already on disk. If the object has already
+    been backed up, its duplicate_of detail holds the path it was saved at
+    and uploaded_size is the full size of the object.
+
+    No object is created if the backup directory does not have room for it.
+
     Args:
       obj_class: A string containing the objects upnp class
       obj_date: A string containing the objects date
@@ -87,23 +282,83 @@ class Backup(object):
       obj_type: A string containing the objects type
 
     Returns:
-      A string containing the created object id
+      A Deferred which fires with the created object id, or None if there is
+      not enough space for the object
     """
-    (parent_id, obj_id) = self._GenerateObjectID(obj_date)
-    self.logger.debug('Creating Backup Object for %s (type:%s size:%s)',
-                      obj_name, obj_type, obj_size)
-    self.backup_objects[obj_id] = {'obj_class': obj_class,
-                                   'obj_date': obj_date,
-                                   'obj_name': obj_name,
-                                   'obj_size': obj_size,
-                                   'obj_subtype': obj_subtype,
-                                   'obj_type': obj_type,
-                                   'parent_id': parent_id}
-    return obj_id
+    obj_details = self.backup_objects.Find(obj_name, obj_date, obj_size)
+    if obj_details:
+      if obj_details.uploaded_size is None:
+        # Loaded from the journal, see what made it to disk before the
+        # restart.
+        partial_file = os.path.join(self.GetObjectDir(obj_details),
+                                    PARTIAL_FILE % obj_details.obj_id)
+        uploaded_size = 0
+        if os.path.isfile(partial_file):
+          uploaded_size = os.path.getsize(partial_file)
+        self.backup_objects.SetUploadedSize(obj_details.obj_id, uploaded_size)
+      if obj_details.uploaded_size:
+        self.logger.info('Resuming upload of %s after %d bytes', obj_name,
+                         obj_details.uploaded_size)
+      return defer.succeed(obj_details.obj_id)
+
+    if not self.dedup_index or not obj_size:
+      return defer.succeed(self._AddObject(obj_class, obj_date, obj_name,
+                                           obj_size, obj_subtype, obj_type))
+
+    def LookupFailed(failure):
+      self.logger.error('Unable to look up %s in the dedup index: %s',
+                        obj_name, failure.getErrorMessage())
+
+    d = self.write_pool.Submit(self._FindBackedUp, obj_name, obj_date,
+                               obj_size)
+    d.addErrback(LookupFailed)
+    d.addCallback(lambda duplicate_of: self._AddObject(
+        obj_class, obj_date, obj_name, obj_size, obj_subtype, obj_type,
+        duplicate_of=duplicate_of))
+    return d
+
+  def FindDuplicate(self, obj_hash):
+    """Find an object which has already been backed up by its content.
+
+    The dedup index is read, so this is called in the write pool.
+
+    Args:
+      obj_hash: A string containing the hex digest of the object's content
+
+    Returns:
+      A string containing the path of the object or None
+    """
+    if self.dedup_index:
+      return self.dedup_index.FindHash(obj_hash)
 
   def FinishBackup(self):
     pass
 
+  def FlushCatalog(self, client_ip, camera=None, session=None):
+    """Write the objects a client has saved to the catalog.
+
+    Args:
+      client_ip: A string containing the client's IP address
+      camera: A string containing the model of the client's camera, as given
+        by GetCameraName
+      session: A string containing the id of the client's backup session
+
+    Returns:
+      A Deferred which fires once the objects are in the catalog
+    """
+    if self.catalog is None:
+      return defer.succeed(None)
+
+    entries = self.catalog.Flush(client_ip, camera=camera, session=session)
+    if not entries:
+      return defer.succeed(None)
+
+    d = self.write_pool.Submit(self.catalog.Add, entries)
+    d.addErrback(lambda failure: self.logger.error(
+        'Unable to add %d objects to the catalog: %s', len(entries),
+        failure.getErrorMessage()))
+    return d
+
   def GetObjectDetails(self, obj_id):
     """Get details about an object.
 
@@ -111,96 +366,810 @@ class Backup(object):
       obj_id: A string containing the object id
 
     Returns:
-      A dict containing the object details or None if the object does not exist
+      A registry.BackupObject or None if the object does not exist
+    """
+    return self.backup_objects.Get(obj_id)
+
+  def GetObjectDir(self, obj_details):
+    """Get the directory an object is uploaded to.
+
+    With a path_template the directory an object is saved in is not known
+    until its capture date has been read, so objects are uploaded to
+    backup_dir and moved once they are complete.
+
+    Args:
+      obj_details: A registry.BackupObject
+
+    Returns:
+      A string containing the output directory
+    """
+    if self.config.get('AUTOBACKUP', 'path_template'):
+      return self.config.get('AUTOBACKUP', 'backup_dir')
+    return GetBackupDir(self.config, obj_details.obj_date)
+
+  def OpenObject(self, obj_id, offset=0, transport=None, client=None,
+                 profile=None, camera=None, backup_session=None):
+    """Open an object for writing.
+
+    The output directory and file are created in the write pool, so this
+    never blocks on the disk. Data is written to a partial file named after
+    the object id, which is renamed once the upload is complete.
+
+    With a path_template the object's EXIF capture date is read from the
+    start of the upload as it arrives, and used for the date fields instead
+    of the date the camera sent.
+
+    Args:
+      obj_id: A string containing the object to write
+      offset: An int containing the byte offset to resume the upload at
+      transport: An optional transport feeding the object, paused while the
+        write pool is behind and dropped if the object cannot be written
+      client: A string containing the IP address of the client sending the
+        object, used to share the write pool fairly between clients
+      profile: A profiling.RequestProfile to record the disk operations in
+      camera: A string containing the model of the camera sending the object
+      backup_session: The session.BackupSession the object is sent in, kept
+        active while the object arrives
+
+    Returns:
+      An ObjectWriter for the object
+    """
+    obj_details = self.GetObjectDetails(obj_id)
+    # The object must not be forgotten, and its partial file removed, while
+    # it is being written.
+    self.backup_objects.AddWriter(obj_id)
+    obj_file = GetObjectPath(self.config, obj_details.obj_name,
+                             obj_details.obj_date, camera=camera)
+    obj_dir = os.path.dirname(obj_file)
+
+    capture_date_path = None
+    if self.config.get('AUTOBACKUP', 'path_template'):
+      capture_date_path = functools.partial(
+          GetObjectPath, self.config, obj_details.obj_name,
+          obj_details.obj_date, camera=camera)
+
+    if obj_details.duplicate_of:
+      self.logger.info('Discarding upload of %s, already saved as %s',
+                       obj_details.obj_name, obj_details.duplicate_of)
+    elif offset:
+      self.logger.info('Saving %s to %s from byte %d', obj_details.obj_name,
+                       obj_dir, offset)
+    else:
+      self.logger.info('Saving %s to %s', obj_details.obj_name, obj_dir)
+    return ObjectWriter(self, obj_id, obj_file, self.write_pool,
+                        partial_dir=self.GetObjectDir(obj_details),
+                        capture_date_path=capture_date_path,
+                        duplicate_of=obj_details.duplicate_of,
+                        obj_size=obj_details.obj_size, offset=offset,
+                        transport=transport, client=client, profile=profile,
+                        backup_session=backup_session, max_pending=self.config.getint('AUTOBACKUP',
+                                                       'write_queue_size'))
+
+  def HasSpaceFor(self, obj_size):
+    """Check whether the backup directory has room for another object.
+
+    The object has to fit next to the rest of every object which is still
+    pending, leaving min_free_space megabytes free. Space already uploaded
+    or preallocated for a pending object is gone from the free space, so
+    only the rest of it is reserved.
+
+    Args:
+      obj_size: A string containing the object size
+
+    Returns:
+      True if there is enough space for the object
+    """
+    if not hasattr(os, 'statvfs'):
+      return True
+
+    # The backup directory might not have been created yet.
+    backup_dir = os.path.abspath(self.config.get('AUTOBACKUP', 'backup_dir'))
+    while not os.path.isdir(backup_dir):
+      backup_dir = os.path.dirname(backup_dir)
+
+    stat = os.statvfs(backup_dir)
+    free_space = stat.f_bavail * stat.f_frsize
+    reserved = (self.backup_objects.pending_size +
+                self.config.getint('AUTOBACKUP', 'min_free_space') * 1024 * 1024)
+    needed = int(obj_size or 0)
+
+    if free_space - reserved < needed:
+      self.logger.error('Not enough space in %s for %s bytes (%d bytes free, '
+                        '%d bytes reserved)', backup_dir, needed, free_space,
+                        reserved)
+      return False
+    return True
+
+  def ObjectSaved(self, obj_id, obj_file, obj_hash, client=None,
+                  duplicate=False):
+    """Record that an object has been backed up.
+
+    The object is queued for the catalog until FlushCatalog is called for
+    the client.
+
+    Args:
+      obj_id: A string containing the object id
+      obj_file: A string containing the path the object is saved at
+      obj_hash: A string containing the hex digest of the object's content,
+        or None if the content was not received
+      client: A string containing the IP address of the client which sent
+        the object
+      duplicate: True if obj_file was saved from an earlier object
+    """
+    obj_details = self.GetObjectDetails(obj_id)
+    if obj_details and self.dedup_index and obj_hash:
+      self.write_pool.Submit(
+          self.dedup_index.Add, obj_details.obj_name, obj_details.obj_date,
+          obj_details.obj_size, obj_hash, obj_file).addErrback(
+              lambda failure: self.logger.error(
+                  'Unable to add %s to the dedup index: %s', obj_file,
+                  failure.getErrorMessage()))
+    if obj_details and self.catalog is not None:
+      self.catalog.Queue(client, {
+          'class': obj_details.obj_class,
+          'date': obj_details.obj_date,
+          'duplicate': int(duplicate),
+          'hash': obj_hash,
+          'mime_type': obj_details.obj_type,
+          'name': obj_details.obj_name,
+          'obj_id': obj_id,
+          'path': obj_file,
+          'size': obj_details.obj_size and int(obj_details.obj_size),
+          'stored': time.time()})
+    if obj_details and not duplicate and self.postprocessor:
+      self.postprocessor.Add(obj_file)
+    self.RemoveObject(obj_id)
+
+  def RemoveObject(self, obj_id):
+    """Forget about an object once it has been written.
+
+    Args:
+      obj_id: A string containing the object id
+    """
+    self.backup_objects.Remove(obj_id)
+
+  def SetAllocatedSize(self, obj_id, allocated_size):
+    """Record how much space has been preallocated for an object.
+
+    Args:
+      obj_id: A string containing the object id
+      allocated_size: An int containing the number of bytes allocated
+    """
+    self.backup_objects.SetAllocatedSize(obj_id, allocated_size)
+
+  def SetUploadedSize(self, obj_id, uploaded_size):
+    """Record how much of an object is on disk.
+
+    Args:
+      obj_id: A string containing the object id
+      uploaded_size: An int containing the number of bytes on disk
     """
-    return self.backup_objects.get(obj_id)
+    self.backup_objects.SetUploadedSize(obj_id, uploaded_size)
 
   def StartBackup(self):
     pass
 
-  def WriteObject(self, obj_id, data):
+  def WriteObject(self, obj_id, data, client=None, profile=None, camera=None):
     """Save an object to disk.
 
     Args:
       obj_id: A string containing the object to write
       data: The data to write to disk
+      client: A string containing the IP address of the client sending the
+        object
+      profile: A profiling.RequestProfile to record the disk operations in
+      camera: A string containing the model of the camera sending the object
+
+    Returns:
+      A Deferred which fires once the object has been written
     """
-    obj_details = self.GetObjectDetails(obj_id)
+    writer = self.OpenObject(obj_id, client=client, profile=profile,
+                             camera=camera)
+    writer.write(data)
+    return writer.Finish()
+
+
+class ObjectWriter(object):
+  """A file-like object which streams an upload into the backup directory.
+
+  Incoming chunks are collected until buffer_size bytes are pending and then
+  handed to the write pool, so memory use stays fixed no matter how large the
+  object is. Disk operations for one object run one at a time and in order.
+  When more than max_pending of them are waiting, the transport feeding the
+  object is paused until the disk catches up.
+
+  The data goes to a partial file in partial_dir, or next to obj_file if it
+  is not given. Space for the announced obj_size is reserved when it is
+  opened, so a full disk is noticed before any data is sent, and the
+  transport is dropped if that fails. Once the
+  upload is finished and exactly obj_size bytes were received the partial
+  file is synced and renamed to obj_file (or a new name, if obj_file already
+  exists). An interrupted upload leaves the partial file behind so it can be
+  resumed at offset later. The content is
+  hashed as it is written; if an object with the same hash has already been
+  backed up the partial file is removed instead. If duplicate_of is given
+  the object is known to be backed up already and the data is discarded.
+
+  If capture_date_path is given, the EXIF capture date is looked for in the
+  first chunks of the object as they arrive (or in the partial file while it
+  is hashed, for a resumed upload), and the object is saved at the path
+  capture_date_path returns for it instead of obj_file.
+
+  If a profile is given, the time each disk operation takes is recorded in
+  it. If a backup_session is given, it is kept active as data is written, so
+  a long upload doesn't make it look idle.
+  """
 
-    obj_dir = [self.config.get('AUTOBACKUP', 'backup_dir')]
+  def __init__(self, backup, obj_id, obj_file, write_pool, partial_dir=None,
+               capture_date_path=None, duplicate_of=None, obj_size=None,
+               offset=0, transport=None, client=None, profile=None,
+               backup_session=None, buffer_size=UPLOAD_BUFFER_SIZE,
+               max_pending=4):
+    self.logger = logging.getLogger('pc_autobackup.mediaserver.writer')
+    self.backup = backup
+    self.backup_session = backup_session
+    self.buffer_size = buffer_size
+    self.capture_date_path = capture_date_path
+    self.client = client
+    self.duplicate_of = duplicate_of
+    self.error = None
+    self.finished = False
+    self.max_pending = max_pending
+    self.obj_file = obj_file
+    self.obj_id = obj_id
+    self.obj_size = obj_size and int(obj_size)
+    self.offset = offset
+    self.partial_dir = partial_dir or os.path.dirname(obj_file)
+    self.partial_file = os.path.join(self.partial_dir, PARTIAL_FILE % obj_id)
+    self.profile = profile
+    self.size = 0
+    self.stored_duplicate = False
+    self.taken = None
+    self.transport = transport
+    self.write_pool = write_pool
+    self.written = offset
+
+    # Set by _Open in a pool thread, reported to the backup by _OpDone.
+    self._allocated = 0
+    self._buffer = []
+    self._buffered = 0
+    self._busy = False
+    self._closed = False
+    # The start of the object, until the capture date has been found in it.
+    self._exif_data = '' if capture_date_path else None
+    self._file = None
+    self._finish_deferreds = []
+    self._hash = dedup.HASH()
+    self._ops = collections.deque()
+    self._paused = False
+    self._released = False
+
+    if not duplicate_of:
+      self._Queue(self._Open)
+
+  def _Close(self, sync=False):
+    if self._file is not None:
+      if sync:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+      self._file.close()
+      self._file = None
+
+  def _Commit(self, obj_file):
+    if self.obj_size is not None and self.written != self.obj_size:
+      # Keep the partial file, the camera can resume from what did arrive.
+      self.logger.error('Received %d bytes of %s, expected %d', self.written,
+                        os.path.basename(self.obj_file), self.obj_size)
+      raise IOError('Incomplete upload of %s' % self.obj_file)
+
+    if self.taken is not None:
+      self.obj_file = self.capture_date_path(taken=self.taken)
+      self.logger.debug('%s was taken %s, saving it to %s',
+                        os.path.basename(self.obj_file),
+                        time.strftime('%Y-%m-%d %H:%M:%S', self.taken),
+                        os.path.dirname(self.obj_file))
+
+    store = self._Store
+    if self.profile is not None:
+      store = self.profile.Timed('store', store)
+    return self.write_pool.SubmitFor(self.client, store)
+
+  def _Next(self):
+    if self._busy or not self._ops:
+      return
+    self._busy = True
+    func, args = self._ops.popleft()
+    if self.profile is not None:
+      func = self.profile.Timed(func.__name__.strip('_').lower(), func)
+    d = self.write_pool.SubmitFor(self.client, func, *args)
+    d.addCallbacks(self._OpDone, self._OpFailed)
+
+  def _Open(self):
+    if MakeDirs(self.partial_dir):
+      self.logger.info('Creating output dir %s', self.partial_dir)
+    if self.offset:
+      if os.path.getsize(self.partial_file) < self.offset:
+        raise IOError('Cannot resume %s at byte %d, only %d bytes on disk' %
+                      (self.partial_file, self.offset,
+                       os.path.getsize(self.partial_file)))
+      self._file = open(self.partial_file, 'r+b')
+      remaining = self.offset
+      while remaining:
+        data = self._file.read(min(remaining, self.buffer_size))
+        self._hash.update(data)
+        if self._exif_data is not None:
+          self._ReadCaptureDate(data)
+        remaining -= len(data)
+      self._file.truncate(self.offset)
+      self._file.seek(self.offset)
+    else:
+      try:
+        self._file = open(self.partial_file, 'wb')
+      except IOError as e:
+        if e.errno != errno.ENOENT:
+          raise
+        # The directory was removed after it was remembered.
+        MakeDirs(self.partial_dir, refresh=True)
+        self._file = open(self.partial_file, 'wb')
+    if self.obj_size and common.Preallocate(self._file, self.offset,
+                                            self.obj_size - self.offset):
+      self._allocated = self.obj_size
+
+  def _OpDone(self, result):
+    self._busy = False
+    if self._allocated:
+      self.backup.SetAllocatedSize(self.obj_id, self._allocated)
+      self._allocated = 0
+    if result:
+      self.written += result
+      self.backup.SetUploadedSize(self.obj_id, self.written)
+      if self.backup_session is not None:
+        self.backup_session.Touch()
+    if self._paused and len(self._ops) <= self.max_pending / 2:
+      self._Resume()
+    self._Next()
+    self._FireFinished()
+    self._ReleaseIfAbandoned()
+
+  def _OpFailed(self, failure):
+    self._busy = False
+    self._ops.clear()
+    self._buffer = []
+    self._buffered = 0
+    if self.error is None:
+      self.error = failure
+      self.logger.error('Unable to save %s: %s', self.obj_file,
+                        failure.getErrorMessage())
+      if self.transport is not None and not self.finished:
+        # There is no point in receiving the rest of the object.
+        self.transport.loseConnection()
+    if self._paused:
+      self._Resume()
+    # The file still has to be closed, even though nothing else will be
+    # written to it.
+    if self._file is not None:
+      self._Queue(self._Close)
+    self._FireFinished()
+    self._ReleaseIfAbandoned()
+
+  def _FireFinished(self):
+    if not self._finish_deferreds or self._busy or self._ops:
+      return
+    deferreds, self._finish_deferreds = self._finish_deferreds, []
+    for d in deferreds:
+      if self.error is not None:
+        d.errback(self.error)
+      else:
+        d.callback(self.obj_file)
+
+  def _ReadCaptureDate(self, data):
+    self._exif_data += data[:exif.MAX_HEADER_BYTES - len(self._exif_data)]
+    try:
+      self.taken = exif.ParseDateTimeOriginal(self._exif_data)
+    except exif.NeedMoreData:
+      if len(self._exif_data) < exif.MAX_HEADER_BYTES:
+        return
+    self._exif_data = None
+
+  def _Queue(self, func, *args):
+    self._ops.append((func, args))
+    if (self.transport is not None and not self._paused and
+        len(self._ops) > self.max_pending):
+      self._paused = True
+      self.transport.pauseProducing()
+    self._Next()
+
+  def _Release(self, result=None):
+    if not self._released:
+      self._released = True
+      self.backup.CloseObject(self.obj_id)
+    return result
+
+  def _ReleaseIfAbandoned(self):
+    # An interrupted upload is done with the object once its last write and
+    # the close of the partial file are on disk.
+    if self._closed and not self.finished and not self._busy and not self._ops:
+      self._Release()
+
+  def _Resume(self):
+    self._paused = False
+    if self.transport is not None:
+      self.transport.resumeProducing()
+
+  def _Store(self):
+    duplicate_of = self.backup.FindDuplicate(self._hash.hexdigest())
+    if duplicate_of and os.path.isfile(duplicate_of):
+      self.logger.info('%s is a duplicate of %s, not keeping it',
+                       os.path.basename(self.obj_file), duplicate_of)
+      os.remove(self.partial_file)
+      self.stored_duplicate = True
+      return duplicate_of
+
+    obj_dir = os.path.dirname(self.obj_file)
+    if obj_dir != self.partial_dir and MakeDirs(obj_dir):
+      self.logger.info('Creating output dir %s', obj_dir)
+    obj_file = GetUnusedFilename(self.obj_file)
+    if obj_file != self.obj_file:
+      self.logger.warning('%s already exists, saving as %s', self.obj_file,
+                          os.path.basename(obj_file))
+
+    try:
+      os.rename(self.partial_file, obj_file)
+    except OSError as e:
+      if e.errno != errno.ENOENT or not os.path.isfile(self.partial_file):
+        raise
+      MakeDirs(obj_dir, refresh=True)
+      os.rename(self.partial_file, obj_file)
+    return obj_file
+
+  def _Write(self, data):
+    self._file.write(data)
+    self._hash.update(data)
+    return len(data)
+
+  def close(self):
+    """Close the object, abandoning it if it was not finished."""
+    if self._closed:
+      return
+    self._closed = True
+    if not self.finished and not self.duplicate_of:
+      self.logger.warning('Upload of %s interrupted after %d bytes',
+                          self.obj_file, self.size)
+      # Keep everything that did arrive, so a resumed upload can skip it.
+      if self._paused:
+        self._Resume()
+      self.transport = None
+      self.Flush()
+      self._Queue(self._Close)
+    elif not self.finished:
+      self._Release()
+
+  def Finish(self):
+    """Write any buffered data and close the object.
 
-    if self.config.getboolean('AUTOBACKUP', 'create_date_subdir'):
-      obj_dir.append(obj_details['obj_date'])
+    Returns:
+      A Deferred which fires with the object's path once it is on disk
+    """
+    self.finished = True
+    self._closed = True
+
+    if self.duplicate_of:
+      self.backup.ObjectSaved(self.obj_id, self.duplicate_of, None,
+                              self.client, duplicate=True)
+      self._Release()
+      return defer.succeed(self.duplicate_of)
+
+    d = defer.Deferred()
+    self._finish_deferreds.append(d)
+    if self.error is None:
+      self.Flush()
+      self._Queue(self._Close, True)
+      d.addCallback(self._Commit)
+      d.addCallback(self._Finished)
+    d.addBoth(self._Release)
+    self._FireFinished()
+    return d
+
+  def _Finished(self, obj_file):
+    self.logger.info('%s saved successfully', os.path.basename(obj_file))
+    self.backup.ObjectSaved(self.obj_id, obj_file, self._hash.hexdigest(),
+                            self.client, duplicate=self.stored_duplicate)
+    return obj_file
+
+  def Flush(self):
+    """Hand buffered data to the write pool."""
+    if self._buffer and self.error is None:
+      self._Queue(self._Write, ''.join(self._buffer))
+      self._buffer = []
+      self._buffered = 0
+
+  def read(self, size=-1):
+    # The upload body lives on disk, not here. twisted.web only reads the
+    # content of form posts, which are never sent to the upload path.
+    return ''
+
+  def seek(self, offset, whence=0):
+    pass
 
-    obj_dir = os.path.join(*obj_dir)
+  def tell(self):
+    return self.offset + self.size
 
-    if not os.path.isdir(obj_dir):
-      self.logger.info('Creating output dir %s', obj_dir)
-      os.makedirs(obj_dir)
+  def write(self, data):
+    if self.error is not None:
+      return
+    if self.duplicate_of:
+      self.size += len(data)
+      return
+    if self._exif_data is not None and not self.offset:
+      self._ReadCaptureDate(data)
+    self._buffer.append(data)
+    self._buffered += len(data)
+    self.size += len(data)
+    if self._buffered >= self.buffer_size:
+      self.Flush()
+
+
+class DiscardedUpload(object):
+  """A file-like object which throws away the body of an unknown upload."""
+
+  def close(self):
+    pass
+
+  def read(self, size=-1):
+    return ''
+
+  def seek(self, offset, whence=0):
+    pass
+
+  def tell(self):
+    return 0
+
+  def write(self, data):
+    pass
+
+
+class DIDLParser(object):
+  """Extracts an item's fields from a DIDL document in a single pass.
+
+  The DIDL can be fed on its own or as a whole CreateObject request. The
+  Elements argument of the request holds the DIDL either escaped, in which
+  case expat has already unescaped it by the time it is parsed, or as raw
+  elements, which are handled as they come.
+  """
+
+  TEXT_ELEMENTS = {'dc:date': 'date',
+                   'dc:title': 'name',
+                   'upnp:class': 'class'}
+
+  def __init__(self):
+    self.elements = {}
+
+    self._didl = None
+    self._res_seen = False
+    self._text = None
+    self._text_element = None
+
+  def _CreateParser(self):
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.CharacterDataHandler = self._CharacterData
+    parser.EndElementHandler = self._EndElement
+    parser.StartElementHandler = self._StartElement
+    return parser
+
+  def _CharacterData(self, data):
+    if self._text_element:
+      self._text.append(data)
+    elif self._didl is not None:
+      self._didl.append(data)
+
+  def _EndElement(self, name):
+    if name == self._text_element:
+      self.elements[self.TEXT_ELEMENTS[name]] = ''.join(self._text)
+      self._text = None
+      self._text_element = None
+    elif name == 'Elements' and self._didl is not None:
+      didl = ''.join(self._didl).strip()
+      self._didl = None
+      if didl:
+        self._CreateParser().Parse(didl.encode('utf-8'), True)
+
+  def _StartElement(self, name, attrs):
+    if name in self.TEXT_ELEMENTS:
+      if (not self._text_element and
+          self.TEXT_ELEMENTS[name] not in self.elements):
+        self._text = []
+        self._text_element = name
+    elif name == 'res':
+      if not self._res_seen:
+        self._res_seen = True
+        self.elements.update(attrs)
+    elif name == 'Elements':
+      self._didl = []
+
+  def Parse(self, data):
+    """Parse a DIDL document or a CreateObject request.
+
+    Args:
+      data: A string containing the document
+
+    Returns:
+      A dict containing the item's elements
+    """
+    self._CreateParser().Parse(data, True)
+    return self.elements
+
+
+class StaticDocument(object):
+  """A document from the DMS directory, kept in memory ready to be served.
+
+  The file is read again when its modification time changes, which is
+  checked at most once every reload_interval seconds. A document which is a
+  template is formatted again only when the values filled in change.
+  """
+
+  reload_interval = 1
+
+  def __init__(self, filename):
+    self.logger = logging.getLogger('pc_autobackup.mediaserver.document')
+    self.body = None
+    self.etag = None
+    self.filename = filename
+    self.last_modified = None
+
+    self._last_check = 0
+    self._mtime = None
+    self._template = None
+    self._values = None
+
+    self._ReloadIfChanged()
 
-    obj_file = os.path.join(obj_dir, obj_details['obj_name'])
+  def _ReloadIfChanged(self):
+    now = time.time()
+    if now - self._last_check < self.reload_interval:
+      return
+    self._last_check = now
 
-    self.logger.info('Saving %s to %s', obj_details['obj_name'], obj_dir)
-    with open(obj_file, 'wb') as f:
-      f.write(data)
-    self.logger.info('%s saved successfully', obj_details['obj_name'])
+    mtime = os.path.getmtime(self.filename)
+    if mtime == self._mtime:
+      return
 
-    del(self.backup_objects[obj_id])
+    if self._mtime is not None:
+      self.logger.info('Reloading %s', self.filename)
+    with open(self.filename, 'rb') as f:
+      self._template = f.read()
+    self._mtime = mtime
+    self.body = None
+
+  def Get(self, values=None):
+    """Get the document.
+
+    Args:
+      values: A dict of values to fill into the template, or None if the
+        document is not a template
+
+    Returns:
+      A string containing the encoded document
+    """
+    self._ReloadIfChanged()
+    if self.body is not None and values == self._values:
+      return self.body
+
+    body = self._template
+    if values is not None:
+      body %= dict((k, common.EscapeHTML(v)) for k, v in values.iteritems())
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+
+    self.body = body
+    self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+    self.last_modified = int(math.ceil(max(self._mtime, time.time())))
+    self._values = values
+    return body
+
+  def Render(self, request, values=None):
+    """Serve the document, or Not Modified if the client has it already.
+
+    Args:
+      request: A twisted.web.server.Request
+      values: A dict of values to fill into the template, or None if the
+        document is not a template
+
+    Returns:
+      A string containing the response body
+    """
+    body = self.Get(values)
+    request.setHeader('Content-Type', 'text/xml; charset=utf-8')
+    if request.setETag(self.etag):
+      return ''
+    if request.getHeader('if-none-match'):
+      # If-None-Match takes precedence over If-Modified-Since.
+      request.setHeader('Last-Modified',
+                        http.datetimeToString(self.last_modified))
+    elif request.setLastModified(self.last_modified):
+      return ''
+    return body
 
 
 class MediaServer(Resource):
 
-  clients = {}
+  documents = None
   isLeaf = True
+  sessions = None
 
   def __init__(self, config_file=None):
     self.logger = logging.getLogger('pc_autobackup.mediaserver')
     self.config = common.LoadOrCreateConfig(config_file)
     self.config_file = config_file
 
+    if MediaServer.sessions is None:
+      MediaServer.sessions = session.SessionManager(
+          max_sessions=self.config.getint('AUTOBACKUP', 'max_sessions'),
+          idle_timeout=self.config.getint('AUTOBACKUP',
+                                          'session_idle_timeout'),
+          end_callback=self.SessionEnded)
+      metrics.BACKUP_SESSIONS.SetFunction(lambda: len(MediaServer.sessions))
+      task.LoopingCall(MediaServer.sessions.ExpireIdle).start(
+          SESSION_EXPIRE_INTERVAL, now=False)
+      reactor.addSystemEventTrigger('before', 'shutdown',
+                                    MediaServer.sessions.FinishAll)
+
+    # The worker processes are forked before the reactor and the write pool
+    # start their threads. Backup sets the stages, and changes them when the
+    # configuration is reloaded.
+    if (Backup.postprocessor is None and
+        postprocess.GetStages(self.config)):
+      Backup.postprocessor = postprocess.PostProcessor(
+          self.config, [],
+          processes=self.config.getint('AUTOBACKUP', 'postprocess_processes'))
+      reactor.addSystemEventTrigger('during', 'shutdown',
+                                    Backup.postprocessor.Stop)
+
+    if MediaServer.documents is None:
+      MediaServer.documents = dict(
+          (name, StaticDocument(os.path.join(common.BASEDIR, 'DMS', name)))
+          for name in DMS_DOCUMENTS)
+
+  @profiling.Timed('render')
   def render_GET(self, request):
-    if request.path != '/favicon.ico':
-      self.logger.debug('[%s] GET request for %s', request.getClientIP(),
-                        request.path)
-      self.logger.debug('Request args for %s from %s: %s', request.path,
-                        request.getClientIP(), request.args)
-      self.logger.debug('Request headers for %s from %s: %s', request.path,
-                        request.getClientIP(), request.args)
-      self.logger.debug('Request came on interface %s', request.getHost().host)
-
-    if request.path == '/DMS/SamsungDmsDesc.xml':
+    debug = self.logger.isEnabledFor(logging.DEBUG)
+    if debug and request.path != '/favicon.ico':
+      self.LogRequest(request)
+
+    if request.path == METRICS_PATH:
+      request.setHeader('Content-Type', metrics.CONTENT_TYPE)
+      return metrics.Render()
+
+    if request.path.startswith(CONTENT_PATH):
+      return self.ServeObject(request)
+
+    if request.path == '/DMS/%s' % DMS_DESC:
       self.logger.info('New connection from %s (%s)', request.getClientIP(),
                        request.getHeader('user-agent'))
-      self.clients[request.getClientIP()] = request.getHeader('user-agent')
-      response = self.GetDMSDescriptionResponse()
-    elif request.path.split('/')[-1] == 'ContentDirectory1.xml':
-      with open(os.path.join(common.BASEDIR, 'DMS', 'ContentDirectory1.xml'), 'r') as xml_data:
-        response = xml_data.read()
-    elif request.path.split('/')[-1] == 'ConnectionManager1.xml':
-      with open(os.path.join(common.BASEDIR, 'DMS', 'ConnectionManager1.xml'), 'r') as xml_data:
-        response = xml_data.read()
+      self.sessions.SetUserAgent(request.getClientIP(),
+                                 request.getHeader('user-agent'))
+      response = self.GetDMSDescriptionResponse(request)
+    elif request.path.split('/')[-1] in self.documents:
+      document = self.documents[request.path.split('/')[-1]]
+      response = document.Render(request)
     else:
       self.logger.error('Unhandled GET request from %s: %s',
                         request.getClientIP(), request.path)
       request.setResponseCode(404)
       return ''
 
-    if isinstance(response, unicode):
-      response = response.encode('utf-8')
-
-    request.setHeader("Content-Type", "text/xml; charset=utf-8")
-    self.logger.debug('Sending response for %s to %s: %s', request.path,
-                      request.getClientIP(), response)
+    if debug:
+      self.logger.debug('Sending response for %s to %s: %s', request.path,
+                        request.getClientIP(), common.TruncateForLog(response))
     return response
 
+  @profiling.Timed('render')
   def render_POST(self, request):
-    self.logger.debug('Request args for %s from %s: %s', request.path,
-                      request.getClientIP(), request.args)
-    self.logger.debug('Request headers for %s from %s: %s', request.path,
-                      request.getClientIP(), request.args)
-    self.logger.debug('Request came on interface %s', request.getHost().host)
+    debug = self.logger.isEnabledFor(logging.DEBUG)
+    if debug:
+      self.LogRequest(request)
 
-    if request.path == '/cd/content':
+    if request.path == UPLOAD_PATH:
       response = self.ReceiveUpload(request)
     elif request.path == '/upnp/control/ContentDirectory1':
       response = self.GetContentDirectoryResponse(request)
@@ -214,10 +1183,24 @@ class MediaServer(Resource):
       response = response.encode('utf-8')
 
     request.setHeader("Content-Type", "text/xml; charset=utf-8")
-    self.logger.debug('Sending response for %s to %s: %s', request.path,
-                      request.getClientIP(), response)
+    if debug and response is not NOT_DONE_YET:
+      self.logger.debug('Sending response for %s to %s: %s', request.path,
+                        request.getClientIP(), common.TruncateForLog(response))
     return response
 
+  def FinishRequest(self, request, response):
+    """Finish a request whose response was deferred.
+
+    Args:
+      request: A twisted.web.server.Request
+      response: A string containing the response body
+    """
+    if request.finished or getattr(request, '_disconnected', False):
+      return
+    request.write(response)
+    request.finish()
+
+  @profiling.Timed('soap')
   def GetContentDirectoryResponse(self, request):
     """Generate the ContentDirectory response XML.
 
@@ -225,47 +1208,68 @@ class MediaServer(Resource):
       request: A twisted.web.server.Request
 
     Returns:
-      A string containing the XML contents
+      A string containing the XML contents, or NOT_DONE_YET if the response
+      is written once it is ready
       In an error, the HTTP response code is set to 404 and an empty string is
       returned.
     """
-    self.logger.debug('Request content for %s from %s: %s', request.path,
-                      request.getClientIP(), request.content.read())
-    request.content.seek(0)
+    if self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug('Request content for %s from %s: %s', request.path,
+                        request.getClientIP(), common.TruncateForLog(
+                            request.content.read(common.LOG_BODY_LIMIT + 1)))
+      request.content.seek(0)
 
     soapaction = request.getHeader('soapaction')
 
     if soapaction == X_BACKUP_START:
-      self.logger.info('Starting backup for %s (%s)', request.getClientIP(),
-                       self.clients[request.getClientIP()])
+      backup_session = self.sessions.Start(request.getClientIP())
+      if not backup_session:
+        self.logger.error('Refusing backup for %s, %d backups are running',
+                          request.getClientIP(), len(self.sessions))
+        return self.GetSOAPFault(request, UPNP_ERROR_CANNOT_PROCESS,
+                                 'Too many backups in progress')
+      self.logger.info('Starting backup for %s', backup_session)
       response = X_BACKUP_RESPONSE % 'START'
     elif soapaction == CREATE_OBJ:
       soap_xml = request.content.read()
 
-      m = CREATE_OBJ_DIDL.search(soap_xml)
-      if m:
-        parsed_data = self.ParseDIDL(m.group('didl'))
-
-        obj_class = parsed_data.get('class')
-        obj_date = parsed_data.get('date')
-        obj_name = parsed_data.get('name')
-        obj_size = parsed_data.get('size')
-
-        try:
-          obj_type = parsed_data.get('protocolInfo').split(':')[2]
-          obj_subtype = parsed_data.get('protocolInfo').split(':')[3]
-        except IndexError:
-          self.logger.error('Invalid DIDL: %s', soap_xml)
-          request.setResponseCode(404)
-          return ''
-
-        backup = Backup(self.config_file)
-        obj_id = backup.CreateObject(obj_class, obj_date, obj_name, obj_size,
-                                     obj_subtype, obj_type)
+      parse_started = time.time()
+      try:
+        with profiling.GetSpan(request, 'parse_didl'):
+          parsed_data = self.ParseDIDL(soap_xml)
+      except xml.parsers.expat.ExpatError:
+        parsed_data = {}
+      metrics.CREATE_OBJECT_PARSE_SECONDS.Observe(time.time() - parse_started)
+
+      obj_class = parsed_data.get('class')
+      obj_date = parsed_data.get('date')
+      obj_name = parsed_data.get('name')
+      obj_size = parsed_data.get('size')
+
+      try:
+        obj_type = parsed_data['protocolInfo'].split(':')[2]
+        obj_subtype = parsed_data['protocolInfo'].split(':')[3]
+      except (IndexError, KeyError):
+        self.logger.error('Invalid DIDL: %s', soap_xml)
+        request.setResponseCode(404)
+        return ''
+
+      backup = Backup(self.config_file)
+      d = backup.CreateObject(obj_class, obj_date, obj_name, obj_size,
+                              obj_subtype, obj_type)
+
+      def Created(obj_id):
+        if not obj_id:
+          return self.GetSOAPFault(request, UPNP_ERROR_CANNOT_PROCESS,
+                                   'Not enough free space for %s' % obj_name)
         obj_details = backup.GetObjectDetails(obj_id)
 
-        self.logger.info('Ready to receive %s (%s size:%s)', obj_name, obj_type,
-                         obj_size)
+        backup_session = self.sessions.Get(request.getClientIP())
+        if backup_session:
+          backup_session.objects_created += 1
+
+        self.logger.info('Ready to receive %s (%s size:%s)', obj_name,
+                         obj_type, obj_size)
 
         response_dict = {
             'interface': request.getHost().host,
@@ -274,15 +1278,47 @@ class MediaServer(Resource):
             'obj_size': obj_size,
             'obj_subtype': obj_subtype,
             'obj_type': obj_type,
-            'parent_id': obj_details['parent_id']}
-
-        didl = CREATE_OBJ_RESPONSE_DIDL % response_dict
-        response_dict['didl'] = common.EscapeHTML(didl)
-        response = CREATE_OBJ_RESPONSE % response_dict
+            'parent_id': obj_details.parent_id,
+            'resume_upload': int(bool(obj_details.uploaded_size)),
+            'uploaded_size': obj_details.uploaded_size}
+
+        # Only the values which come from the camera can need escaping.
+        for k in ('obj_class', 'obj_size', 'obj_subtype', 'obj_type'):
+          response_dict[k] = common.EscapeHTML('%s' % response_dict[k])
+        return CREATE_OBJ_RESPONSE_TEMPLATE % response_dict
+
+      def Failed(failure):
+        self.logger.error('Unable to create %s: %s', obj_name,
+                          failure.getTraceback())
+        return self.GetSOAPFault(request, UPNP_ERROR_CANNOT_PROCESS,
+                                 'Unable to create %s' % obj_name)
+
+      def Respond(response):
+        if isinstance(response, unicode):
+          response = response.encode('utf-8')
+        self.FinishRequest(request, response)
+
+      d.addCallback(Created)
+      d.addErrback(Failed)
+      d.addCallback(Respond)
+      return NOT_DONE_YET
     elif soapaction == X_BACKUP_DONE:
-      self.logger.info('Backup complete for %s (%s)', request.getClientIP(),
-                       self.clients[request.getClientIP()])
+      backup_session = self.sessions.Finish(request.getClientIP())
+      if backup_session:
+        self.logger.info('Backup complete for %s: %d of %d objects, %.1f MB '
+                         'in %.1fs (%.2f MB/s)', backup_session,
+                         backup_session.objects_saved,
+                         backup_session.objects_created,
+                         backup_session.bytes_received / 1048576.0,
+                         backup_session.Duration(),
+                         backup_session.Throughput() / 1048576.0)
+      else:
+        self.logger.info('Backup complete for %s (%s)', request.getClientIP(),
+                         self.sessions.GetUserAgent(request.getClientIP()))
       response = X_BACKUP_RESPONSE % 'DONE'
+    elif (soapaction or '').strip('"').startswith(CONTENT_DIRECTORY + '#'):
+      response = self.QueryContentDirectory(
+          request, soapaction.strip('"').split('#', 1)[1])
     else:
       self.logger.error('Unhandled soapaction: %s', soapaction)
       request.setResponseCode(404)
@@ -290,23 +1326,166 @@ class MediaServer(Resource):
 
     return response
 
-  def GetDMSDescriptionResponse(self):
+  def GetDMSDescriptionResponse(self, request=None):
     """Generate the DMS Description response XML.
 
+    Args:
+      request: A twisted.web.server.Request to serve the description to, so
+        a camera which has the current description gets Not Modified
+
     Returns:
       A string containing the XML contents
     """
-    with open(os.path.join(common.BASEDIR, 'DMS', 'SamsungDmsDesc.xml'), 'r') as dms_desc:
-      response = dms_desc.read() % {
-          'friendly_name': self.config.get('AUTOBACKUP', 'server_name'),
-          'uuid': self.config.get('AUTOBACKUP', 'uuid')}
+    values = {'friendly_name': self.config.get('AUTOBACKUP', 'server_name'),
+              'uuid': self.config.get('AUTOBACKUP', 'uuid')}
+    if request:
+      return self.documents[DMS_DESC].Render(request, values)
+    return self.documents[DMS_DESC].Get(values)
 
-    return response
+  def GetSOAPFault(self, request, error_code, error_description):
+    """Generate a SOAP fault response for a failed action.
+
+    Args:
+      request: A twisted.web.server.Request
+      error_code: An int containing the UPnP error code
+      error_description: A string describing the error
+
+    Returns:
+      A string containing the XML contents
+    """
+    request.setResponseCode(500)
+    return SOAP_FAULT % {'error_code': error_code,
+                         'error_description':
+                         common.EscapeHTML(error_description)}
+
+  def LogRequest(self, request):
+    """Log the details of a request at debug level.
+
+    Args:
+      request: A twisted.web.server.Request
+    """
+    self.logger.debug('[%s] %s request for %s', request.getClientIP(),
+                      request.method, request.path)
+    self.logger.debug('Request args for %s from %s: %s', request.path,
+                      request.getClientIP(), request.args)
+    self.logger.debug('Request headers for %s from %s: %s', request.path,
+                      request.getClientIP(), request.getAllHeaders())
+    self.logger.debug('Request came on interface %s', request.getHost().host)
+
+  def QueryContentDirectory(self, request, action):
+    """Answer a ContentDirectory action from the catalog.
+
+    Browse, Search and the like are run in the write pool, since they read
+    the catalog.
+
+    Args:
+      request: A twisted.web.server.Request
+      action: A string containing the name of the action
+
+    Returns:
+      NOT_DONE_YET, or a string containing a SOAP fault if the request is
+      invalid
+    """
+    backup = Backup(self.config_file)
+    if backup.catalog is None:
+      self.logger.error('Unable to answer %s from %s, the catalog is off',
+                        action, request.getClientIP())
+      return self.GetSOAPFault(request, UPNP_ERROR_CANNOT_PROCESS,
+                               'The catalog is turned off')
+
+    try:
+      args = contentdirectory.ParseArguments(request.content.read())
+    except contentdirectory.UPnPError as e:
+      return self.GetSOAPFault(request, e.error_code, e.error_description)
+
+    host = request.getHost()
+    content_url = 'http://%s:%d%s%%d' % (host.host, host.port, CONTENT_PATH)
+    d = backup.write_pool.SubmitFor(
+        request.getClientIP(),
+        contentdirectory.ContentDirectory(backup.catalog).Call, action, args,
+        content_url)
+
+    def Answered(response):
+      self.FinishRequest(request, response.encode('utf-8'))
+
+    def Failed(failure):
+      if failure.check(contentdirectory.UPnPError):
+        self.logger.warning('%s from %s failed: %s', action,
+                            request.getClientIP(), failure.value)
+        response = self.GetSOAPFault(request, failure.value.error_code,
+                                     failure.value.error_description)
+      else:
+        self.logger.error('%s from %s failed: %s', action,
+                          request.getClientIP(), failure.getTraceback())
+        response = self.GetSOAPFault(request, UPNP_ERROR_CANNOT_PROCESS,
+                                     'Unable to read the catalog')
+      self.FinishRequest(request, response)
+
+    d.addCallbacks(Answered, Failed)
+    return NOT_DONE_YET
+
+  def ServeObject(self, request):
+    """Serve a backed up object found with Browse or Search.
+
+    Objects are requested as CONTENT_PATH followed by their id in the
+    catalog.
+
+    Args:
+      request: A twisted.web.server.Request
+
+    Returns:
+      NOT_DONE_YET, or an empty string if the object does not exist
+    """
+    backup = Backup(self.config_file)
+    row_id = request.path[len(CONTENT_PATH):]
+    if backup.catalog is None or not row_id.isdigit():
+      request.setResponseCode(404)
+      return ''
+
+    def Serve(row):
+      if row is None or not os.path.isfile(row['path']):
+        self.logger.error('Unable to serve object %s to %s', row_id,
+                          request.getClientIP())
+        request.setResponseCode(404)
+        self.FinishRequest(request, '')
+        return
+      response = File(row['path']).render(request)
+      if response is not NOT_DONE_YET:
+        self.FinishRequest(request, response)
+
+    def Failed(failure):
+      self.logger.error('Unable to serve object %s to %s: %s', row_id,
+                        request.getClientIP(), failure.getErrorMessage())
+      request.setResponseCode(500)
+      self.FinishRequest(request, '')
+
+    d = backup.write_pool.SubmitFor(request.getClientIP(),
+                                    backup.catalog.GetObject, int(row_id))
+    d.addCallbacks(Serve, Failed)
+    return NOT_DONE_YET
+
+  def SessionEnded(self, backup_session):
+    """Write the objects saved in a backup session to the catalog.
+
+    The dedup index is synced as well, so a crash can't lose it.
+
+    Args:
+      backup_session: A session.BackupSession
+    """
+    backup = Backup(self.config_file)
+    backup.FlushCatalog(backup_session.client_ip,
+                        camera=GetCameraName(backup_session.user_agent),
+                        session=backup_session.session_id)
+    if backup.dedup_index:
+      backup.write_pool.Submit(backup.dedup_index.Sync).addErrback(
+          lambda failure: self.logger.error('Unable to sync the dedup index: '
+                                            '%s', failure.getErrorMessage()))
 
   def ParseDIDL(self, didl):
     """Parse DIDL.
 
-    The following is an example of the DIDL to be parsed:
+    The DIDL can also be given inside the Elements of a CreateObject request,
+    escaped or not. The following is an example of the DIDL to be parsed:
 
       <DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/" xmlns:dlna = "urn:schemas-dlna-org:metadata-1-0/">
         <item id="" restricted="0" parentID="DLNA.ORG_AnyContainer" >
@@ -326,61 +1505,291 @@ class MediaServer(Resource):
        'size': '4429673'}
 
     Args:
-      didl: A string containing the DIDL to be parsed
+      didl: A string containing the DIDL or CreateObject request to be parsed
 
     Returns:
       A dict containing the item's elements
+
+    Raises:
+      xml.parsers.expat.ExpatError: The DIDL is not well formed
     """
-    parser = HTMLParser.HTMLParser()
-    didl = parser.unescape(didl)
+    return DIDLParser().Parse(didl)
 
-    didl_elements = {}
-    dom = xml.dom.minidom.parseString(didl)
+  @profiling.Timed('receive_upload')
+  def ReceiveUpload(self, request):
+    """Receive an uploaded file.
 
-    def getText(node):
-      rc = []
-      for child in node.childNodes:
-        if child.nodeType == child.TEXT_NODE:
-          rc.append(child.data)
-      return ''.join(rc)
+    Args:
+      request: A twisted.web.server.Request
 
-    title = dom.getElementsByTagName('dc:title')
-    if title:
-      didl_elements['name'] = getText(title[0])
+    Returns:
+      NOT_DONE_YET, the request is finished once the upload is on disk, or
+      an empty string if the object is unknown
+    """
+    if not isinstance(request.content, ObjectWriter):
+      # UploadRequest has already thrown the body away.
+      self.logger.error('Upload from %s for unknown object %s',
+                        request.getClientIP(), GetUploadObjectID(request.uri))
+      request.setResponseCode(404)
+      return ''
 
-    date = dom.getElementsByTagName('dc:date')
-    if date:
-      didl_elements['date'] = getText(date[0])
+    size = request.content.size
+    d = request.content.Finish()
+
+    upload_started = getattr(request, 'upload_started', time.time())
+
+    def UploadSaved(obj_file):
+      elapsed = time.time() - upload_started
+      metrics.UPLOADS.Inc()
+      metrics.UPLOAD_BYTES.Inc(size)
+      metrics.UPLOAD_SECONDS.Observe(elapsed)
+      if elapsed > 0:
+        metrics.UPLOAD_MBPS.Observe(size / 1048576.0 / elapsed)
+
+      backup_session = self.sessions.Get(request.getClientIP())
+      if backup_session:
+        backup_session.ObjectSaved(size)
+      else:
+        # Without a session there is nothing to batch the catalog write with.
+        Backup(self.config_file).FlushCatalog(
+            request.getClientIP(),
+            camera=GetCameraName(
+                self.sessions.GetUserAgent(request.getClientIP())))
+      self.FinishRequest(request, '')
+
+    def UploadFailed(failure):
+      metrics.UPLOAD_ERRORS.Inc()
+      request.setResponseCode(500)
+      self.FinishRequest(request, '')
+
+    d.addCallbacks(UploadSaved, UploadFailed)
+    return NOT_DONE_YET
+
+
+class UploadRequest(Request):
+  """A twisted.web.server.Request which streams uploads straight to disk.
+
+  The body of a POST to the upload path is handed to an ObjectWriter as it
+  arrives instead of being collected in memory or a temporary file first.
+  The body of an upload for an object which was never created, or has been
+  forgotten, is thrown away and the upload fails with a 404.
+
+  When profiling is on, each request's profile starts once its headers have
+  arrived, so the time spent receiving the body is part of it.
+  """
 
-    upnp_class = dom.getElementsByTagName('upnp:class')
-    if upnp_class:
-      didl_elements['class'] = getText(upnp_class[0])
+  profile = None
+
+  def gotLength(self, length):
+    self.upload_started = time.time()
+    self.profile = profiling.Start(self)
+
+    # self.uri is not set until the whole body has arrived, so the channel
+    # has to be asked for the path of the request being received.
+    uri = getattr(self.channel, '_path', '')
+    if self.channel and uri.startswith(UPLOAD_PATH):
+      obj_id = GetUploadObjectID(uri)
+      resource = self.channel.site.resource
+      backup = Backup(getattr(resource, 'config_file', None))
+      if obj_id and backup.GetObjectDetails(obj_id):
+        offset = GetUploadOffset(self.requestHeaders.getRawHeaders(
+            'content-range', [''])[0])
+        client = self.channel.transport.getPeer().host
+        backup_session = None
+        camera = None
+        if getattr(resource, 'sessions', None) is not None:
+          backup_session = resource.sessions.Get(client)
+          camera = GetCameraName(resource.sessions.GetUserAgent(client))
+        self.content = backup.OpenObject(
+            obj_id, offset=offset, transport=self.channel.transport,
+            client=client, profile=self.profile, camera=camera,
+            backup_session=backup_session)
+      else:
+        # Nothing will be saved, so the body isn't kept in memory or a
+        # temporary file while it arrives.
+        self.content = DiscardedUpload()
+      return
+
+    Request.gotLength(self, length)
+
+  def process(self):
+    if self.profile is not None:
+      self.profile.Add('receive', time.time() - self.profile.started)
+    Request.process(self)
+
+
+def GetBackupDir(config, obj_date):
+  """Get the directory objects of a date are saved in.
+
+  Args:
+    config: A common.Config
+    obj_date: A string containing the object date
+
+  Returns:
+    A string containing the output directory
+  """
+  obj_dir = [config.get('AUTOBACKUP', 'backup_dir')]
 
-    res = dom.getElementsByTagName('res')
-    if res:
-      for k, v in res[0].attributes.items():
-        didl_elements[k] = v
+  if config.getboolean('AUTOBACKUP', 'create_date_subdir'):
+    obj_dir.append(obj_date)
 
-    return didl_elements
+  return os.path.join(*obj_dir)
 
-  def ReceiveUpload(self, request):
-    """Receive an uploaded file.
 
-    Args:
-      request: A twisted.web.server.Request
+def GetCameraName(user_agent):
+  """Get the model of a camera from its user agent.
 
-    Returns:
-      An empty string
-    """
-    response = ''
+  Samsung cameras send a user agent like SEC_HHP_[Camera]WB150F/1.0
 
-    obj_id = request.args['didx'][0].split('=')[1]
-    backup = Backup(self.config_file)
+  Args:
+    user_agent: A string containing the camera's user agent
+
+  Returns:
+    A string containing the model, safe to use in a path, or None if the user
+    agent is unknown
+  """
+  if not user_agent:
+    return None
+  m = CAMERA_MODEL.search(user_agent)
+  model = m.group(1) if m else user_agent
+  return UNSAFE_PATH_CHARS.sub('_', model.strip()).strip('_.') or None
+
+
+def GetObjectPath(config, obj_name, obj_date, taken=None, camera=None):
+  """Get the path an object is saved at.
+
+  If the path_template option is set, the object is saved at the path it
+  gives under backup_dir, e.g. {year}/{month}/{camera}/{name}. The fields are
+  year, month, day, date (as YYYY-MM-DD), camera and name. When the template
+  has no {name} field the object is saved in the directory it names.
+  Otherwise the object is saved in the directory from GetBackupDir.
+
+  Args:
+    config: A common.Config
+    obj_name: A string containing the object name
+    obj_date: A string containing the object date sent by the camera
+    taken: A time.struct_time of when the object was taken, used for the date
+      fields instead of obj_date if given
+    camera: A string containing the model of the camera the object is from
+
+  Returns:
+    A string containing the path of the object
+  """
+  template = config.get('AUTOBACKUP', 'path_template')
+  if not template:
+    return os.path.join(GetBackupDir(config, obj_date), obj_name)
+
+  if taken is None and obj_date:
+    try:
+      taken = time.strptime(obj_date[:10], '%Y-%m-%d')
+    except ValueError:
+      pass
+
+  fields = {'camera': camera or PATH_TEMPLATE_UNKNOWN, 'name': obj_name}
+  for field, date_format in (('year', '%Y'), ('month', '%m'), ('day', '%d'),
+                             ('date', '%Y-%m-%d')):
+    if taken is None:
+      fields[field] = PATH_TEMPLATE_UNKNOWN
+    else:
+      fields[field] = time.strftime(date_format, taken)
 
-    data = request.content.read()
-    backup.WriteObject(obj_id, data)
+  try:
+    obj_path = template.format(**fields)
+  except (IndexError, KeyError, ValueError) as e:
+    logging.getLogger('pc_autobackup.mediaserver').error(
+        'Invalid path_template %s: %s', template, e)
+    return os.path.join(GetBackupDir(config, obj_date), obj_name)
+  if '{name}' not in template:
+    obj_path = os.path.join(obj_path, obj_name)
+  return os.path.join(config.get('AUTOBACKUP', 'backup_dir'),
+                      obj_path.lstrip(os.sep))
 
-    return response
+
+def GetUnusedFilename(obj_file):
+  """Get a filename for an object which doesn't overwrite an existing file.
+
+  Args:
+    obj_file: A string containing the path the object should be saved at
+
+  Returns:
+    A string containing obj_file, or obj_file with _1, _2, etc. added before
+    the extension if it exists
+  """
+  (name, ext) = os.path.splitext(obj_file)
+  unused_file = obj_file
+  i = 0
+  while os.path.exists(unused_file):
+    i += 1
+    unused_file = '%s_%d%s' % (name, i, ext)
+  return unused_file
+
+
+def GetUploadOffset(content_range):
+  """Get the offset a resumed upload starts at.
+
+  A resumed upload carries a Content-Range header for the remaining bytes,
+  e.g. bytes 1048576-4429672/4429673
+
+  Args:
+    content_range: A string containing the Content-Range header
+
+  Returns:
+    An int containing the offset of the first byte of the upload
+  """
+  m = CONTENT_RANGE.match(content_range or '')
+  if m:
+    return int(m.group('start'))
+  return 0
+
+
+def GetUploadObjectID(uri):
+  """Get the object id from an upload URI.
+
+  Uploads are sent to the importUri given in the CreateObject response, e.g.
+  /cd/content?didx=0_id=UP_2012-01-01_aBcDeFgHiJ
+
+  Args:
+    uri: A string containing the request URI
+
+  Returns:
+    A string containing the object id or None if there is no object id
+  """
+  query = urlparse.parse_qs(urlparse.urlsplit(uri).query)
+  didx = query.get('didx', [''])[0].split('=', 1)
+  if len(didx) != 2:
+    return None
+  return didx[1]
+
+
+def MakeDirs(obj_dir, refresh=False):
+  """Create a directory and its parents if they do not exist.
+
+  Directories are remembered once they exist, so saving many objects to the
+  same directory does not check it every time.
+
+  Args:
+    obj_dir: A string containing the directory
+    refresh: True to check the directory again, e.g. after it was removed
+
+  Returns:
+    True if the directory was created
+  """
+  if refresh:
+    _known_dirs.discard(obj_dir)
+  elif obj_dir in _known_dirs:
+    return False
+
+  created = False
+  if not os.path.isdir(obj_dir):
+    try:
+      os.makedirs(obj_dir)
+      created = True
+    except OSError:
+      # Another thread may have created it first.
+      if not os.path.isdir(obj_dir):
+        raise
+  _known_dirs.add(obj_dir)
+  return created
 
 
 def StartMediaServer():
@@ -390,7 +1799,7 @@ def StartMediaServer():
   """
   logging.info('MediaServer started')
   resource = MediaServer()
-  factory = Site(resource)
+  factory = Site(resource, requestFactory=UploadRequest)
   reactor.listenTCP(52235, factory)
   reactor.run()
 
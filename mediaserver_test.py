@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the PC Autobackup MediaServer
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from twisted.internet import address
+from twisted.internet import defer
+from twisted.test import proto_helpers
+from twisted.web import server
+
+import common
+import mediaserver
+import session
+
+
+def ResetBackup():
+  """Forget the state Backup shares between instances."""
+  if mediaserver.Backup.catalog:
+    mediaserver.Backup.catalog.Close()
+  if mediaserver.Backup.dedup_index:
+    mediaserver.Backup.dedup_index.Close()
+  if mediaserver.Backup.postprocessor:
+    mediaserver.Backup.postprocessor.Stop()
+  mediaserver.Backup.backup_objects = None
+  mediaserver.Backup.catalog = None
+  mediaserver.Backup.dedup_index = None
+  mediaserver.Backup.postprocess_stages = None
+  mediaserver.Backup.postprocessor = None
+  mediaserver.Backup._stages_mtime = None
+  mediaserver.Backup.write_pool = None
+  mediaserver.MediaServer.sessions = None
+
+
+def WriteConfig(tmp_dir, **options):
+  """Write a configuration which keeps everything in a directory.
+
+  Args:
+    tmp_dir: A string containing the directory
+    **options: Values for AUTOBACKUP options, the catalog, dedup index and
+      object journal are off unless given
+
+  Returns:
+    A string containing the path of the configuration file
+  """
+  values = {'backup_dir': os.path.join(tmp_dir, 'backup'),
+            'catalog': 0,
+            'dedup': 0,
+            'object_journal': 0,
+            'state_dir': os.path.join(tmp_dir, 'state')}
+  values.update(options)
+  config_file = os.path.join(tmp_dir, 'pc_autobackup.cfg')
+  with open(config_file, 'w') as f:
+    f.write('[AUTOBACKUP]\n')
+    for option, value in sorted(values.iteritems()):
+      f.write('%s = %s\n' % (option, value))
+  return config_file
+
+
+class FakeBackup(object):
+  """Records what an ObjectWriter reports to its Backup."""
+
+  def __init__(self):
+    self.allocated_size = {}
+    self.closed = []
+    self.duplicates = {}
+    self.saved = []
+    self.uploaded_size = {}
+
+  def CloseObject(self, obj_id):
+    self.closed.append(obj_id)
+
+  def FindDuplicate(self, obj_hash):
+    return self.duplicates.get(obj_hash)
+
+  def ObjectSaved(self, obj_id, obj_file, obj_hash, client=None,
+                  duplicate=False):
+    self.saved.append((obj_id, obj_file, obj_hash, duplicate))
+
+  def SetAllocatedSize(self, obj_id, allocated_size):
+    self.allocated_size[obj_id] = allocated_size
+
+  def SetUploadedSize(self, obj_id, uploaded_size):
+    self.uploaded_size[obj_id] = uploaded_size
+
+
+class FakeTransport(object):
+  """A transport which records being paused and dropped."""
+
+  def __init__(self):
+    self.connected = True
+    self.paused = False
+
+  def loseConnection(self):
+    self.connected = False
+
+  def pauseProducing(self):
+    self.paused = True
+
+  def resumeProducing(self):
+    self.paused = False
+
+
+class FakeWritePool(object):
+  """A write pool which only runs operations when told to."""
+
+  def __init__(self):
+    self.queue = collections.deque()
+
+  def Run(self):
+    func, args, d = self.queue.popleft()
+    try:
+      result = func(*args)
+    except Exception:
+      d.errback()
+    else:
+      d.callback(result)
+
+  def RunAll(self):
+    while self.queue:
+      self.Run()
+
+  def Submit(self, func, *args):
+    d = defer.Deferred()
+    self.queue.append((func, args, d))
+    return d
+
+  def SubmitFor(self, client, func, *args):
+    return self.Submit(func, *args)
+
+
+class ObjectWriterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.backup = FakeBackup()
+    self.backup_dir = tempfile.mkdtemp()
+    self.obj_file = os.path.join(self.backup_dir, 'SAM_0001.JPG')
+    self.partial_file = os.path.join(self.backup_dir,
+                                     mediaserver.PARTIAL_FILE % 'obj')
+    self.transport = FakeTransport()
+    self.write_pool = FakeWritePool()
+
+  def tearDown(self):
+    shutil.rmtree(self.backup_dir)
+
+  def Finish(self, writer):
+    """Finish an object and run its disk operations to the end.
+
+    Args:
+      writer: An ObjectWriter
+
+    Returns:
+      A list containing the result the Finish Deferred fired with
+    """
+    result = []
+    writer.Finish().addBoth(result.append)
+    # The store is submitted only once the writes are done.
+    while self.write_pool.queue:
+      self.write_pool.RunAll()
+    self.assertEqual(1, len(result))
+    return result[0]
+
+  def GetWriter(self, **kwargs):
+    kwargs.setdefault('buffer_size', 1)
+    kwargs.setdefault('max_pending', 1)
+    return mediaserver.ObjectWriter(self.backup, 'obj', self.obj_file,
+                                    self.write_pool,
+                                    transport=self.transport, **kwargs)
+
+  def testBackpressure(self):
+    writer = self.GetWriter(max_pending=2)
+    for data in 'abc':
+      writer.write(data)
+    self.assertTrue(self.transport.paused)
+
+    # Paused until no more than half of max_pending operations are waiting.
+    self.write_pool.Run()
+    self.assertTrue(self.transport.paused)
+    self.write_pool.Run()
+    self.assertTrue(self.transport.paused)
+    self.write_pool.Run()
+    self.assertFalse(self.transport.paused)
+    self.write_pool.RunAll()
+    self.assertEqual(3, writer.written)
+
+  def testBuffering(self):
+    writer = self.GetWriter(buffer_size=4)
+    self.write_pool.Run()
+    writer.write('ab')
+    self.assertFalse(self.write_pool.queue)
+    writer.write('cd')
+    self.assertEqual(1, len(self.write_pool.queue))
+
+  def testFinish(self):
+    writer = self.GetWriter(obj_size=4)
+    writer.write('ab')
+    writer.write('cd')
+    self.assertEqual(self.obj_file, self.Finish(writer))
+
+    with open(self.obj_file, 'rb') as f:
+      self.assertEqual('abcd', f.read())
+    self.assertFalse(os.path.exists(self.partial_file))
+    self.assertEqual(
+        [('obj', self.obj_file, hashlib.sha1('abcd').hexdigest(), False)],
+        self.backup.saved)
+    self.assertEqual(['obj'], self.backup.closed)
+    self.assertTrue(self.transport.connected)
+
+  def testFinishExistingFile(self):
+    open(self.obj_file, 'wb').close()
+    writer = self.GetWriter(obj_size=2)
+    writer.write('ab')
+    obj_file = self.Finish(writer)
+
+    self.assertNotEqual(self.obj_file, obj_file)
+    with open(obj_file, 'rb') as f:
+      self.assertEqual('ab', f.read())
+    self.assertEqual(0, os.path.getsize(self.obj_file))
+
+  def testFinishIncomplete(self):
+    writer = self.GetWriter(obj_size=4)
+    writer.write('ab')
+    result = self.Finish(writer)
+
+    self.assertTrue(result.check(IOError))
+    self.assertEqual([], self.backup.saved)
+    self.assertEqual(['obj'], self.backup.closed)
+    # The partial file is kept so the upload can be resumed.
+    with open(self.partial_file, 'rb') as f:
+      self.assertEqual('ab', f.read())
+
+  def testFinishStoredDuplicate(self):
+    duplicate_of = os.path.join(self.backup_dir, 'SAM_0002.JPG')
+    with open(duplicate_of, 'wb') as f:
+      f.write('ab')
+    self.backup.duplicates[hashlib.sha1('ab').hexdigest()] = duplicate_of
+    writer = self.GetWriter(obj_size=2)
+    writer.write('ab')
+    self.assertEqual(duplicate_of, self.Finish(writer))
+
+    self.assertFalse(os.path.exists(self.obj_file))
+    self.assertFalse(os.path.exists(self.partial_file))
+    self.assertEqual(
+        [('obj', duplicate_of, hashlib.sha1('ab').hexdigest(), True)],
+        self.backup.saved)
+    self.assertEqual(['obj'], self.backup.closed)
+
+  def testDuplicateOf(self):
+    duplicate_of = os.path.join(self.backup_dir, 'SAM_0002.JPG')
+    writer = self.GetWriter(duplicate_of=duplicate_of, obj_size=2)
+    writer.write('ab')
+    self.assertFalse(self.write_pool.queue)
+    self.assertEqual(2, writer.tell())
+    self.assertEqual(duplicate_of, self.Finish(writer))
+
+    self.assertFalse(os.path.exists(self.partial_file))
+    self.assertEqual([('obj', duplicate_of, None, True)], self.backup.saved)
+    self.assertEqual(['obj'], self.backup.closed)
+
+  def testDuplicateOfClosed(self):
+    writer = self.GetWriter(duplicate_of='/backup/SAM_0002.JPG')
+    writer.close()
+    writer.close()
+    self.assertEqual(['obj'], self.backup.closed)
+
+  def testProgressKeepsSessionActive(self):
+    backup_session = session.BackupSession('192.168.1.10')
+    backup_session.last_seen -= 100
+    writer = self.GetWriter(backup_session=backup_session)
+    self.write_pool.Run()
+    self.assertLess(backup_session.last_seen, time.time() - 99)
+    writer.write('ab')
+    self.write_pool.Run()
+    self.assertGreater(backup_session.last_seen, time.time() - 1)
+
+  def testResume(self):
+    with open(self.partial_file, 'wb') as f:
+      f.write('abXX')
+    writer = self.GetWriter(obj_size=4, offset=2)
+    self.assertEqual(2, writer.tell())
+    writer.write('cd')
+    self.assertEqual(self.obj_file, self.Finish(writer))
+
+    with open(self.obj_file, 'rb') as f:
+      self.assertEqual('abcd', f.read())
+    # The hash covers the part of the object sent before it was resumed.
+    self.assertEqual(hashlib.sha1('abcd').hexdigest(), self.backup.saved[0][2])
+
+  def testResumeMissingData(self):
+    with open(self.partial_file, 'wb') as f:
+      f.write('a')
+    writer = self.GetWriter(obj_size=4, offset=2)
+    self.write_pool.Run()
+    self.assertIsNotNone(writer.error)
+    self.assertFalse(self.transport.connected)
+
+    writer.write('cd')
+    self.assertFalse(self.write_pool.queue)
+    self.assertTrue(self.Finish(writer).check(IOError))
+    self.assertEqual([], self.backup.saved)
+    self.assertEqual(['obj'], self.backup.closed)
+
+  def testCloseWhilePaused(self):
+    writer = self.GetWriter(obj_size=4)
+    writer.write('ab')
+    writer.write('cd')
+    self.assertTrue(self.transport.paused)
+
+    writer.close()
+    self.assertFalse(self.transport.paused)
+    self.write_pool.RunAll()
+
+    self.assertIsNone(writer.error)
+    self.assertIsNone(writer._file)
+    self.assertEqual(['obj'], self.backup.closed)
+    self.assertEqual(4, self.backup.uploaded_size['obj'])
+    with open(self.partial_file, 'rb') as f:
+      self.assertEqual('abcd', f.read())
+
+  def testCloseWhilePausedOpenFails(self):
+    # A file where the output directory should be makes the open fail.
+    open(os.path.join(self.backup_dir, 'file'), 'wb').close()
+    self.obj_file = os.path.join(self.backup_dir, 'file', 'SAM_0001.JPG')
+    writer = self.GetWriter(obj_size=4)
+    writer.write('ab')
+    writer.write('cd')
+    writer.close()
+    self.write_pool.RunAll()
+
+    self.assertIsNotNone(writer.error)
+    self.assertFalse(self.transport.paused)
+    self.assertFalse(self.write_pool.queue)
+    self.assertEqual(['obj'], self.backup.closed)
+
+
+class BackupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.config_file = WriteConfig(self.tmp_dir, create_date_subdir=0,
+                                   dedup=1)
+    self.write_pool = FakeWritePool()
+    mediaserver.Backup.write_pool = self.write_pool
+    self.backup = mediaserver.Backup(self.config_file)
+
+  def tearDown(self):
+    ResetBackup()
+    shutil.rmtree(self.tmp_dir)
+
+  def CreateObject(self, obj_name):
+    result = []
+    self.backup.CreateObject('object.item.imageItem', '2012-01-01',
+                             obj_name, '1000', 'DLNA.ORG_PN=JPEG_LRG',
+                             'image/jpeg').addCallback(result.append)
+    return result
+
+  def testDedupIndexIsUsedInWritePool(self):
+    obj_file = os.path.join(self.tmp_dir, 'SAM_0001.JPG')
+    open(obj_file, 'wb').close()
+    self.backup.dedup_index.Add('SAM_0001.JPG', '2012-01-01', '1000', 'abc',
+                                obj_file)
+
+    result = self.CreateObject('SAM_0001.JPG')
+    self.assertEqual([], result)
+    self.write_pool.RunAll()
+    obj_details = self.backup.GetObjectDetails(result[0])
+    self.assertEqual(obj_file, obj_details.duplicate_of)
+    self.assertEqual(1000, obj_details.uploaded_size)
+
+    result = self.CreateObject('SAM_0002.JPG')
+    self.write_pool.RunAll()
+    self.assertIsNone(self.backup.GetObjectDetails(result[0]).duplicate_of)
+    self.backup.ObjectSaved(result[0], '/backup/SAM_0002.JPG', 'abd')
+    self.assertIsNone(self.backup.FindDuplicate('abd'))
+    self.write_pool.RunAll()
+    self.assertEqual('/backup/SAM_0002.JPG',
+                     self.backup.FindDuplicate('abd'))
+
+
+class MediaServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.write_pool = FakeWritePool()
+    mediaserver.Backup.write_pool = self.write_pool
+    config_file = WriteConfig(self.tmp_dir, catalog=1)
+    self.backup = mediaserver.Backup(config_file)
+    self.server = mediaserver.MediaServer(config_file)
+
+  def tearDown(self):
+    ResetBackup()
+    shutil.rmtree(self.tmp_dir)
+
+  def testCatalogHasCameraModel(self):
+    self.backup.catalog.Queue('192.168.1.10', {
+        'obj_id': 'UP_1', 'name': 'SAM_0001.JPG', 'date': '2012-01-01',
+        'path': '/backup/SAM_0001.JPG', 'stored': 1.0, 'duplicate': 0})
+    self.server.SessionEnded(session.BackupSession(
+        '192.168.1.10', 'SEC_HHP_[Camera]WB150F/1.0'))
+    self.write_pool.RunAll()
+    self.assertEqual(['WB150F'],
+                     [row['camera'] for row in self.backup.catalog.Find()])
+
+
+class PostProcessingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    mediaserver.Backup.write_pool = FakeWritePool()
+
+  def tearDown(self):
+    ResetBackup()
+    shutil.rmtree(self.tmp_dir)
+
+  def ChangeConfig(self, **options):
+    config = common.LoadOrCreateConfig(WriteConfig(self.tmp_dir, **options))
+    mtime = time.time() + 10
+    os.utime(config.config_file, (mtime, mtime))
+    config._last_check = 0
+    return mediaserver.Backup(config.config_file)
+
+  def testStartedWithServer(self):
+    config_file = WriteConfig(self.tmp_dir, postprocess='validate')
+    mediaserver.MediaServer(config_file)
+    postprocessor = mediaserver.Backup.postprocessor
+    self.assertIsNotNone(postprocessor)
+    self.assertEqual([], postprocessor.stages)
+
+    mediaserver.Backup(config_file)
+    self.assertEqual(['validate'], postprocessor.stages)
+    self.ChangeConfig(postprocess='validate,bogus')
+    self.assertEqual(['validate'], postprocessor.stages)
+    self.ChangeConfig(postprocess='exif_date')
+    self.assertEqual(['exif_date'], postprocessor.stages)
+    self.assertIs(postprocessor, mediaserver.Backup.postprocessor)
+
+  def testNotStartedByRequests(self):
+    config_file = WriteConfig(self.tmp_dir)
+    mediaserver.MediaServer(config_file)
+    mediaserver.Backup(config_file)
+    self.ChangeConfig(postprocess='validate')
+    self.assertIsNone(mediaserver.Backup.postprocessor)
+
+
+class UploadRequestTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    site = server.Site(mediaserver.MediaServer(WriteConfig(self.tmp_dir)),
+                       requestFactory=mediaserver.UploadRequest)
+    self.channel = site.buildProtocol(
+        address.IPv4Address('TCP', '192.168.1.10', 12345))
+    self.transport = proto_helpers.StringTransport()
+    self.channel.makeConnection(self.transport)
+
+  def tearDown(self):
+    self.channel.connectionLost(None)
+    ResetBackup()
+    shutil.rmtree(self.tmp_dir)
+
+  def testUnknownObject(self):
+    for uri in ('%s?didx=0_id=UP_bogus' % mediaserver.UPLOAD_PATH,
+                mediaserver.UPLOAD_PATH):
+      body = 'x' * 200000
+      self.channel.dataReceived('POST %s HTTP/1.1\r\nHost: server\r\n'
+                                'Content-Length: %d\r\n\r\n' %
+                                (uri, len(body)))
+      request = self.channel._channel.requests[-1]
+      self.assertIsInstance(request.content, mediaserver.DiscardedUpload)
+      self.channel.dataReceived(body)
+      self.assertTrue(self.transport.value().startswith('HTTP/1.1 404 '))
+      self.transport.clear()
+
+
+class DIDLParserTest(unittest.TestCase):
+
+  DIDL = ('<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/" '
+          'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+          'xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/">'
+          '<item id="" restricted="0" parentID="DLNA.ORG_AnyContainer">'
+          '<dc:title>SAM_0001.JPG</dc:title>'
+          '<dc:date>2012-01-01</dc:date>'
+          '<upnp:class>object.item.imageItem</upnp:class>'
+          '<res protocolInfo="*:*:image/jpeg:DLNA.ORG_PN=JPEG_LRG" '
+          'size="4429673"></res>'
+          '</item>'
+          '</DIDL-Lite>')
+  ELEMENTS = {'class': 'object.item.imageItem',
+              'date': '2012-01-01',
+              'name': 'SAM_0001.JPG',
+              'protocolInfo': '*:*:image/jpeg:DLNA.ORG_PN=JPEG_LRG',
+              'size': '4429673'}
+  REQUEST = ('<?xml version="1.0" encoding="utf-8"?>'
+             '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+             '<s:Body>'
+             '<u:CreateObject '
+             'xmlns:u="urn:schemas-upnp-org:service:ContentDirectory:1">'
+             '<ContainerID>DLNA.ORG_AnyContainer</ContainerID>'
+             '<Elements>%s</Elements>'
+             '</u:CreateObject>'
+             '</s:Body>'
+             '</s:Envelope>')
+
+  def testDIDL(self):
+    self.assertEqual(self.ELEMENTS, mediaserver.DIDLParser().Parse(self.DIDL))
+
+  def testEscapedElements(self):
+    didl = (self.DIDL.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+    self.assertEqual(self.ELEMENTS,
+                     mediaserver.DIDLParser().Parse(self.REQUEST % didl))
+
+  def testRawElements(self):
+    self.assertEqual(self.ELEMENTS,
+                     mediaserver.DIDLParser().Parse(self.REQUEST % self.DIDL))
+
+  def testFirstValuesAreKept(self):
+    didl = self.DIDL.replace(
+        '</item>',
+        '<dc:title>SAM_0002.JPG</dc:title>'
+        '<res protocolInfo="*:*:image/jpeg:DLNA.ORG_PN=JPEG_TN" size="1">'
+        '</res></item>')
+    self.assertEqual(self.ELEMENTS, mediaserver.DIDLParser().Parse(didl))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Prometheus style metrics for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import bisect
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+THROUGHPUT_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 250)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Every metric, in the order they are rendered.
+METRICS = []
+
+
+class Counter(object):
+  """A count which only goes up.
+
+  Metrics are only updated from the reactor thread, so value is a plain int.
+  """
+
+  __slots__ = ('help', 'name', 'value')
+
+  def __init__(self, name, help):
+    self.help = help
+    self.name = name
+    self.value = 0
+    METRICS.append(self)
+
+  def Inc(self, amount=1):
+    self.value += amount
+
+  def Render(self):
+    return ['# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s counter' % self.name,
+            '%s %s' % (self.name, self.value)]
+
+
+class Gauge(object):
+  """A value which is read from a function when the metrics are rendered."""
+
+  __slots__ = ('func', 'help', 'name')
+
+  def __init__(self, name, help):
+    self.func = None
+    self.help = help
+    self.name = name
+    METRICS.append(self)
+
+  def Render(self):
+    value = 0
+    if self.func:
+      value = self.func()
+    return ['# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s gauge' % self.name,
+            '%s %s' % (self.name, value)]
+
+  def SetFunction(self, func):
+    """Set the function which returns the gauge's value.
+
+    Args:
+      func: A function taking no arguments and returning a number
+    """
+    self.func = func
+
+
+class Histogram(object):
+  """Counts of observed values in buckets, plus their sum."""
+
+  __slots__ = ('buckets', 'count', 'counts', 'help', 'name', 'sum')
+
+  def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+    self.buckets = buckets
+    self.count = 0
+    self.counts = [0] * (len(buckets) + 1)
+    self.help = help
+    self.name = name
+    self.sum = 0.0
+    METRICS.append(self)
+
+  def Observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def Render(self):
+    lines = ['# HELP %s %s' % (self.name, self.help),
+             '# TYPE %s histogram' % self.name]
+    total = 0
+    for bucket, count in zip(self.buckets, self.counts):
+      total += count
+      lines.append('%s_bucket{le="%s"} %d' % (self.name, bucket, total))
+    lines.append('%s_bucket{le="+Inf"} %d' % (self.name, self.count))
+    lines.append('%s_sum %s' % (self.name, self.sum))
+    lines.append('%s_count %d' % (self.name, self.count))
+    return lines
+
+
+def Render():
+  """Render every metric in the Prometheus text format.
+
+  Returns:
+    A string containing the metrics
+  """
+  lines = []
+  for metric in METRICS:
+    lines.extend(metric.Render())
+  lines.append('')
+  return '\n'.join(lines)
+
+
+BACKUP_SESSIONS = Gauge('pc_autobackup_backup_sessions',
+                        'Cameras currently backing up')
+CREATE_OBJECT_PARSE_SECONDS = Histogram(
+    'pc_autobackup_create_object_parse_seconds',
+    'Time spent parsing CreateObject requests')
+PENDING_OBJECTS = Gauge('pc_autobackup_pending_objects',
+                        'Objects created but not uploaded yet')
+SSDP_MSEARCH = Counter('pc_autobackup_ssdp_msearch_total',
+                       'SSDP M-SEARCH requests received')
+SSDP_MSEARCH_DROPPED = Counter('pc_autobackup_ssdp_msearch_dropped_total',
+                               'SSDP M-SEARCH requests merged into a pending '
+                               'response or over the rate limit')
+SSDP_REPLY_SECONDS = Histogram('pc_autobackup_ssdp_reply_seconds',
+                               'Time from an M-SEARCH to its reply')
+UPLOAD_BYTES = Counter('pc_autobackup_upload_bytes_total',
+                       'Bytes of uploaded objects received')
+UPLOAD_ERRORS = Counter('pc_autobackup_upload_errors_total',
+                        'Uploads which could not be saved')
+UPLOAD_MBPS = Histogram('pc_autobackup_upload_mbps',
+                        'Throughput of each upload in MB/s',
+                        buckets=THROUGHPUT_BUCKETS)
+UPLOAD_SECONDS = Histogram('pc_autobackup_upload_seconds',
+                           'Time from the start of an upload until it is '
+                           'saved')
+UPLOADS = Counter('pc_autobackup_uploads_total', 'Uploads saved')
+WRITE_POOL_QUEUED = Gauge('pc_autobackup_write_pool_queued',
+                          'Disk operations waiting for or running in the '
+                          'write pool')
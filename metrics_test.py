@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the Prometheus style metrics
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import unittest
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.metrics = list(metrics.METRICS)
+
+  def tearDown(self):
+    metrics.METRICS[:] = self.metrics
+
+  def testCounter(self):
+    counter = metrics.Counter('test_total', 'Things')
+    counter.Inc()
+    counter.Inc(2)
+    self.assertEqual(['# HELP test_total Things',
+                      '# TYPE test_total counter',
+                      'test_total 3'], counter.Render())
+
+  def testGauge(self):
+    gauge = metrics.Gauge('test_gauge', 'Things now')
+    self.assertEqual('test_gauge 0', gauge.Render()[-1])
+    gauge.SetFunction(lambda: 5)
+    self.assertEqual(['# HELP test_gauge Things now',
+                      '# TYPE test_gauge gauge',
+                      'test_gauge 5'], gauge.Render())
+
+  def testHistogram(self):
+    histogram = metrics.Histogram('test_seconds', 'Time', buckets=(1, 5))
+    for value in (0.5, 1, 3, 10):
+      histogram.Observe(value)
+    self.assertEqual(['# HELP test_seconds Time',
+                      '# TYPE test_seconds histogram',
+                      'test_seconds_bucket{le="1"} 2',
+                      'test_seconds_bucket{le="5"} 3',
+                      'test_seconds_bucket{le="+Inf"} 4',
+                      'test_seconds_sum 14.5',
+                      'test_seconds_count 4'], histogram.Render())
+
+  def testRender(self):
+    metrics.METRICS[:] = []
+    metrics.Counter('a_total', 'A').Inc()
+    metrics.Gauge('b', 'B')
+    self.assertEqual('# HELP a_total A\n# TYPE a_total counter\na_total 1\n'
+                     '# HELP b B\n# TYPE b gauge\nb 0\n', metrics.Render())
+
+
+if __name__ == '__main__':
+  unittest.main()
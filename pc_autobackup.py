@@ -5,11 +5,13 @@
 
 __author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
 
+import atexit
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import optparse
 import os
 import platform
+import Queue
 import re
 import socket
 import sys
@@ -19,6 +21,8 @@ from twisted.internet import reactor
 from twisted.web.server import Site
 
 import common
+import ingest
+import profiling
 import ssdp
 import mediaserver
 
@@ -119,14 +123,13 @@ def ImportCameraConfig(mountpoint,config_file=None):
 
       config.set('AUTOBACKUP', 'server_name', friendly_name)
       config.set('AUTOBACKUP', 'uuid', uuid)
-      with open(config_file, 'wb') as file:
-        logger.info('Saving server configuration')
-        try:
-          config.write(file)
-          logger.info('Configuration saved successfully')
-        except IOError as e:
-          logger.error('Unable to save configuration: %s', str(e))
-          sys.exit(1)
+      logger.info('Saving server configuration')
+      try:
+        config.Save()
+        logger.info('Configuration saved successfully')
+      except IOError as e:
+        logger.error('Unable to save configuration: %s', str(e))
+        sys.exit(1)
       logger.info('Updating camera configuration')
       UpdateCameraConfig(mountpoint)
       logger.info('IMPORTANT: Disable PC AutoBackup on your Windows server!')
@@ -175,6 +178,10 @@ def main():
   parser.add_option('-b', '--bind', dest='bind',
                     help='bind the server to a specific IP',
                     metavar='IP')
+  parser.add_option('--camera', dest='camera',
+                    help='camera model to save a card ingested with '
+                    '--ingest_card under (default: from the photos)',
+                    metavar='MODEL')
   parser.add_option('--config_file', dest='config_file',
                     help='change config file location', metavar='FILE')
   parser.add_option('--create_camera_config', dest='create_camera_config',
@@ -185,6 +192,9 @@ def main():
   parser.add_option('--import_camera_config', dest='import_camera_config',
                     help='update server with cameras configuration',
                     metavar='MOUNTPOINT')
+  parser.add_option('--ingest_card', dest='ingest_card',
+                    help='copy everything not backed up yet from a camera\'s '
+                    'SD card', metavar='MOUNTPOINT')
   parser.add_option('--log_file', dest='log_file', default='autobackup.log',
                     help='change output log file (default: autobackup.log)',
                     metavar='FILE')
@@ -195,6 +205,13 @@ def main():
                     help='do not create subdirs in ouput_dir for media dates')
   parser.add_option('-o', '--output_dir', dest='output_dir',
                     help='output directory for files', metavar='DIR')
+  parser.add_option('--profile', dest='profile',
+                    help='log the time spent in each phase of every request '
+                    'and save cProfile output of sampled requests to DIR',
+                    metavar='DIR')
+  parser.add_option('--profile_rate', dest='profile_rate', type='float',
+                    default=0.01, help='fraction of requests to run cProfile '
+                    'for (default: 0.01)', metavar='FRACTION')
   parser.add_option('-q', '--quiet', dest='quiet', action='store_true',
                     default=False, help='only log errors to console')
   parser.add_option('--update_camera_config', dest='update_camera_config',
@@ -212,7 +229,9 @@ def main():
     lf_log_opts['level'] = logging.DEBUG
 
   logger = logging.getLogger('pc_autobackup')
-  logger.setLevel(logging.DEBUG)
+  # Nothing below the handlers' levels is logged, so the request paths can
+  # skip building debug messages.
+  logger.setLevel(min(log_opts['level'], lf_log_opts['level']))
 
   lf_handler = TimedRotatingFileHandler(options.log_file,
                                         when="midnight",
@@ -222,37 +241,37 @@ def main():
   formatter = logging.Formatter(lf_log_opts['format'],
                                 lf_log_opts['datefmt'])
   lf_handler.setFormatter(formatter)
-  logger.addHandler(lf_handler)
 
   console = logging.StreamHandler()
   console.setLevel(log_opts['level'])
   formatter = logging.Formatter(log_opts['format'],
                                 log_opts['datefmt'])
   console.setFormatter(formatter)
-  logger.addHandler(console)
+
+  # Log files and the console are written from their own thread, so a slow
+  # disk or terminal never holds up the reactor.
+  log_queue = Queue.Queue()
+  listener = common.QueueListener(log_queue, lf_handler, console,
+                                  respect_handler_level=True)
+  listener.start()
+  atexit.register(listener.stop)
+  logger.addHandler(common.QueueHandler(log_queue))
 
   if not options.config_file:
     options.config_file = common.CONFIG_FILE
 
   config = common.LoadOrCreateConfig(options.config_file)
-  update_config = False
 
   if options.bind:
     config.set('AUTOBACKUP', 'default_interface', options.bind)
-    update_config = True
   if options.no_create_date_subdir:
     config.set('AUTOBACKUP', 'create_date_subdir', '0')
-    update_config = True
   if options.output_dir:
     config.set('AUTOBACKUP', 'backup_dir', options.output_dir)
-    update_config = True
   if options.server_name:
     config.set('AUTOBACKUP', 'server_name', options.server_name)
-    update_config = True
 
-  if update_config:
-    with open(options.config_file, 'wb') as config_file:
-      config.write(config_file)
+  config.Save()
 
   if options.create_camera_config:
     UpdateCameraConfig(options.create_camera_config, create_desc_file=True,
@@ -264,6 +283,13 @@ def main():
                        config_file=options.config_file)
     sys.exit(0)
 
+  if options.ingest_card:
+    if not ingest.IngestCard(options.ingest_card,
+                             config_file=options.config_file,
+                             camera=options.camera):
+      sys.exit(1)
+    sys.exit(0)
+
   if options.update_camera_config:
     UpdateCameraConfig(options.update_camera_config,
                        config_file=options.config_file)
@@ -281,11 +307,17 @@ def main():
   if options.debug:
     GetSystemInfo(config_file=options.config_file)
 
+  if options.profile:
+    profiling.Configure(profile_dir=options.profile,
+                        sample_rate=options.profile_rate)
+    logger.info('Profiling requests, saving profiles of %.1f%% of them to %s',
+                options.profile_rate * 100, options.profile)
+
   reactor.listenMulticast(1900, ssdp.SSDPServer(options.config_file), listenMultiple=True)
   logger.info('SSDPServer started')
 
   resource = mediaserver.MediaServer(options.config_file)
-  factory = Site(resource)
+  factory = Site(resource, requestFactory=mediaserver.UploadRequest)
   reactor.listenTCP(52235, factory, interface=interface)
   logger.info('MediaServer started')
 
@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Post-processing of backed up objects for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import json
+import logging
+import multiprocessing
+import optparse
+import os
+import Queue
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+import common
+import exif
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+MP4_EXTENSIONS = ('.m4v', '.mov', '.mp4')
+# How far from the end of a JPEG the end of image marker may be. Some
+# cameras pad the file after it.
+JPEG_EOI_SEARCH = 4096
+# How long Stop waits without any queued object being processed before it
+# gives up on the rest. A worker process which dies loses its object.
+STALL_TIMEOUT = 300
+THUMBNAIL_SIZE = (320, 240)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS processed (
+  path TEXT NOT NULL,
+  stage TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  mtime REAL NOT NULL,
+  result TEXT,
+  error TEXT,
+  processed REAL NOT NULL,
+  PRIMARY KEY (path, stage)
+);
+'''
+
+
+def ExtractExifDate(path, options):
+  """Post-processing stage which finds when a photo was taken.
+
+  Args:
+    path: A string containing the path to the object
+    options: A dict containing the post-processing options
+
+  Returns:
+    A dict containing exif_date as YYYY-MM-DD HH:MM:SS, or None if the photo
+    has no capture date
+  """
+  taken = exif.ReadDateTimeOriginal(path)
+  if taken is None:
+    return {'exif_date': None}
+  return {'exif_date': time.strftime('%Y-%m-%d %H:%M:%S', taken)}
+
+
+def MakeThumbnail(path, options):
+  """Post-processing stage which saves a thumbnail of a photo.
+
+  Thumbnails are saved under thumbnail_dir with the same path the photo has
+  under backup_dir. PIL is needed to make them.
+
+  Args:
+    path: A string containing the path to the object
+    options: A dict containing the post-processing options
+
+  Returns:
+    A dict containing the path of the thumbnail
+  """
+  relative_path = os.path.relpath(path, options['backup_dir'])
+  if relative_path.startswith(os.pardir):
+    relative_path = os.path.basename(path)
+  thumbnail = os.path.join(options['thumbnail_dir'], relative_path)
+  thumbnail_dir = os.path.dirname(thumbnail)
+  if not os.path.isdir(thumbnail_dir):
+    try:
+      os.makedirs(thumbnail_dir)
+    except OSError:
+      if not os.path.isdir(thumbnail_dir):
+        raise
+
+  image = Image.open(path)
+  # Let the decoder skip most of the image instead of scaling it afterwards.
+  image.draft('RGB', THUMBNAIL_SIZE)
+  image.thumbnail(THUMBNAIL_SIZE)
+  image.convert('RGB').save(thumbnail, 'JPEG', quality=85)
+  return {'thumbnail': thumbnail}
+
+
+def ValidateJPEG(path, size):
+  """Check that a JPEG file is complete.
+
+  Args:
+    path: A string containing the path to the file
+    size: An int containing the size of the file
+
+  Returns:
+    A string describing the problem, or None if the file is valid
+  """
+  with open(path, 'rb') as f:
+    if f.read(3) != '\xff\xd8\xff':
+      return 'no JPEG start of image marker'
+    f.seek(max(0, size - JPEG_EOI_SEARCH))
+    if '\xff\xd9' not in f.read():
+      return 'no JPEG end of image marker, the file is truncated'
+  return None
+
+
+def ValidateMP4(path, size):
+  """Check that an MP4 file is complete.
+
+  The top level boxes have to start with ftyp and exactly fill the file.
+
+  Args:
+    path: A string containing the path to the file
+    size: An int containing the size of the file
+
+  Returns:
+    A string describing the problem, or None if the file is valid
+  """
+  offset = 0
+  boxes = []
+  with open(path, 'rb') as f:
+    while offset < size:
+      f.seek(offset)
+      header = f.read(16)
+      if len(header) < 8:
+        return 'box header at byte %d is truncated' % offset
+      (box_size, box_type) = struct.unpack('>I4s', header[:8])
+      if box_size == 1:
+        if len(header) < 16:
+          return 'box header at byte %d is truncated' % offset
+        box_size = struct.unpack('>Q', header[8:16])[0]
+      elif box_size == 0:
+        box_size = size - offset
+      if box_size < 8:
+        return 'invalid %r box at byte %d' % (box_type, offset)
+      boxes.append(box_type)
+      offset += box_size
+
+  if not boxes or boxes[0] != 'ftyp':
+    return 'no MP4 ftyp box'
+  if offset != size:
+    return '%r box ends after the end of the file, it is truncated' % (
+        boxes[-1])
+  if 'moov' not in boxes:
+    return 'no MP4 moov box'
+  return None
+
+
+def ValidateHeader(path, options):
+  """Post-processing stage which checks that an object is complete.
+
+  Args:
+    path: A string containing the path to the object
+    options: A dict containing the post-processing options
+
+  Returns:
+    A dict containing valid and, if it is not, problem
+  """
+  size = os.path.getsize(path)
+  ext = os.path.splitext(path)[1].lower()
+  if ext in JPEG_EXTENSIONS:
+    problem = ValidateJPEG(path, size)
+  else:
+    problem = ValidateMP4(path, size)
+  if problem:
+    return {'valid': False, 'problem': problem}
+  return {'valid': True}
+
+
+# Post-processing stages by name, with the function which runs them in a
+# worker process and the extensions of the objects they apply to. A stage
+# function takes the object's path and the options and returns a dict which
+# is saved as the result.
+STAGES = {
+    'exif_date': (ExtractExifDate, JPEG_EXTENSIONS),
+    'thumbnail': (MakeThumbnail, JPEG_EXTENSIONS),
+    'validate': (ValidateHeader, JPEG_EXTENSIONS + MP4_EXTENSIONS),
+}
+
+
+def RegisterStage(name, func, extensions):
+  """Add a post-processing stage.
+
+  Stages have to be registered before the PostProcessor is created, and
+  func has to be a module level function so it can be run in a worker
+  process.
+
+  Args:
+    name: A string containing the name used in the postprocess option
+    func: A function taking a path and a dict of options, returning a dict
+    extensions: A tuple of lowercase file extensions the stage applies to
+  """
+  STAGES[name] = (func, extensions)
+
+
+def RunStages(path, stages, options):
+  """Run post-processing stages on an object.
+
+  Called in a worker process.
+
+  Args:
+    path: A string containing the path to the object
+    stages: A list of strings containing the stage names
+    options: A dict containing the post-processing options
+
+  Returns:
+    A tuple of the path and a dict containing a tuple of the result and the
+    error of each stage
+  """
+  results = {}
+  for stage in stages:
+    try:
+      results[stage] = (STAGES[stage][0](path, options), None)
+    except Exception as e:
+      results[stage] = (None, '%s: %s' % (e.__class__.__name__, e))
+  return (path, results)
+
+
+class PostProcessor(object):
+  """Runs post-processing stages on backed up objects in a process pool.
+
+  Objects are added from the reactor, which only puts them on a queue. A
+  feeder thread looks up which stages each object still needs and hands it
+  to a multiprocessing pool, so parsing and image work neither blocks the
+  reactor nor competes with it for the GIL. Results are saved in an SQLite
+  database along with the object's size and mtime, so each file is only
+  processed once by each stage.
+
+  Worker processes are forked when the PostProcessor is created, so it has
+  to be created before other threads are started. They never log, since the
+  logging locks may be held by another thread at the fork. The stages can be
+  changed later, the number of processes can't.
+  """
+
+  def __init__(self, config, stages, processes=2):
+    self.logger = logging.getLogger('pc_autobackup.postprocess')
+    self.options = {
+        'backup_dir': config.get('AUTOBACKUP', 'backup_dir'),
+        'thumbnail_dir': config.get('AUTOBACKUP', 'thumbnail_dir')}
+    self.stages = []
+    self.SetStages(stages)
+
+    self.failed = 0
+    self.pending = 0
+    self.processed = 0
+
+    db_file = os.path.join(common.GetStateDir(config), 'postprocess.sqlite')
+    self._db = sqlite3.connect(db_file, check_same_thread=False)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.executescript(SCHEMA)
+    self._done = threading.Condition()
+    self._lock = threading.Lock()
+    self._queue = Queue.Queue()
+
+    self._pool = multiprocessing.Pool(processes)
+    self._feeder = threading.Thread(target=self._Feed,
+                                    name='pc_autobackup.postprocess')
+    self._feeder.daemon = True
+    self._feeder.start()
+
+  def _Feed(self):
+    while True:
+      path = self._queue.get()
+      if path is None:
+        break
+      try:
+        stages = self.GetPendingStages(path)
+      except OSError as e:
+        self.logger.error('Unable to post-process %s: %s', path, e)
+        self._Finished()
+        continue
+      if not stages:
+        self._Finished()
+        continue
+      self._pool.apply_async(RunStages, (path, stages, self.options),
+                             callback=self._Processed)
+
+  def _Finished(self):
+    with self._done:
+      self.pending -= 1
+      self._done.notify_all()
+
+  def _Processed(self, result):
+    # Called in the pool's result thread.
+    (path, results) = result
+    try:
+      stat = os.stat(path)
+    except OSError as e:
+      self.logger.error('%s disappeared while being post-processed: %s',
+                        path, e)
+      self._Finished()
+      return
+
+    now = time.time()
+    rows = []
+    for stage, (stage_result, error) in sorted(results.iteritems()):
+      if error:
+        self.failed += 1
+        self.logger.error('Post-processing stage %s failed for %s: %s',
+                          stage, path, error)
+      elif stage == 'validate' and not stage_result['valid']:
+        self.logger.warning('%s is damaged: %s', path, stage_result['problem'])
+      rows.append((path, stage, stat.st_size, stat.st_mtime,
+                   json.dumps(stage_result), error, now))
+    with self._lock:
+      with self._db:
+        self._db.executemany(
+            'INSERT OR REPLACE INTO processed (path, stage, size, mtime, '
+            'result, error, processed) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    self.processed += 1
+    self.logger.debug('Post-processed %s: %s', path, results)
+    self._Finished()
+
+  def Add(self, path):
+    """Queue an object to be post-processed.
+
+    Args:
+      path: A string containing the path to the object
+    """
+    with self._done:
+      self.pending += 1
+    self._queue.put(path)
+
+  def GetPendingStages(self, path):
+    """Get the stages which still have to run for an object.
+
+    Args:
+      path: A string containing the path to the object
+
+    Returns:
+      A list of strings containing stage names
+
+    Raises:
+      OSError: The object does not exist
+    """
+    stat = os.stat(path)
+    ext = os.path.splitext(path)[1].lower()
+    stages = [s for s in self.stages if ext in STAGES[s][1]]
+    if not stages:
+      return []
+
+    with self._lock:
+      done = self._db.execute(
+          'SELECT stage, size, mtime FROM processed WHERE path = ?',
+          (path,)).fetchall()
+    done = set(stage for (stage, size, mtime) in done
+               if size == stat.st_size and mtime == stat.st_mtime)
+    return [s for s in stages if s not in done]
+
+  def GetResults(self, path):
+    """Get the saved results of the stages which ran for an object.
+
+    Args:
+      path: A string containing the path to the object
+
+    Returns:
+      A dict containing the result of each stage which succeeded
+    """
+    with self._lock:
+      rows = self._db.execute(
+          'SELECT stage, result FROM processed WHERE path = ? AND error IS '
+          'NULL', (path,)).fetchall()
+    return dict((stage, json.loads(result)) for (stage, result) in rows)
+
+  def SetStages(self, stages):
+    """Change the stages which run for objects not handed to a worker yet.
+
+    Args:
+      stages: A list of strings containing stage names
+
+    Raises:
+      ValueError: A stage is unknown, the stages are left as they were
+    """
+    for stage in stages:
+      if stage not in STAGES:
+        raise ValueError('Unknown post-processing stage %s' % stage)
+    if 'thumbnail' in stages and Image is None:
+      # Not recorded as processed either, so thumbnails are made once PIL is
+      # installed.
+      self.logger.warning('PIL is not installed, thumbnails will not be made')
+      stages = [s for s in stages if s != 'thumbnail']
+    self.stages = stages
+
+  def Stop(self, wait=False, timeout=STALL_TIMEOUT):
+    """Stop taking objects and shut the worker processes down.
+
+    Args:
+      wait: True to wait for every queued object to be processed first
+      timeout: A float containing how many seconds to wait without any
+        object being processed before giving up on the rest
+    """
+    if wait and not self.Wait(timeout):
+      self.logger.error('Gave up on %d objects after %ds without progress, '
+                        'a worker process may have died', self.pending,
+                        timeout)
+      wait = False
+    self._queue.put(None)
+    self._feeder.join()
+    if wait:
+      self._pool.close()
+    else:
+      self._pool.terminate()
+    self._pool.join()
+    with self._lock:
+      self._db.close()
+
+  def Wait(self, timeout=None):
+    """Wait until every queued object has been processed.
+
+    Args:
+      timeout: A float containing how many seconds to wait without any
+        object being processed, or None to wait for as long as it takes
+
+    Returns:
+      True if every object was processed, False if the wait timed out
+    """
+    with self._done:
+      pending = self.pending
+      progress = time.time()
+      while self.pending:
+        if self.pending != pending:
+          pending = self.pending
+          progress = time.time()
+        elif timeout is not None and time.time() - progress >= timeout:
+          return False
+        self._done.wait(min(1, timeout or 1))
+    return True
+
+
+def GetStages(config):
+  """Get the post-processing stages which are turned on.
+
+  Args:
+    config: A common.Config
+
+  Returns:
+    A list of strings containing stage names
+  """
+  return [s.strip() for s in config.get('AUTOBACKUP', 'postprocess').split(',')
+          if s.strip()]
+
+
+def main():
+  parser = optparse.OptionParser(
+      usage='%prog [options]\n\nPost-process every object in the backup '
+      'directory which has not been\nprocessed yet.')
+  parser.add_option('--config_file', dest='config_file',
+                    help='change config file location', metavar='FILE')
+  parser.add_option('--processes', dest='processes', type='int',
+                    help='number of worker processes (default: the '
+                    'postprocess_processes option)', metavar='COUNT')
+  parser.add_option('--stages', dest='stages',
+                    help='comma separated stages to run (default: the '
+                    'postprocess option, available: %s)' %
+                    ', '.join(sorted(STAGES)), metavar='STAGES')
+  (options, args) = parser.parse_args()
+
+  logging_options = common.LOG_DEFAULTS.copy()
+  logging.basicConfig(**logging_options)
+
+  config = common.LoadOrCreateConfig(options.config_file or
+                                     common.CONFIG_FILE)
+  if options.stages:
+    config.set('AUTOBACKUP', 'postprocess', options.stages)
+  stages = GetStages(config)
+  if not stages:
+    parser.error('No post-processing stages, set the postprocess option or '
+                 'use --stages')
+
+  try:
+    postprocessor = PostProcessor(
+        config, stages, processes=options.processes or
+        config.getint('AUTOBACKUP', 'postprocess_processes'))
+  except ValueError as e:
+    parser.error(str(e))
+
+  started = time.time()
+  for root, dirs, files in os.walk(config.get('AUTOBACKUP', 'backup_dir')):
+    dirs.sort()
+    for name in sorted(files):
+      if not name.startswith('.'):
+        postprocessor.Add(os.path.join(root, name))
+  postprocessor.Stop(wait=True)
+  logging.info('Post-processed %d objects in %.1fs, %d stages failed',
+               postprocessor.processed, time.time() - started,
+               postprocessor.failed)
+  if postprocessor.failed or postprocessor.pending:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the post-processing of backed up objects
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+
+import common
+import exif
+import exif_test
+import postprocess
+
+JPEG = exif_test.MakeJPEG(exif_ifd={exif.TAG_DATE_TIME_ORIGINAL:
+                                        exif_test.DATE}) + '\xff\xd9'
+MP4 = (struct.pack('>I4s', 16, 'ftyp') + 'mp42' + '\0' * 4 +
+       struct.pack('>I4s', 12, 'moov') + 'abcd')
+
+
+class ValidateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def Validate(self, obj_name, data):
+    path = os.path.join(self.tmp_dir, obj_name)
+    with open(path, 'wb') as f:
+      f.write(data)
+    return postprocess.ValidateHeader(path, {})
+
+  def testJPEG(self):
+    self.assertEqual({'valid': True}, self.Validate('SAM_0001.JPG', JPEG))
+    self.assertFalse(self.Validate('SAM_0001.JPG', JPEG[:-2])['valid'])
+    self.assertFalse(self.Validate('SAM_0001.JPG', 'x' + JPEG)['valid'])
+
+  def testMP4(self):
+    self.assertEqual({'valid': True}, self.Validate('SAM_0001.MP4', MP4))
+    self.assertFalse(self.Validate('SAM_0001.MP4', MP4[:-1])['valid'])
+    self.assertFalse(self.Validate('SAM_0001.MP4', MP4[:16])['valid'])
+    self.assertFalse(self.Validate('SAM_0001.MP4', MP4[16:])['valid'])
+
+
+class PostProcessorTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.backup_dir = os.path.join(self.tmp_dir, 'backup')
+    os.makedirs(self.backup_dir)
+    config_file = os.path.join(self.tmp_dir, 'pc_autobackup.cfg')
+    with open(config_file, 'w') as f:
+      f.write('[AUTOBACKUP]\nbackup_dir = %s\nstate_dir = %s\n' % (
+          self.backup_dir, os.path.join(self.tmp_dir, 'state')))
+    self.postprocessor = postprocess.PostProcessor(
+        common.LoadOrCreateConfig(config_file), ['exif_date', 'validate'],
+        processes=1)
+
+  def tearDown(self):
+    self.postprocessor.Stop()
+    shutil.rmtree(self.tmp_dir)
+
+  def WriteObject(self, obj_name, data):
+    path = os.path.join(self.backup_dir, obj_name)
+    with open(path, 'wb') as f:
+      f.write(data)
+    return path
+
+  def testProcessedOnce(self):
+    path = self.WriteObject('SAM_0001.JPG', JPEG)
+    mp4_path = self.WriteObject('SAM_0002.MP4', MP4)
+    self.assertEqual(['exif_date', 'validate'],
+                     self.postprocessor.GetPendingStages(path))
+    self.assertEqual(['validate'],
+                     self.postprocessor.GetPendingStages(mp4_path))
+
+    self.postprocessor.Add(path)
+    self.postprocessor.Add(mp4_path)
+    self.assertTrue(self.postprocessor.Wait(timeout=30))
+    self.assertEqual(2, self.postprocessor.processed)
+    self.assertEqual(
+        {'exif_date': {'exif_date': '2013-01-02 03:04:05'},
+         'validate': {'valid': True}},
+        self.postprocessor.GetResults(path))
+    self.assertEqual([], self.postprocessor.GetPendingStages(path))
+
+    with open(path, 'ab') as f:
+      f.write('x')
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    self.assertEqual(['exif_date', 'validate'],
+                     self.postprocessor.GetPendingStages(path))
+
+  def testSetStages(self):
+    self.postprocessor.SetStages(['validate'])
+    self.assertEqual(['validate'], self.postprocessor.stages)
+    self.assertRaises(ValueError, self.postprocessor.SetStages,
+                      ['exif_date', 'bogus'])
+    self.assertEqual(['validate'], self.postprocessor.stages)
+
+    path = self.WriteObject('SAM_0001.JPG', JPEG)
+    self.postprocessor.Add(path)
+    self.assertTrue(self.postprocessor.Wait(timeout=30))
+    self.assertEqual(['validate'],
+                     self.postprocessor.GetResults(path).keys())
+
+  def testStopGivesUpOnLostObjects(self):
+    # An object handed to a worker process which dies is never finished.
+    self.postprocessor._pool.apply_async = lambda *args, **kwargs: None
+    self.postprocessor.Add(self.WriteObject('SAM_0001.JPG', JPEG))
+    self.assertFalse(self.postprocessor.Wait(timeout=0.1))
+
+    started = time.time()
+    self.postprocessor.Stop(wait=True, timeout=0.1)
+    self.assertLess(time.time() - started, 10)
+    self.assertEqual(1, self.postprocessor.pending)
+
+
+if __name__ == '__main__':
+  unittest.main()
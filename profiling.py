@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Request profiling for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import collections
+import cProfile
+import functools
+import itertools
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+# Set by Configure. While it is None nothing is recorded and every hook
+# returns straight away.
+_settings = None
+# The request being profiled with cProfile. cProfile can only profile one
+# request at a time.
+_sampled = None
+_profile_number = itertools.count(1)
+
+UNSAFE_FILENAME_CHARS = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+class NullSpan(object):
+  """A span which records nothing, used when profiling is off."""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+  """Adds the time spent in a with block to a RequestProfile."""
+
+  __slots__ = ('name', 'profile', 'started')
+
+  def __init__(self, profile, name):
+    self.name = name
+    self.profile = profile
+    self.started = None
+
+  def __enter__(self):
+    self.started = time.time()
+    return self
+
+  def __exit__(self, *args):
+    self.profile.Add(self.name, time.time() - self.started)
+    return False
+
+
+class RequestProfile(object):
+  """The time a request spent in each phase of its handling.
+
+  Phases which happen more than once, like the writes of an upload, are
+  added up. Phases run in the write pool also record how long they waited
+  for a pool thread. If the request was sampled, everything the reactor
+  thread does until the request finishes is profiled with cProfile as well.
+  """
+
+  def __init__(self, request, profile_dir=None):
+    self.logger = logging.getLogger('pc_autobackup.profiling')
+    self.profile_dir = profile_dir
+    self.profiler = None
+    self.request = request
+    self.spans = collections.OrderedDict()
+    self.started = time.time()
+
+    # Spans of write pool operations are added from pool threads.
+    self._lock = threading.Lock()
+
+  def Add(self, name, seconds):
+    """Add time to a phase.
+
+    Args:
+      name: A string containing the name of the phase
+      seconds: A float containing the time spent in the phase
+    """
+    with self._lock:
+      self.spans[name] = self.spans.get(name, 0) + seconds
+
+  def Finish(self):
+    """Log the phases of the finished request and save its cProfile."""
+    global _sampled
+
+    self.Add('total', time.time() - self.started)
+    # A request which lost its connection early may not have a path yet.
+    method = getattr(self.request, 'method', None) or '-'
+    path = getattr(self.request, 'path', None) or '-'
+    description = '%s %s from %s' % (method, path, self.request.getClientIP())
+    self.logger.info('%s: %s', description, ', '.join(
+        '%s %.1fms' % (name, seconds * 1000)
+        for name, seconds in self.spans.iteritems()))
+
+    if self.profiler is not None:
+      self.profiler.disable()
+      _sampled = None
+      profile_file = os.path.join(self.profile_dir, '%s-%s-%d.prof' % (
+          time.strftime('%Y%m%d%H%M%S'),
+          UNSAFE_FILENAME_CHARS.sub('_', method + path),
+          next(_profile_number)))
+      try:
+        self.profiler.dump_stats(profile_file)
+        self.logger.info('Saved profile of %s to %s', description,
+                         profile_file)
+      except (IOError, OSError) as e:
+        self.logger.error('Unable to save profile %s: %s', profile_file, e)
+
+  def StartProfiler(self):
+    """Profile the reactor thread with cProfile until the request finishes."""
+    global _sampled
+
+    _sampled = self
+    self.profiler = cProfile.Profile()
+    self.profiler.enable()
+
+  def Timed(self, name, func):
+    """Wrap a function run in the write pool so its time is recorded.
+
+    Args:
+      name: A string containing the name of the phase
+      func: The function to be run in a pool thread
+
+    Returns:
+      A function which calls func, adding the time it waited for a thread to
+      write_pool_wait and the time it ran to the phase
+    """
+    queued = time.time()
+
+    @functools.wraps(func)
+    def Wrapper(*args, **kwargs):
+      started = time.time()
+      self.Add('write_pool_wait', started - queued)
+      try:
+        return func(*args, **kwargs)
+      finally:
+        self.Add(name, time.time() - started)
+    return Wrapper
+
+
+def Configure(profile_dir=None, sample_rate=0.0):
+  """Turn on profiling of requests.
+
+  Args:
+    profile_dir: A string containing the directory cProfile output is saved
+      in
+    sample_rate: A float containing the fraction of requests to run cProfile
+      for, 0 only records the time spent in each phase
+  """
+  global _settings
+
+  if profile_dir and not os.path.isdir(profile_dir):
+    os.makedirs(profile_dir)
+  _settings = (profile_dir, sample_rate if profile_dir else 0.0)
+
+
+def Start(request):
+  """Start profiling a request, if profiling is on.
+
+  Args:
+    request: A twisted.web.server.Request whose headers have arrived
+
+  Returns:
+    A RequestProfile, or None if profiling is off
+  """
+  if _settings is None:
+    return None
+
+  (profile_dir, sample_rate) = _settings
+  profile = RequestProfile(request, profile_dir)
+  if sample_rate and _sampled is None and random.random() < sample_rate:
+    profile.StartProfiler()
+  request.notifyFinish().addBoth(lambda _: profile.Finish())
+  return profile
+
+
+def GetSpan(request, name):
+  """Get a span timing a with block as a phase of a request.
+
+  Args:
+    request: A twisted.web.server.Request
+    name: A string containing the name of the phase
+
+  Returns:
+    A Span, or NULL_SPAN if the request is not being profiled
+  """
+  profile = getattr(request, 'profile', None)
+  if profile is None:
+    return NULL_SPAN
+  return Span(profile, name)
+
+
+def Timed(name):
+  """Decorate a method taking a request so its time is a phase of it.
+
+  Args:
+    name: A string containing the name of the phase
+
+  Returns:
+    A decorator
+  """
+  def Decorator(func):
+    @functools.wraps(func)
+    def Wrapper(self, request, *args, **kwargs):
+      profile = getattr(request, 'profile', None)
+      if profile is None:
+        return func(self, request, *args, **kwargs)
+      started = time.time()
+      try:
+        return func(self, request, *args, **kwargs)
+      finally:
+        profile.Add(name, time.time() - started)
+    return Wrapper
+  return Decorator
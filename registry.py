@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Registry of pending backup objects for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+
+class BackupObject(object):
+  """An object announced by CreateObject which has not been saved yet."""
+
+  __slots__ = ('allocated_size', 'created', 'duplicate_of', 'obj_class',
+               'obj_date', 'obj_id', 'obj_name', 'obj_size', 'obj_subtype',
+               'obj_type', 'parent_id', 'uploaded_size')
+
+  def __init__(self, obj_id, parent_id, obj_class, obj_date, obj_name,
+               obj_size, obj_subtype, obj_type, uploaded_size=0,
+               duplicate_of=None, created=None, allocated_size=0):
+    self.allocated_size = allocated_size
+    self.created = created or time.time()
+    self.duplicate_of = duplicate_of
+    self.obj_class = obj_class
+    self.obj_date = obj_date
+    self.obj_id = obj_id
+    self.obj_name = obj_name
+    self.obj_size = obj_size
+    self.obj_subtype = obj_subtype
+    self.obj_type = obj_type
+    self.parent_id = parent_id
+    self.uploaded_size = uploaded_size
+
+  @classmethod
+  def FromDict(cls, obj_dict):
+    """Create a BackupObject from a dict made by ToDict.
+
+    Args:
+      obj_dict: A dict containing the object's fields
+
+    Returns:
+      A BackupObject
+    """
+    return cls(**dict((str(k), v) for k, v in obj_dict.iteritems()))
+
+  def Key(self):
+    """Get the key which identifies the same object across CreateObjects.
+
+    Returns:
+      A tuple containing the object name, date and size
+    """
+    return (self.obj_name, self.obj_date, self.obj_size)
+
+  def PendingSize(self):
+    """Get the number of bytes the object still has to take up on disk.
+
+    Bytes which have been uploaded or preallocated already count against
+    the free space of the disk, so they are not included.
+
+    Returns:
+      An int containing the object size less the bytes already on disk, or
+      0 if it is a duplicate
+    """
+    if self.duplicate_of or not self.obj_size:
+      return 0
+    on_disk = max(self.uploaded_size or 0, self.allocated_size or 0)
+    return max(int(self.obj_size) - on_disk, 0)
+
+  def ToDict(self):
+    """Get the object's fields as a dict.
+
+    Returns:
+      A dict containing the object's fields
+    """
+    return dict((k, getattr(self, k)) for k in self.__slots__)
+
+
+class ObjectRegistry(object):
+  """Pending backup objects, by object id.
+
+  Objects are forgotten ttl seconds after they were created, and the oldest
+  object is dropped when max_objects are pending. An object which is being
+  written, see AddWriter, is never forgotten; it is only dropped once its
+  writer is gone, so an upload in progress never loses its partial file.
+
+  If a journal file is given every change is recorded in it, and it is
+  replayed on startup so pending objects survive a restart. Changes are
+  collected in memory and written by Flush, which can be called from another
+  thread so the journal is never written from the reactor. Changes since the
+  last Flush are lost if the process dies.
+
+  pending_size holds the number of bytes the pending objects still have to
+  take up on disk: their announced size less what has already been uploaded
+  or preallocated.
+  """
+
+  def __init__(self, max_objects=10000, ttl=86400, journal_file=None,
+               evict_callback=None):
+    self.logger = logging.getLogger('pc_autobackup.registry')
+    self.evict_callback = evict_callback
+    self.journal_file = journal_file
+    self.max_objects = max_objects
+    self.pending_size = 0
+    self.ttl = ttl
+
+    self._journal = None
+    self._journal_entries = 0
+    self._keys = {}
+    self._objects = collections.OrderedDict()
+    self._writers = collections.Counter()
+
+    # Changes waiting for Flush. If _rewrite is set they are the whole
+    # journal, which replaces the file.
+    self._flush_lock = threading.Lock()
+    self._lock = threading.Lock()
+    self._rewrite = False
+    self._unflushed = []
+
+    if journal_file:
+      self._LoadJournal()
+
+  def __contains__(self, obj_id):
+    return self.Get(obj_id) is not None
+
+  def __len__(self):
+    return len(self._objects)
+
+  @property
+  def unflushed(self):
+    """The number of changes waiting to be written to the journal."""
+    return len(self._unflushed)
+
+  def _Append(self, entry):
+    if not self.journal_file:
+      return
+    with self._lock:
+      self._unflushed.append(entry)
+    self._journal_entries += 1
+
+    if self._journal_entries > 2 * len(self._objects) + 1000:
+      self._CompactJournal()
+
+  def _CompactJournal(self):
+    entries = [{'add': obj.ToDict()} for obj in self._objects.itervalues()]
+    with self._lock:
+      self._unflushed = entries
+      self._rewrite = True
+    self._journal_entries = len(entries)
+
+  def _Evict(self, obj_id, reason):
+    obj = self._Pop(obj_id)
+    self.logger.info('Forgetting %s (%s), %s', obj.obj_name, obj_id, reason)
+    self._Append({'del': obj_id})
+    if self.evict_callback:
+      self.evict_callback(obj)
+
+  def _Insert(self, obj):
+    self._objects[obj.obj_id] = obj
+    self._keys[obj.Key()] = obj.obj_id
+    self.pending_size += obj.PendingSize()
+
+  def _LoadJournal(self):
+    journal_dir = os.path.dirname(self.journal_file)
+    if journal_dir and not os.path.isdir(journal_dir):
+      os.makedirs(journal_dir)
+
+    if os.path.isfile(self.journal_file):
+      with open(self.journal_file, 'rb') as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            # A crash can leave a partly written last line behind.
+            continue
+          if 'add' in entry:
+            obj = BackupObject.FromDict(entry['add'])
+            # The amount of data on disk is not journaled, it has to be
+            # looked up again before the object is resumed.
+            obj.allocated_size = 0
+            if not obj.duplicate_of:
+              obj.uploaded_size = None
+            self._Insert(obj)
+          elif 'del' in entry and entry['del'] in self._objects:
+            self._Pop(entry['del'])
+
+      self.logger.info('Loaded %d pending objects from %s',
+                       len(self._objects), self.journal_file)
+
+    self._CompactJournal()
+    self.Flush()
+    self.Expire()
+
+  def _Pop(self, obj_id):
+    obj = self._objects.pop(obj_id)
+    self._writers.pop(obj_id, None)
+    if self._keys.get(obj.Key()) == obj_id:
+      del self._keys[obj.Key()]
+    self.pending_size -= obj.PendingSize()
+    return obj
+
+  def _SetSize(self, obj_id, field, size):
+    obj = self._objects.get(obj_id)
+    if obj is None:
+      return
+    self.pending_size -= obj.PendingSize()
+    setattr(obj, field, size)
+    self.pending_size += obj.PendingSize()
+
+  def Add(self, obj):
+    """Add a pending object.
+
+    Args:
+      obj: A BackupObject
+    """
+    self.Expire()
+    while len(self._objects) >= self.max_objects:
+      idle = next((obj_id for obj_id in self._objects
+                   if not self._writers[obj_id]), None)
+      if idle is None:
+        self.logger.warning('All %d pending objects are being uploaded',
+                            len(self._objects))
+        break
+      self._Evict(idle, 'too many pending objects')
+
+    self._Insert(obj)
+    self._Append({'add': obj.ToDict()})
+
+  def AddWriter(self, obj_id):
+    """Record that an object is being written, so it is not forgotten.
+
+    Args:
+      obj_id: A string containing the object id
+    """
+    if obj_id in self._objects:
+      self._writers[obj_id] += 1
+
+  def Close(self):
+    """Write any unflushed changes and close the journal."""
+    self.Flush()
+    with self._flush_lock:
+      if self._journal:
+        self._journal.close()
+        self._journal = None
+
+  def Expire(self):
+    """Forget objects which are older than the ttl and not being written."""
+    expired = time.time() - self.ttl
+    evict = []
+    for obj_id, obj in self._objects.iteritems():
+      if obj.created > expired:
+        break
+      if not self._writers[obj_id]:
+        evict.append(obj_id)
+    for obj_id in evict:
+      self._Evict(obj_id, 'expired')
+
+  def Find(self, obj_name, obj_date, obj_size):
+    """Find a pending object by its name, date and size.
+
+    Args:
+      obj_name: A string containing the object name
+      obj_date: A string containing the object date
+      obj_size: A string containing the object size
+
+    Returns:
+      A BackupObject or None if no such object is pending
+    """
+    obj_id = self._keys.get((obj_name, obj_date, obj_size))
+    if obj_id:
+      return self.Get(obj_id)
+
+  def Flush(self):
+    """Write the changes made since the last Flush to the journal.
+
+    Safe to call from any thread.
+    """
+    with self._flush_lock:
+      with self._lock:
+        entries, self._unflushed = self._unflushed, []
+        rewrite, self._rewrite = self._rewrite, False
+      if not entries and not rewrite:
+        return
+
+      if rewrite:
+        if self._journal:
+          self._journal.close()
+        tmp_file = '%s.tmp' % self.journal_file
+        with open(tmp_file, 'wb') as f:
+          for entry in entries:
+            f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        os.rename(tmp_file, self.journal_file)
+        self._journal = open(self.journal_file, 'ab')
+      elif self._journal:
+        self._journal.write(''.join(
+            json.dumps(entry, separators=(',', ':')) + '\n'
+            for entry in entries))
+        self._journal.flush()
+
+  def Get(self, obj_id):
+    """Get a pending object.
+
+    Args:
+      obj_id: A string containing the object id
+
+    Returns:
+      A BackupObject or None if the object is not pending
+    """
+    obj = self._objects.get(obj_id)
+    if (obj and obj.created <= time.time() - self.ttl and
+        not self._writers[obj_id]):
+      self._Evict(obj_id, 'expired')
+      return None
+    return obj
+
+  def Remove(self, obj_id):
+    """Remove a pending object once it has been saved.
+
+    Args:
+      obj_id: A string containing the object id
+    """
+    if obj_id in self._objects:
+      self._Pop(obj_id)
+      self._Append({'del': obj_id})
+
+  def RemoveWriter(self, obj_id):
+    """Record that an object is no longer being written.
+
+    Args:
+      obj_id: A string containing the object id
+    """
+    if self._writers[obj_id] > 1:
+      self._writers[obj_id] -= 1
+    else:
+      self._writers.pop(obj_id, None)
+
+  def SetAllocatedSize(self, obj_id, allocated_size):
+    """Record how much space has been preallocated for an object.
+
+    Args:
+      obj_id: A string containing the object id
+      allocated_size: An int containing the number of bytes allocated
+    """
+    self._SetSize(obj_id, 'allocated_size', allocated_size)
+
+  def SetUploadedSize(self, obj_id, uploaded_size):
+    """Record how much of an object is on disk.
+
+    Args:
+      obj_id: A string containing the object id
+      uploaded_size: An int containing the number of bytes on disk, or None
+        if it is not known
+    """
+    self._SetSize(obj_id, 'uploaded_size', uploaded_size)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the registry of pending backup objects
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import registry
+
+
+def MakeObject(obj_id, obj_size='1000', **kwargs):
+  return registry.BackupObject(obj_id, 'UP_2012-01-01', 'object.item',
+                               '2012-01-01', '%s.JPG' % obj_id, obj_size,
+                               'jpeg', 'image/jpeg', **kwargs)
+
+
+class ObjectRegistryTest(unittest.TestCase):
+
+  def testPendingSizeExcludesBytesOnDisk(self):
+    objects = registry.ObjectRegistry()
+    objects.Add(MakeObject('a'))
+    objects.Add(MakeObject('b'))
+    objects.Add(MakeObject('dup', duplicate_of='/backup/dup.JPG'))
+    self.assertEqual(2000, objects.pending_size)
+
+    objects.SetAllocatedSize('a', 1000)
+    self.assertEqual(1000, objects.pending_size)
+    objects.SetUploadedSize('a', 400)
+    self.assertEqual(1000, objects.pending_size)
+    objects.SetUploadedSize('b', 250)
+    self.assertEqual(750, objects.pending_size)
+    objects.SetUploadedSize('b', None)
+    self.assertEqual(1000, objects.pending_size)
+
+    objects.Remove('a')
+    objects.Remove('b')
+    objects.Remove('dup')
+    self.assertEqual(0, objects.pending_size)
+
+  def testFind(self):
+    objects = registry.ObjectRegistry()
+    a = MakeObject('a')
+    objects.Add(a)
+    self.assertIs(a, objects.Find('a.JPG', '2012-01-01', '1000'))
+    self.assertIsNone(objects.Find('a.JPG', '2012-01-01', '1001'))
+
+    objects.Remove('a')
+    self.assertIsNone(objects.Find('a.JPG', '2012-01-01', '1000'))
+
+  def testFullRegistryKeepsObjectsBeingWritten(self):
+    evicted = []
+    objects = registry.ObjectRegistry(
+        max_objects=2, evict_callback=lambda obj: evicted.append(obj.obj_id))
+    objects.Add(MakeObject('a'))
+    objects.Add(MakeObject('b'))
+    objects.AddWriter('a')
+    objects.Add(MakeObject('c'))
+    self.assertEqual(['b'], evicted)
+    self.assertIn('a', objects)
+
+    # Nothing can be evicted while every object is being written.
+    objects.AddWriter('c')
+    objects.Add(MakeObject('d'))
+    self.assertEqual(['b'], evicted)
+    self.assertEqual(3, len(objects))
+
+  def testExpireKeepsObjectsBeingWritten(self):
+    evicted = []
+    objects = registry.ObjectRegistry(
+        ttl=10, evict_callback=lambda obj: evicted.append(obj.obj_id))
+    a = MakeObject('a')
+    b = MakeObject('b')
+    objects.Add(a)
+    objects.Add(b)
+    objects.AddWriter('a')
+    objects.AddWriter('a')
+    a.created -= 20
+    b.created -= 20
+    objects.Expire()
+    self.assertEqual(['b'], evicted)
+    self.assertIsNotNone(objects.Get('a'))
+
+    objects.RemoveWriter('a')
+    objects.Expire()
+    self.assertEqual(['b'], evicted)
+    objects.RemoveWriter('a')
+    self.assertIsNone(objects.Get('a'))
+    self.assertEqual(['b', 'a'], evicted)
+
+
+class ObjectRegistryJournalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.state_dir = tempfile.mkdtemp()
+    self.journal_file = os.path.join(self.state_dir, 'objects.journal')
+
+  def tearDown(self):
+    shutil.rmtree(self.state_dir)
+
+  def ReadJournal(self):
+    with open(self.journal_file) as f:
+      return f.read().splitlines()
+
+  def testChangesAreWrittenByFlush(self):
+    objects = registry.ObjectRegistry(journal_file=self.journal_file)
+    objects.Add(MakeObject('a'))
+    objects.Add(MakeObject('b'))
+    objects.Remove('b')
+    self.assertEqual([], self.ReadJournal())
+    self.assertEqual(3, objects.unflushed)
+
+    objects.Flush()
+    self.assertEqual(3, len(self.ReadJournal()))
+    self.assertEqual(0, objects.unflushed)
+    objects.Close()
+
+    objects = registry.ObjectRegistry(journal_file=self.journal_file)
+    self.assertEqual(['a'], [obj.obj_id for obj in objects._objects.values()])
+    self.assertIsNone(objects.Get('a').uploaded_size)
+    objects.Close()
+
+  def testCloseFlushes(self):
+    objects = registry.ObjectRegistry(journal_file=self.journal_file)
+    objects.Add(MakeObject('a'))
+    objects.Close()
+    self.assertEqual(1, len(self.ReadJournal()))
+
+  def testJournalIsCompacted(self):
+    objects = registry.ObjectRegistry(journal_file=self.journal_file)
+    objects.Add(MakeObject('kept'))
+    for i in xrange(600):
+      objects.Add(MakeObject('obj%d' % i))
+      objects.Remove('obj%d' % i)
+    objects.Flush()
+    self.assertLess(len(self.ReadJournal()), 1001)
+    objects.Close()
+
+    objects = registry.ObjectRegistry(journal_file=self.journal_file)
+    self.assertEqual(['kept'],
+                     [obj.obj_id for obj in objects._objects.values()])
+    objects.Close()
+
+  def testPartlyWrittenLastLineIsIgnored(self):
+    objects = registry.ObjectRegistry(journal_file=self.journal_file)
+    objects.Add(MakeObject('a'))
+    objects.Close()
+    with open(self.journal_file, 'ab') as f:
+      f.write('{"add":{"obj_id":"b"')
+
+    objects = registry.ObjectRegistry(journal_file=self.journal_file)
+    self.assertEqual(['a'], [obj.obj_id for obj in objects._objects.values()])
+    self.assertEqual(1, len(self.ReadJournal()))
+    objects.Close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Camera backup sessions for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import collections
+import logging
+import time
+
+
+class BackupSession(object):
+  """A camera's backup run, from X_BACKUP_START to X_BACKUP_DONE."""
+
+  def __init__(self, client_ip, user_agent=None):
+    self.bytes_received = 0
+    self.client_ip = client_ip
+    self.finished = None
+    self.last_seen = time.time()
+    self.objects_created = 0
+    self.objects_saved = 0
+    self.started = self.last_seen
+    self.session_id = '%s-%s' % (
+        time.strftime('%Y%m%d%H%M%S', time.localtime(self.started)), client_ip)
+    self.user_agent = user_agent
+
+  def __str__(self):
+    return '%s (%s)' % (self.client_ip, self.user_agent)
+
+  def Duration(self):
+    """Get how long the session has been running.
+
+    Returns:
+      A float containing the duration in seconds
+    """
+    return (self.finished or time.time()) - self.started
+
+  def ObjectSaved(self, size):
+    """Record an object received in this session.
+
+    Args:
+      size: An int containing the number of bytes received
+    """
+    self.bytes_received += size
+    self.objects_saved += 1
+    self.Touch()
+
+  def Throughput(self):
+    """Get the average upload speed of the session.
+
+    Returns:
+      A float containing the throughput in bytes per second
+    """
+    duration = self.Duration()
+    if duration <= 0:
+      return 0.0
+    return self.bytes_received / duration
+
+  def Touch(self):
+    """Record that the camera is still backing up, e.g. sending an object."""
+    self.last_seen = time.time()
+
+
+class SessionManager(object):
+  """Backup sessions of the cameras currently backing up, by client IP.
+
+  At most max_sessions cameras can back up at once. A session which has not
+  been used for idle_timeout seconds is dropped by ExpireIdle, so a camera
+  which goes away without sending X_BACKUP_DONE doesn't hold on to its slot.
+
+  end_callback is called with every session which ends, whether it finished
+  or was dropped.
+  """
+
+  max_clients = 100
+
+  def __init__(self, max_sessions=5, idle_timeout=600, end_callback=None):
+    self.logger = logging.getLogger('pc_autobackup.session')
+    self.end_callback = end_callback
+    self.idle_timeout = idle_timeout
+    self.max_sessions = max_sessions
+
+    self._sessions = collections.OrderedDict()
+    self._user_agents = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._sessions)
+
+  def _End(self, session):
+    session.finished = time.time()
+    if self.end_callback:
+      self.end_callback(session)
+
+  def ExpireIdle(self):
+    """Drop sessions which have been idle for longer than idle_timeout."""
+    idle = time.time() - self.idle_timeout
+    for client_ip, session in self._sessions.items():
+      if session.last_seen < idle:
+        self.logger.warning('Dropping idle backup session for %s', session)
+        del self._sessions[client_ip]
+        self._End(session)
+
+  def Finish(self, client_ip):
+    """Finish a client's backup session.
+
+    Args:
+      client_ip: A string containing the client's IP address
+
+    Returns:
+      The finished BackupSession or None if the client had no session
+    """
+    session = self._sessions.pop(client_ip, None)
+    if session:
+      self._End(session)
+    return session
+
+  def FinishAll(self):
+    """Finish every session, e.g. when the server shuts down."""
+    for client_ip in self._sessions.keys():
+      self.Finish(client_ip)
+
+  def Get(self, client_ip):
+    """Get a client's backup session and mark it as active.
+
+    Args:
+      client_ip: A string containing the client's IP address
+
+    Returns:
+      A BackupSession or None if the client has no session
+    """
+    session = self._sessions.get(client_ip)
+    if session:
+      session.Touch()
+    return session
+
+  def GetUserAgent(self, client_ip):
+    """Get the user agent a client last announced itself with.
+
+    Args:
+      client_ip: A string containing the client's IP address
+
+    Returns:
+      A string containing the user agent or None
+    """
+    return self._user_agents.get(client_ip)
+
+  def SetUserAgent(self, client_ip, user_agent):
+    """Remember the user agent of a client.
+
+    Args:
+      client_ip: A string containing the client's IP address
+      user_agent: A string containing the client's user agent
+    """
+    self._user_agents.pop(client_ip, None)
+    self._user_agents[client_ip] = user_agent
+    while len(self._user_agents) > self.max_clients:
+      self._user_agents.popitem(last=False)
+
+  def Start(self, client_ip):
+    """Start a backup session for a client.
+
+    A client which already has a session gets a new one.
+
+    Args:
+      client_ip: A string containing the client's IP address
+
+    Returns:
+      A BackupSession or None if too many sessions are running
+    """
+    self.ExpireIdle()
+    self.Finish(client_ip)
+    if len(self._sessions) >= self.max_sessions:
+      return None
+
+    session = BackupSession(client_ip, self.GetUserAgent(client_ip))
+    self._sessions[client_ip] = session
+    return session
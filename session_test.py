@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the camera backup sessions
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import time
+import unittest
+
+import session
+
+
+class BackupSessionTest(unittest.TestCase):
+
+  def testObjectSaved(self):
+    backup_session = session.BackupSession('192.168.1.10', 'camera')
+    backup_session.last_seen -= 100
+    backup_session.started -= 10
+    backup_session.ObjectSaved(1000)
+    backup_session.ObjectSaved(500)
+    self.assertEqual(2, backup_session.objects_saved)
+    self.assertEqual(1500, backup_session.bytes_received)
+    self.assertAlmostEqual(time.time(), backup_session.last_seen, delta=1)
+    self.assertAlmostEqual(150, backup_session.Throughput(), delta=5)
+
+  def testDurationStopsWhenFinished(self):
+    backup_session = session.BackupSession('192.168.1.10')
+    backup_session.finished = backup_session.started + 5
+    self.assertEqual(5, backup_session.Duration())
+
+
+class SessionManagerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.ended = []
+    self.sessions = session.SessionManager(max_sessions=2, idle_timeout=60,
+                                           end_callback=self.ended.append)
+
+  def testMaxSessions(self):
+    self.assertIsNotNone(self.sessions.Start('192.168.1.10'))
+    self.assertIsNotNone(self.sessions.Start('192.168.1.11'))
+    self.assertIsNone(self.sessions.Start('192.168.1.12'))
+    # A camera which starts again gets a new session in its old slot.
+    first = self.sessions.Get('192.168.1.10')
+    self.assertIsNotNone(self.sessions.Start('192.168.1.10'))
+    self.assertEqual([first], self.ended)
+    self.assertEqual(2, len(self.sessions))
+
+  def testFinish(self):
+    self.sessions.SetUserAgent('192.168.1.10', 'camera')
+    backup_session = self.sessions.Start('192.168.1.10')
+    self.assertEqual('camera', backup_session.user_agent)
+    self.assertIs(backup_session, self.sessions.Finish('192.168.1.10'))
+    self.assertIsNotNone(backup_session.finished)
+    self.assertEqual([backup_session], self.ended)
+    self.assertIsNone(self.sessions.Finish('192.168.1.10'))
+    self.assertIsNone(self.sessions.Get('192.168.1.10'))
+
+  def testFinishAll(self):
+    self.sessions.Start('192.168.1.10')
+    self.sessions.Start('192.168.1.11')
+    self.sessions.FinishAll()
+    self.assertEqual(0, len(self.sessions))
+    self.assertEqual(2, len(self.ended))
+
+  def testExpireIdle(self):
+    idle = self.sessions.Start('192.168.1.10')
+    active = self.sessions.Start('192.168.1.11')
+    idle.last_seen -= 61
+    active.last_seen -= 61
+    active.Touch()
+    self.sessions.ExpireIdle()
+    self.assertEqual([idle], self.ended)
+    self.assertIsNone(self.sessions.Get('192.168.1.10'))
+
+    # Getting a session keeps it active.
+    active.last_seen -= 61
+    self.assertIs(active, self.sessions.Get('192.168.1.11'))
+    self.sessions.ExpireIdle()
+    self.assertEqual([idle], self.ended)
+
+  def testUserAgents(self):
+    self.sessions.max_clients = 2
+    self.sessions.SetUserAgent('192.168.1.10', 'a')
+    self.sessions.SetUserAgent('192.168.1.11', 'b')
+    self.sessions.SetUserAgent('192.168.1.10', 'c')
+    self.sessions.SetUserAgent('192.168.1.12', 'd')
+    self.assertEqual('c', self.sessions.GetUserAgent('192.168.1.10'))
+    self.assertIsNone(self.sessions.GetUserAgent('192.168.1.11'))
+    self.assertEqual('d', self.sessions.GetUserAgent('192.168.1.12'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -7,14 +7,45 @@ __author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
 
 import ConfigParser
 import logging
+import random
 import re
 import socket
+import time
 
 from twisted.internet import reactor
 from twisted.internet.protocol import DatagramProtocol
+from twisted.internet.task import LoopingCall
 
 import common
-
+import metrics
+
+HOST_ADDRESS_CACHE_SIZE = 1024
+HOST_ADDRESS_TTL = 300
+INTERFACE_CHECK_INTERVAL = 30
+
+MAX_AGE = 1800
+# Announce a few times per max-age so a lost packet doesn't make cameras
+# forget about us, delayed by up to ANNOUNCE_JITTER of the interval so
+# servers started together don't all announce at once.
+ANNOUNCE_INTERVAL = MAX_AGE / 3
+ANNOUNCE_JITTER = 0.1
+
+# Replies are delayed by a random part of the MX seconds a search allows, but
+# never by more than MAX_MX, so retransmitted searches can be merged.
+MAX_MX = 5
+# Each source may send MSEARCH_BURST searches at once, and MSEARCH_RATE per
+# second after that.
+MSEARCH_BURST = 10
+MSEARCH_RATE = 2.0
+
+MULTICAST_ADDRESS = ('239.255.255.250', 1900)
+NOTIFY_TYPES = ['upnp:rootdevice',
+                'uuid:%s',
+                'urn:schemas-upnp-org:device:MediaServer:1',
+                'urn:schemas-upnp-org:service:ContentDirectory:1',
+                'urn:schemas-upnp-org:service:ConnectionManager:1']
+
+MEDIASERVER_ST = 'urn:schemas-upnp-org:device:MediaServer:'
 MSEARCH = re.compile(r'^M-SEARCH \* HTTP/1.1', re.DOTALL)
 MSEARCH_DATA = re.compile(r'^([^:]+):\s+(.*)')
 
@@ -24,33 +55,133 @@ class SSDPServer(DatagramProtocol):
   def __init__(self, config_file=None):
     self.logger = logging.getLogger('pc_autobackup.ssdp')
     self.config = common.LoadOrCreateConfig(config_file)
+    self.interfaces = frozenset()
+
+    self._announcer = LoopingCall(self.ScheduleAnnouncement)
+    self._host_addresses = {}
+    self._interface_check = LoopingCall(self.CheckInterfaces)
+    self._msearch_tokens = {}
+    self._pending_replies = {}
+    self._probe = None
+    self._responses = {}
+    self._responses_mtime = None
+    self._responses_uuid = None
+
+    reactor.addSystemEventTrigger('before', 'shutdown', self.SendByebye)
 
   def startProtocol(self):
     self.transport.setTTL(5)
-    self.transport.joinGroup('239.255.255.250')
+    self.transport.joinGroup(MULTICAST_ADDRESS[0])
+    # The first interface check finds every interface as new and announces
+    # on them, so the announcer only has to repeat that.
+    self._interface_check.start(INTERFACE_CHECK_INTERVAL)
+    self._announcer.start(ANNOUNCE_INTERVAL, now=False)
+
+  def stopProtocol(self):
+    if self._announcer.running:
+      self._announcer.stop()
+    if self._interface_check.running:
+      self._interface_check.stop()
+    for delayed_call in self._pending_replies.itervalues():
+      delayed_call.cancel()
+    self._pending_replies.clear()
+    if self._probe:
+      self._probe.close()
+      self._probe = None
 
   def datagramReceived(self, datagram, address):
+    if self.config.has_option('AUTOBACKUP', 'default_interface'):
+      host_ip = self.GetHostAddress(address)[0]
+      if self.config.get('AUTOBACKUP', 'default_interface') != host_ip:
+        return
+
     m = MSEARCH.match(datagram)
     if m:
+      received = time.time()
+      metrics.SSDP_MSEARCH.Inc()
+
+      msearch_data = self.ParseSSDPDiscovery(datagram)
+      # Most searches on a busy network are for other kinds of devices, those
+      # don't count against the rate limit.
       # TODO(jrebeiro): Verify that MediaServer is the only discovery request
       #                 PCAutoBackup responds to.
-      msearch_data = self.ParseSSDPDiscovery(datagram)
-      address_info = ':'.join([str(x) for x in address])
-      if msearch_data.get('discovery_type'):
+      if not msearch_data.get('ST', '').startswith(MEDIASERVER_ST):
+        return
+
+      if not self.TakeMSearchToken(address[0], received):
+        metrics.SSDP_MSEARCH_DROPPED.Inc()
+        return
+
+      if self.logger.isEnabledFor(logging.DEBUG):
+        address_info = ':'.join([str(x) for x in address])
         self.logger.debug('Received SSDP M-SEARCH for %s from %s',
                           msearch_data.get('discovery_type'), address_info)
-      else:
-        self.logger.debug('Received SSDP M-SEARCH from %s', address_info)
+        self.logger.debug('Received SSDP M-SEARCH on interface %s',
+                          self.GetHostAddress(address)[0])
 
-      host_ip,host_port = self.GetHostAddress(address)
-      self.logger.debug('Received SSDP M-SEARCH on interface %s', host_ip)
+      self.ScheduleSSDPResponse(address, msearch_data, received)
 
-      if self.config.has_option('AUTOBACKUP', 'default_interface'):
-        if self.config.get('AUTOBACKUP', 'default_interface') != host_ip:
-          return
+  def Announce(self, nts='ssdp:alive', interfaces=None):
+    """Multicast NOTIFY packets for the server on the local interfaces.
 
-      if msearch_data.get('discovery_type') == 'MediaServer':
-        self.SendSSDPResponse(address)
+    Args:
+      nts: One of ssdp:alive or ssdp:byebye
+      interfaces: An iterable of interface addresses, all interfaces if None
+    """
+    if not self.transport:
+      return
+    if interfaces is None:
+      interfaces = self.interfaces
+
+    uuid = self.config.get('AUTOBACKUP', 'uuid')
+    if self.config.has_option('AUTOBACKUP', 'default_interface'):
+      default_interface = self.config.get('AUTOBACKUP', 'default_interface')
+      interfaces = [x for x in interfaces if x == default_interface]
+
+    sock = self.transport.getHandle()
+    for ip_address in sorted(interfaces):
+      if ip_address.startswith('127.'):
+        continue
+
+      self.logger.debug('Sending SSDP %s on interface %s', nts, ip_address)
+      try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                        socket.inet_aton(ip_address))
+        for nt in NOTIFY_TYPES:
+          if '%s' in nt:
+            nt %= uuid
+          usn = 'uuid:%s' % uuid
+          if nt != usn:
+            usn = '%s::%s' % (usn, nt)
+          response = self.GetSSDPResponse('notify', ip_address,
+                                          {'NT': nt, 'NTS': nts, 'USN': usn})
+          self.transport.write(response, MULTICAST_ADDRESS)
+      except socket.error as e:
+        self.logger.warning('Unable to send SSDP %s on interface %s: %s',
+                            nts, ip_address, e)
+
+  def CheckInterfaces(self):
+    """Check whether the local network interfaces have changed.
+
+    Cached host addresses are dropped when they have, and the server is
+    announced on new interfaces straight away.
+
+    Returns:
+      A frozenset containing the addresses of new interfaces
+    """
+    interfaces = common.GetLocalAddresses()
+    if interfaces == self.interfaces:
+      return frozenset()
+
+    added = interfaces - self.interfaces
+    if self.interfaces:
+      self.logger.info('Network interfaces changed: %s',
+                       ', '.join(sorted(interfaces)))
+    self.interfaces = interfaces
+    self._host_addresses.clear()
+    self._responses.clear()
+    self.Announce(interfaces=added)
+    return added
 
   def GenerateSSDPResponse(self, response_type, ip_address, uuid,
                            notify_fields={}):
@@ -68,7 +199,7 @@ class SSDPServer(DatagramProtocol):
     location = 'LOCATION: http://%s:52235/DMS/SamsungDmsDesc.xml' % ip_address
     if response_type == 'm-search':
       response = ['HTTP/1.1 200 OK',
-                  'CACHE-CONTROL: max-age = 1800',
+                  'CACHE-CONTROL: max-age = %d' % MAX_AGE,
                   'EXT:',
                   location,
                   'SERVER: MS-Windows/XP UPnP/1.0 PROTOTYPE/1.0',
@@ -76,8 +207,8 @@ class SSDPServer(DatagramProtocol):
                   'USN: uuid:%s::urn:schemas-upnp-org:device:MediaServer:1' % uuid]
     elif response_type == 'notify':
       response = ['NOTIFY * HTTP/1.1',
-                  'HOST: 239.255.255.250:1900',
-                  'CACHE-CONTROL: max-age=1800',
+                  'HOST: %s:%d' % MULTICAST_ADDRESS,
+                  'CACHE-CONTROL: max-age=%d' % MAX_AGE,
                   location,
                   'NT: %s' % notify_fields.get('NT', ''),
                   'NTS: %s' % notify_fields.get('NTS', ''),
@@ -89,6 +220,41 @@ class SSDPServer(DatagramProtocol):
     response.append('')
     return '\r\n'.join(response)
 
+  def GetSSDPResponse(self, response_type, ip_address, notify_fields={}):
+    """Get an SSDP response, generating it only the first time.
+
+    Responses are kept per interface address until the network interfaces
+    or the configured UUID change.
+
+    Args:
+      response_type: One of m-search or notify
+      ip_address: IP address to use for the response
+      notify_fields: A dictionary containing NT, NTS, and USN fields
+
+    Returns:
+      A string containing an SSDP response
+    """
+    # Reading an option costs more than generating the response, so the
+    # UUID is only read again when the configuration file has been loaded
+    # again.
+    self.config.ReloadIfChanged()
+    if (self._responses_uuid is None or
+        self.config.mtime != self._responses_mtime):
+      self._responses_mtime = self.config.mtime
+      uuid = self.config.get('AUTOBACKUP', 'uuid')
+      if uuid != self._responses_uuid:
+        self._responses.clear()
+        self._responses_uuid = uuid
+
+    key = (response_type, ip_address, notify_fields.get('NT'),
+           notify_fields.get('NTS'), notify_fields.get('USN'))
+    response = self._responses.get(key)
+    if response is None:
+      response = self.GenerateSSDPResponse(response_type, ip_address,
+                                           self._responses_uuid, notify_fields)
+      self._responses[key] = response
+    return response
+
   def ParseSSDPDiscovery(self, datagram):
     """Parse an SSDP UDP datagram.
 
@@ -115,35 +281,112 @@ class SSDPServer(DatagramProtocol):
 
     return parsed_data
 
-  def SendSSDPResponse(self, address):
-    """Send a response to an SSDP MediaServer discovery request.
+  def ScheduleAnnouncement(self):
+    """Announce the server after a random part of ANNOUNCE_JITTER."""
+    delay = random.uniform(0, ANNOUNCE_INTERVAL * ANNOUNCE_JITTER)
+    reactor.callLater(delay, self.Announce)
+
+  def ScheduleSSDPResponse(self, address, msearch_data, received=None):
+    """Schedule a response to an SSDP MediaServer discovery request.
+
+    The response is sent after a random delay within the request's MX.
+    Cameras send each search several times, so a search for the same ST
+    from the same address while a response is pending is merged into it.
+
+    Args:
+      address: A tuple of destination IP (string) and port (int)
+      msearch_data: A dict containing the parsed request
+      received: A float containing the time the request was received
+    """
+    key = (address, msearch_data.get('ST'))
+    if key in self._pending_replies:
+      self.logger.debug('Merging SSDP M-SEARCH from %s into pending response',
+                        ':'.join([str(x) for x in address]))
+      metrics.SSDP_MSEARCH_DROPPED.Inc()
+      return
+
+    try:
+      mx = min(max(int(msearch_data.get('MX', 1)), 0), MAX_MX)
+    except ValueError:
+      mx = 1
+
+    def Send():
+      del self._pending_replies[key]
+      self.SendSSDPResponse(address, received)
+
+    self._pending_replies[key] = reactor.callLater(random.uniform(0, mx), Send)
+
+  def SendByebye(self):
+    """Tell cameras the server is going away."""
+    self.Announce('ssdp:byebye')
+
+  def SendSSDPResponse(self, address, received=None):
+    """Send a response to an SSDP MediaServer discovery request now.
 
     Args:
       address: A tuple of destination IP (string) and port (int)
+      received: A float containing the time the request was received
     """
-    host_ip,host_port = self.GetHostAddress(address)
-    response = self.GenerateSSDPResponse('m-search',
-                                         host_ip,
-                                         self.config.get('AUTOBACKUP', 'uuid'))
+    host_ip = self.GetHostAddress(address)[0]
+    response = self.GetSSDPResponse('m-search', host_ip)
 
     address_info = ':'.join([str(x) for x in address])
     self.logger.info('Sending SSDP response to %s', address_info)
     self.logger.debug('Sending SSDP response to %s: %r', address_info,
                       response)
     self.transport.write(response, address)
+    if received:
+      metrics.SSDP_REPLY_SECONDS.Observe(time.time() - received)
+
+  def TakeMSearchToken(self, source_ip, now):
+    """Check whether a source is within its M-SEARCH rate limit.
+
+    Args:
+      source_ip: A string containing the IP address the search came from
+      now: A float containing the time the search was received
+
+    Returns:
+      True if the search should be handled, False if it should be dropped
+    """
+    (tokens, last) = self._msearch_tokens.get(source_ip, (MSEARCH_BURST, now))
+    tokens = min(MSEARCH_BURST, tokens + (now - last) * MSEARCH_RATE)
+    if tokens < 1:
+      self._msearch_tokens[source_ip] = (tokens, now)
+      return False
+
+    if (source_ip not in self._msearch_tokens and
+        len(self._msearch_tokens) >= HOST_ADDRESS_CACHE_SIZE):
+      self._msearch_tokens.clear()
+    self._msearch_tokens[source_ip] = (tokens - 1, now)
+    return True
 
   def GetHostAddress(self, address):
     """Get host address used when communicating with given udp address.
 
+    The route lookup is done by connecting a UDP probe socket, which sends
+    nothing. Results are cached per peer for HOST_ADDRESS_TTL seconds, or
+    until the network interfaces change.
+
     Args:
       address: A tuple of destination IP (string) and port (int)
 
     Returns:
       A tuple of host IP (string) and port (int)
     """
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.connect(address)
-    return s.getsockname()
+    now = time.time()
+    cached = self._host_addresses.get(address[0])
+    if cached and cached[1] > now:
+      return cached[0]
+
+    if self._probe is None:
+      self._probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self._probe.connect(address)
+    host_address = self._probe.getsockname()
+
+    if len(self._host_addresses) >= HOST_ADDRESS_CACHE_SIZE:
+      self._host_addresses.clear()
+    self._host_addresses[address[0]] = (host_address, now + HOST_ADDRESS_TTL)
+    return host_address
 
 def StartSSDPServer():
   """Start an SSDP server.
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the SSDP server
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import task
+
+import common
+import ssdp
+
+
+class FakeSocket(object):
+  """A UDP socket which records what is done with it."""
+
+  def __init__(self, host_ip='192.168.1.2'):
+    self.connected = []
+    self.host_ip = host_ip
+    self.options = []
+
+  def close(self):
+    pass
+
+  def connect(self, address):
+    self.connected.append(address)
+
+  def getsockname(self):
+    return (self.host_ip, 50000)
+
+  def setsockopt(self, level, option, value):
+    self.options.append((level, option, value))
+
+
+class FakeTransport(object):
+  """A datagram transport which records the packets sent."""
+
+  def __init__(self):
+    self.handle = FakeSocket()
+    self.written = []
+
+  def getHandle(self):
+    return self.handle
+
+  def write(self, data, address):
+    self.written.append((data, address))
+
+
+def MSearch(st, mx=2, **headers):
+  """Make an M-SEARCH datagram.
+
+  Args:
+    st: A string containing the search target
+    mx: An int containing the most seconds a reply may be delayed by
+    **headers: Any other headers to send
+
+  Returns:
+    A string
+  """
+  lines = ['M-SEARCH * HTTP/1.1',
+           'HOST: 239.255.255.250:1900',
+           'MAN: "ssdp:discover"',
+           'MX: %d' % mx,
+           'ST: %s' % st]
+  lines.extend('%s: %s' % header for header in sorted(headers.iteritems()))
+  return '\r\n'.join(lines + ['', ''])
+
+
+class SSDPServerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.config_file = os.path.join(self.tmp_dir, 'pc_autobackup.cfg')
+    self.server = ssdp.SSDPServer(self.config_file)
+    # Replies and announcements are scheduled on a clock the test controls.
+    self.clock = task.Clock()
+    self.reactor = ssdp.reactor
+    ssdp.reactor = self.clock
+    self.server.transport = FakeTransport()
+    self.server._probe = FakeSocket()
+
+  def tearDown(self):
+    ssdp.reactor = self.reactor
+    shutil.rmtree(self.tmp_dir)
+
+  def testAnnounce(self):
+    self.server.interfaces = frozenset(['127.0.0.1', '192.168.1.2'])
+    self.server.Announce()
+    written = self.server.transport.written
+    self.assertEqual(len(ssdp.NOTIFY_TYPES), len(written))
+    for (notify, sent_to) in written:
+      self.assertEqual(ssdp.MULTICAST_ADDRESS, sent_to)
+      self.assertTrue(notify.startswith('NOTIFY * HTTP/1.1\r\n'))
+      self.assertIn('NTS: ssdp:alive\r\n', notify)
+      self.assertIn('LOCATION: http://192.168.1.2:52235/', notify)
+    uuid = common.LoadOrCreateConfig(self.config_file).get('AUTOBACKUP',
+                                                           'uuid')
+    self.assertIn('USN: uuid:%s\r\n' % uuid, written[1][0])
+    self.assertIn('USN: uuid:%s::upnp:rootdevice\r\n' % uuid, written[0][0])
+
+    self.server.transport.written = []
+    self.server.SendByebye()
+    self.assertEqual(len(ssdp.NOTIFY_TYPES),
+                     len(self.server.transport.written))
+    self.assertIn('NTS: ssdp:byebye\r\n',
+                  self.server.transport.written[0][0])
+
+  def testScheduleAnnouncement(self):
+    self.server.interfaces = frozenset(['192.168.1.2'])
+    self.server.ScheduleAnnouncement()
+    self.assertEqual([], self.server.transport.written)
+    self.clock.advance(ssdp.ANNOUNCE_INTERVAL * ssdp.ANNOUNCE_JITTER)
+    self.assertEqual(len(ssdp.NOTIFY_TYPES),
+                     len(self.server.transport.written))
+
+  def testHostAddressIsCached(self):
+    address = ('192.168.1.10', 1900)
+    self.assertEqual(('192.168.1.2', 50000),
+                     self.server.GetHostAddress(address))
+    self.assertEqual(('192.168.1.2', 50000),
+                     self.server.GetHostAddress(('192.168.1.10', 1901)))
+    self.assertEqual([address], self.server._probe.connected)
+
+    # Cached addresses expire.
+    self.server._host_addresses['192.168.1.10'] = (('192.168.1.3', 50000), 0)
+    self.assertEqual(('192.168.1.2', 50000),
+                     self.server.GetHostAddress(address))
+    self.assertEqual(2, len(self.server._probe.connected))
+
+  def testInterfaceChangeDropsHostAddresses(self):
+    get_local_addresses = common.GetLocalAddresses
+    interfaces = [frozenset(['192.168.1.2'])]
+    common.GetLocalAddresses = lambda: interfaces[0]
+    try:
+      self.assertEqual(frozenset(['192.168.1.2']),
+                       self.server.CheckInterfaces())
+      self.server.GetHostAddress(('192.168.1.10', 1900))
+      self.assertEqual(frozenset(), self.server.CheckInterfaces())
+      self.assertEqual(1, len(self.server._host_addresses))
+
+      interfaces[0] = frozenset(['192.168.1.2', '10.0.0.2'])
+      self.assertEqual(frozenset(['10.0.0.2']), self.server.CheckInterfaces())
+      self.assertEqual({}, self.server._host_addresses)
+    finally:
+      common.GetLocalAddresses = get_local_addresses
+
+  def testMediaServerSearch(self):
+    address = ('192.168.1.10', 1900)
+    self.server.datagramReceived(
+        MSearch('urn:schemas-upnp-org:device:MediaServer:1', mx=0), address)
+    self.clock.advance(0)
+    self.assertEqual(1, len(self.server.transport.written))
+    (response, sent_to) = self.server.transport.written[0]
+    self.assertEqual(address, sent_to)
+    self.assertTrue(response.startswith('HTTP/1.1 200 OK\r\n'))
+    self.assertIn('LOCATION: http://192.168.1.2:52235/', response)
+
+  def testRepeatedSearchesAreMerged(self):
+    address = ('192.168.1.10', 1900)
+    for i in xrange(3):
+      self.server.datagramReceived(
+          MSearch('urn:schemas-upnp-org:device:MediaServer:1', mx=2),
+          address)
+    self.server.datagramReceived(
+        MSearch('urn:schemas-upnp-org:device:MediaServer:1', mx=2),
+        ('192.168.1.11', 1900))
+    self.assertEqual([], self.server.transport.written)
+
+    # Replies are sent within MX.
+    self.clock.advance(2)
+    self.assertEqual([address, ('192.168.1.11', 1900)],
+                     sorted(sent_to for (response, sent_to)
+                            in self.server.transport.written))
+    self.assertEqual({}, self.server._pending_replies)
+
+  def testMXIsCapped(self):
+    self.server.datagramReceived(
+        MSearch('urn:schemas-upnp-org:device:MediaServer:1', mx=120),
+        ('192.168.1.10', 1900))
+    self.clock.advance(ssdp.MAX_MX)
+    self.assertEqual(1, len(self.server.transport.written))
+
+  def testRateLimit(self):
+    for i in xrange(ssdp.MSEARCH_BURST):
+      self.assertTrue(self.server.TakeMSearchToken('192.168.1.10', 100))
+    self.assertFalse(self.server.TakeMSearchToken('192.168.1.10', 100))
+    self.assertTrue(self.server.TakeMSearchToken('192.168.1.11', 100))
+    # Tokens come back at MSEARCH_RATE per second.
+    self.assertFalse(self.server.TakeMSearchToken(
+        '192.168.1.10', 100 + 0.5 / ssdp.MSEARCH_RATE))
+    self.assertTrue(self.server.TakeMSearchToken(
+        '192.168.1.10', 100 + 1.5 / ssdp.MSEARCH_RATE))
+    self.assertFalse(self.server.TakeMSearchToken(
+        '192.168.1.10', 100 + 1.5 / ssdp.MSEARCH_RATE))
+
+  def testOtherSearchesAreIgnored(self):
+    # Only the ST header says what is searched for.
+    self.server.datagramReceived(
+        MSearch('urn:schemas-upnp-org:device:InternetGatewayDevice:1',
+                **{'USER-AGENT': 'urn:schemas-upnp-org:device:MediaServer:1'}),
+        ('192.168.1.10', 1900))
+    self.clock.advance(ssdp.MAX_MX)
+    self.assertEqual([], self.server.transport.written)
+    self.assertEqual({}, self.server._msearch_tokens)
+
+  def testResponsesAreCached(self):
+    response = self.server.GetSSDPResponse('m-search', '192.168.1.2')
+    self.assertIs(response,
+                  self.server.GetSSDPResponse('m-search', '192.168.1.2'))
+    self.assertIsNot(response,
+                     self.server.GetSSDPResponse('m-search', '10.0.0.2'))
+
+    config = common.LoadOrCreateConfig(self.config_file)
+    uuid = config.get('AUTOBACKUP', 'uuid')
+    self.assertIn(uuid, response)
+    config.set('AUTOBACKUP', 'uuid', 'new-uuid')
+    config.Save()
+    self.assertIn('new-uuid',
+                  self.server.GetSSDPResponse('m-search', '192.168.1.2'))
+
+
+if __name__ == '__main__':
+  unittest.main()
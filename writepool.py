@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Disk writer thread pool for PC Autobackup
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import collections
+import logging
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python.threadpool import ThreadPool
+
+
+class WritePool(object):
+  """A pool of threads which performs blocking disk I/O off the reactor.
+
+  Work submitted to the pool runs in one of a fixed number of threads and the
+  result is delivered back on the reactor thread through a Deferred.
+
+  Work can be submitted on behalf of a client. When more work is waiting than
+  there are threads, clients take turns, so a camera sending many objects
+  can't hold up the disk for everyone else.
+  """
+
+  def __init__(self, threads=4):
+    self.logger = logging.getLogger('pc_autobackup.writepool')
+    self.queued = 0
+    self.running = 0
+    self.threads = threads
+    self.threadpool = ThreadPool(minthreads=1, maxthreads=threads,
+                                 name='pc_autobackup.writepool')
+
+    self._queues = collections.OrderedDict()
+
+    reactor.callWhenRunning(self.Start)
+    reactor.addSystemEventTrigger('during', 'shutdown', self.Stop)
+
+  def _Dispatch(self):
+    while self._queues and self.running < self.threads:
+      # Take the next job of the client at the front, then move that client
+      # to the back of the line.
+      (client, queue) = self._queues.popitem(last=False)
+      (d, func, args, kwargs) = queue.popleft()
+      if queue:
+        self._queues[client] = queue
+
+      self.running += 1
+      self.threadpool.callInThreadWithCallback(
+          lambda success, result, d=d: reactor.callFromThread(
+              self._Done, d, success, result),
+          func, *args, **kwargs)
+
+  def _Done(self, d, success, result):
+    self.queued -= 1
+    self.running -= 1
+    self._Dispatch()
+    if success:
+      d.callback(result)
+    else:
+      d.errback(result)
+
+  def Start(self):
+    """Start the pool threads."""
+    if not self.threadpool.started:
+      self.logger.debug('Starting write pool with %d threads', self.threads)
+      self.threadpool.start()
+
+  def Stop(self):
+    """Stop the pool once all queued work has finished."""
+    if self.threadpool.started:
+      self.logger.debug('Stopping write pool (%d queued)', self.queued)
+      self.threadpool.stop()
+
+  def Submit(self, func, *args, **kwargs):
+    """Run a function in the pool.
+
+    Args:
+      func: The function to call in a pool thread
+      *args: Positional arguments for func
+      **kwargs: Keyword arguments for func
+
+    Returns:
+      A Deferred which fires with the result of func
+    """
+    return self.SubmitFor(None, func, *args, **kwargs)
+
+  def SubmitFor(self, client, func, *args, **kwargs):
+    """Run a function in the pool on behalf of a client.
+
+    Args:
+      client: A string identifying the client, e.g. its IP address
+      func: The function to call in a pool thread
+      *args: Positional arguments for func
+      **kwargs: Keyword arguments for func
+
+    Returns:
+      A Deferred which fires with the result of func
+    """
+    d = defer.Deferred()
+    self.queued += 1
+    self._queues.setdefault(client, collections.deque()).append(
+        (d, func, args, kwargs))
+    self._Dispatch()
+    return d
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Jeff Rebeiro (jeff@rebeiro.net) All rights reserved
+# Tests for the disk writer thread pool
+
+__author__ = 'jeff@rebeiro.net (Jeff Rebeiro)'
+
+import collections
+import unittest
+
+from twisted.internet import reactor
+from twisted.python import failure
+
+import writepool
+
+
+class FakeThreadPool(object):
+  """A thread pool which only runs work when told to, in the caller."""
+
+  started = True
+
+  def __init__(self):
+    self.calls = collections.deque()
+
+  def callInThreadWithCallback(self, on_result, func, *args, **kwargs):
+    self.calls.append((on_result, func, args, kwargs))
+
+  def Run(self):
+    on_result, func, args, kwargs = self.calls.popleft()
+    try:
+      result = func(*args, **kwargs)
+    except Exception:
+      on_result(False, failure.Failure())
+    else:
+      on_result(True, result)
+    # Deliver the result, which the pool hands back to the reactor thread.
+    reactor.runUntilCurrent()
+
+
+class WritePoolTest(unittest.TestCase):
+
+  def GetPool(self, threads):
+    pool = writepool.WritePool(threads)
+    pool.threadpool = FakeThreadPool()
+    return pool
+
+  def testThreads(self):
+    pool = self.GetPool(2)
+    results = []
+    for i in xrange(3):
+      pool.Submit(lambda i=i: i).addCallback(results.append)
+    self.assertEqual(2, len(pool.threadpool.calls))
+    self.assertEqual(2, pool.running)
+    self.assertEqual(3, pool.queued)
+
+    pool.threadpool.Run()
+    self.assertEqual([0], results)
+    self.assertEqual(2, len(pool.threadpool.calls))
+    self.assertEqual(2, pool.queued)
+    pool.threadpool.Run()
+    pool.threadpool.Run()
+    self.assertEqual([0, 1, 2], results)
+    self.assertEqual(0, pool.running)
+    self.assertEqual(0, pool.queued)
+
+  def testClientsTakeTurns(self):
+    pool = self.GetPool(1)
+    order = []
+    for job in ('a1', 'a2', 'a3'):
+      pool.SubmitFor('a', order.append, job)
+    pool.SubmitFor('b', order.append, 'b1')
+    while pool.threadpool.calls:
+      pool.threadpool.Run()
+    self.assertEqual(['a1', 'a2', 'b1', 'a3'], order)
+
+  def testFailure(self):
+    pool = self.GetPool(1)
+    failures = []
+    pool.Submit(lambda: 1 / 0).addErrback(failures.append)
+    pool.threadpool.Run()
+    self.assertTrue(failures[0].check(ZeroDivisionError))
+    self.assertEqual(0, pool.queued)
+
+
+if __name__ == '__main__':
+  unittest.main()